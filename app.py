@@ -1,737 +1,285 @@
-import base64
-import json
-import re
-from io import BytesIO
-
-import gspread
 import pandas as pd
-import requests
 import streamlit as st
-from google.oauth2.service_account import Credentials
+
+from pipeline import (
+    AliasStore,
+    DEFAULT_PAGE_CONCURRENCY,
+    DEFAULT_PAGES_PER_REQUEST,
+    DEFAULT_RENDER_PROFILE,
+    JOB_QUEUE,
+    MAX_PAGE_CONCURRENCY,
+    MAX_PAGES_PER_REQUEST,
+    OPENAI_RETRY_BUDGET_S,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    PAGE_BATCH_OVERLAP,
+    RENDER_PROFILES,
+    JobCheckpoint,
+    KeyRegisterSync,
+    create_report_excel,
+    job_id_for,
+    open_key_register_spreadsheet,
+    pdf_page_count,
+    perf_stage,
+    perf_table,
+    perf_totals,
+)
 
 st.set_page_config(page_title="Reporte de Llaves M", layout="wide")
 
 # ----------------------------------------------------------
 # GOOGLE SHEETS
 # ----------------------------------------------------------
-def authorize_gspread():
-    creds = st.secrets["gcp_service_account"]
-    credentials = Credentials.from_service_account_info(
-        creds,
-        scopes=[
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive",
-        ],
-    )
-    return gspread.authorize(credentials)
-
-
-def load_key_register() -> pd.DataFrame:
-    client = authorize_gspread()
-    sheet_id = st.secrets["gcp_service_account"]["spreadsheet_id"]
-    sheet = client.open_by_key(sheet_id).worksheet("Key Register")
-    data = sheet.get_all_values()
-
-    if len(data) < 2:
-        raise ValueError("La hoja 'Key Register' no tiene suficiente información.")
-
-    df_keys = pd.DataFrame(data[2:], columns=data[1]).drop(columns="", errors="ignore")
-
-    for col in ["Property Address", "Tag"]:
-        if col not in df_keys.columns:
-            raise ValueError(f"No encontré la columna '{col}' en 'Key Register'.")
-
-    if "Observation" in df_keys.columns:
-        df_keys = df_keys[df_keys["Observation"].fillna("").str.strip() == ""]
-
-    df_keys["Property Address"] = df_keys["Property Address"].fillna("").astype(str).str.strip()
-    df_keys["Tag"] = df_keys["Tag"].fillna("").astype(str).str.strip()
-
-    return df_keys.reset_index(drop=True)
-
-
-# ----------------------------------------------------------
-# NORMALIZACIÓN SIMPLE
-# ----------------------------------------------------------
-def simplify_address_15chars(address: str) -> str:
-    if not isinstance(address, str):
-        return ""
-    address = address.strip()
-    m = re.search(r"\d", address)
-    substr = address[m.start():m.start() + 15] if m else address[:15]
-    return re.sub(r"[^0-9A-Za-z\s]", "", substr).lower().strip()
-
-
-# ----------------------------------------------------------
-# NORMALIZACIÓN FUERTE DE DIRECCIONES
-# ----------------------------------------------------------
-def normalize_address(addr: str) -> str:
-    if not isinstance(addr, str):
-        return ""
-
-    addr = addr.lower().strip()
-
-    replacements = {
-        " street": " st",
-        " road": " rd",
-        " terrace": " tce",
-        " avenue": " ave",
-        " boulevard": " bvd",
-        " drive": " dr",
-        " place": " pl",
-        " court": " ct",
-        " lane": " ln",
-        " quay": " qy",
-        " saint ": " st ",
-        " queensland": " qld",
-    }
-
-    for old, new in replacements.items():
-        addr = addr.replace(old, new)
-
-    addr = addr.replace(",", " ")
-    addr = re.sub(r"[^a-z0-9\s/]", " ", addr)
-    addr = re.sub(r"\s+", " ", addr).strip()
-    return addr
-
-
-def extract_address_parts(addr: str) -> dict:
-    a = normalize_address(addr)
-
-    unit = ""
-    street_number = ""
-    postcode = ""
-    street_type = ""
-    suburb = ""
-
-    unit_match = re.match(r"^([a-z]?\d+[a-z]?/\d+[a-z]?)\b", a)
-    if unit_match:
-        unit = unit_match.group(1)
-
-    num_match = re.search(r"\b(\d+)\b", a)
-    if num_match:
-        street_number = num_match.group(1)
-
-    pc_match = re.search(r"\b([2-9]\d{3})\b", a)
-    if pc_match:
-        postcode = pc_match.group(1)
-
-    stype_match = re.search(r"\b(st|rd|tce|ave|bvd|dr|pl|ct|ln|qy)\b", a)
-    if stype_match:
-        street_type = stype_match.group(1)
-
-    state_words = {"qld", "nsw", "vic", "act", "wa", "sa", "tas", "nt"}
-    type_words = {"st", "rd", "tce", "ave", "bvd", "dr", "pl", "ct", "ln", "qy"}
-
-    tokens = a.split()
-    text_tokens = [t for t in tokens if not re.search(r"\d", t) and t not in state_words and t not in type_words]
-
-    if len(text_tokens) >= 2:
-        suburb = " ".join(text_tokens[-2:])
-    elif len(text_tokens) == 1:
-        suburb = text_tokens[-1]
-
-    return {
-        "normalized": a,
-        "unit": unit,
-        "street_number": street_number,
-        "postcode": postcode,
-        "street_type": street_type,
-        "suburb": suburb,
-        "tokens": set(text_tokens),
-    }
-
-
-def score_address_match(pdf_addr: str, key_addr: str) -> float:
-    p = extract_address_parts(pdf_addr)
-    k = extract_address_parts(key_addr)
-
-    score = 0.0
-
-    if p["unit"] and p["unit"] == k["unit"]:
-        score += 35
-    if p["street_number"] and p["street_number"] == k["street_number"]:
-        score += 20
-    if p["street_type"] and p["street_type"] == k["street_type"]:
-        score += 10
-    if p["postcode"] and p["postcode"] == k["postcode"]:
-        score += 10
-    if p["suburb"] and p["suburb"] == k["suburb"]:
-        score += 10
-
-    token_overlap = len(p["tokens"] & k["tokens"])
-    score += min(token_overlap * 5, 20)
-
-    if simplify_address_15chars(pdf_addr) == simplify_address_15chars(key_addr):
-        score += 10
-
-    return round(score, 2)
-
-
-def find_best_match(pdf_addr: str, df_keys: pd.DataFrame):
-    candidates = []
-
-    for _, row in df_keys.iterrows():
-        key_addr = str(row["Property Address"])
-        score = score_address_match(pdf_addr, key_addr)
-
-        if score > 0:
-            candidates.append({
-                "Property Address": key_addr,
-                "Tag": row.get("Tag", ""),
-                "score": score,
-                "row_data": row.to_dict(),
-            })
+# Un solo Key Register vivo para todas las sesiones: arranca del snapshot
+# local y solo aplica las filas que cambiaron en la planilla. El TTL es un
+# techo para volver a comparar aunque Drive no marque cambios.
+REGISTER_CACHE_TTL = 30 * 60
+REGISTER_SYNC_MODES = {
+    "full": "descarga completa",
+    "patch": "solo filas cambiadas",
+    "rebuild": "índice rearmado",
+    "none": "sin cambios en las filas",
+}
 
-    if not candidates:
-        return None, []
 
-    candidates = sorted(candidates, key=lambda x: x["score"], reverse=True)
-    best = candidates[0]
-    return best, candidates[:3]
+@st.cache_resource(show_spinner=False)
+def get_key_register_spreadsheet():
+    return open_key_register_spreadsheet(dict(st.secrets["gcp_service_account"]))
 
 
-def get_m_keys_for_address(matched_address: str, df_keys: pd.DataFrame) -> str:
-    if not matched_address:
-        return ""
+@st.cache_resource(show_spinner=False)
+def get_key_register_sync():
+    return KeyRegisterSync(get_key_register_spreadsheet(), max_age=REGISTER_CACHE_TTL)
 
-    target_norm = normalize_address(matched_address)
-    target_simple = simplify_address_15chars(matched_address)
 
-    subset = df_keys.copy()
-    subset["__norm"] = subset["Property Address"].astype(str).apply(normalize_address)
-    subset["__simple"] = subset["Property Address"].astype(str).apply(simplify_address_15chars)
+def load_key_register():
+    """Devuelve (df_keys, key_index) al día con la planilla."""
+    return get_key_register_sync().sync()
 
-    matched_rows = subset[
-        (subset["__norm"] == target_norm) |
-        (subset["__simple"] == target_simple)
-    ].copy()
 
-    if matched_rows.empty:
-        return ""
+def refresh_key_register():
+    get_key_register_sync().invalidate()
 
-    tags = matched_rows["Tag"].fillna("").astype(str).str.strip()
-    m_tags = sorted({tag for tag in tags if tag.upper().startswith("M")})
 
-    return ", ".join(m_tags)
+@st.cache_resource(show_spinner=False)
+def get_alias_store():
+    return AliasStore()
 
 
 # ----------------------------------------------------------
-# PDF → IMÁGENES BASE64
+# UI
 # ----------------------------------------------------------
-def pdf_to_base64_images(pdf_bytes: bytes) -> list:
-    try:
-        import fitz
-    except ImportError:
-        raise ImportError("Falta PyMuPDF. Agregá 'pymupdf' a requirements.txt")
-
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-    images = []
+st.title("🗝️ Reporte de Llaves M desde PDF")
+st.caption("Lectura visual con IA + matching inteligente + recuperación de todas las llaves M por propiedad.")
 
-    for page in doc:
-        mat = fitz.Matrix(1.5, 1.5)
-        pix = page.get_pixmap(matrix=mat)
-        images.append(base64.b64encode(pix.tobytes("png")).decode())
+pdf_file = st.file_uploader("📥 Sube tu PDF", type=["pdf"])
 
-    doc.close()
-    return images
+with st.expander("⚙️ Opciones avanzadas"):
+    page_concurrency = st.slider(
+        "Páginas leídas en paralelo",
+        min_value=1,
+        max_value=MAX_PAGE_CONCURRENCY,
+        value=DEFAULT_PAGE_CONCURRENCY,
+        help="Con 1 se leen las páginas una por una, como antes.",
+    )
+    pages_per_request = st.slider(
+        "Páginas por request a GPT",
+        min_value=1,
+        max_value=MAX_PAGES_PER_REQUEST,
+        value=DEFAULT_PAGES_PER_REQUEST,
+        help=(
+            "Con 2-3 se mandan páginas consecutivas juntas: menos requests y el prompt se paga una vez; "
+            "una dirección cortada entre dos páginas de la misma request sale entera."
+        ),
+    )
+    batch_overlap = st.checkbox(
+        "Solapar las requests de varias páginas",
+        value=PAGE_BATCH_OVERLAP,
+        help="La última página de cada request se repite en la siguiente, así ningún corte de página queda entre dos requests.",
+        disabled=pages_per_request == 1,
+    )
+    use_page_cache = st.checkbox(
+        "Reusar páginas ya leídas (caché local)",
+        value=True,
+        help="Si una página es idéntica a una ya procesada, no se vuelve a mandar a GPT.",
+    )
+    use_text_layer = st.checkbox(
+        "Leer primero la capa de texto del PDF",
+        value=True,
+        help="Las páginas que se pueden leer sin IA no se mandan a GPT; el resto sigue por visión.",
+    )
+    use_prefilter = st.checkbox(
+        "Saltear páginas vacías o de solo encabezado",
+        value=True,
+        help=(
+            "Antes de GPT se mira cada página: las que no tienen propiedades no se mandan y las que "
+            "solo traen la cola de una dirección cortada se leen con una imagen más chica."
+        ),
+    )
+    retry_budget = st.slider(
+        "Segundos máximos de reintentos por página",
+        min_value=0,
+        max_value=600,
+        value=OPENAI_RETRY_BUDGET_S,
+        step=10,
+        help="Ante 429/5xx se reintenta con backoff; pasado este tiempo la página se marca como fallida.",
+    )
+    render_profile = st.selectbox(
+        "Perfil de imagen para GPT",
+        options=list(RENDER_PROFILES),
+        index=list(RENDER_PROFILES).index(DEFAULT_RENDER_PROFILE),
+        help=(
+            "original: PNG color como antes · estandar: mismo PNG al tamaño que ve el modelo · "
+            "gris_jpeg: gris, JPEG y sin márgenes · economico: menos tiles, puede perder precisión."
+        ),
+    )
 
+    include_debug = st.checkbox(
+        "Incluir hojas de debug en el Excel",
+        value=True,
+        help="Extraido_PDF y Matched_Debug. Sin ellas el Excel sale más rápido; se pueden bajar aparte en CSV.",
+    )
+    use_aliases = st.checkbox(
+        "Usar direcciones ya confirmadas (alias)",
+        value=True,
+        help="Las direcciones del PDF que ya se confirmaron en corridas anteriores no se vuelven a puntuar ni a consultar a GPT.",
+    )
+    profile_matching = st.checkbox(
+        "Perfilar el matching (cProfile)",
+        value=False,
+        help="Corre el matching bajo cProfile y muestra las funciones más costosas. Lo hace algo más lento.",
+    )
 
-# ----------------------------------------------------------
-# FIX 1: PROMPT MEJORADO
-# ----------------------------------------------------------
-PROMPT = """Esta es una página de un "Housekeeping Daily Summary" de Resly/Bedspoke.
-
-Cada propiedad tiene este formato típico:
-- Dirección (en negrita o destacada, con número de unidad/piso y calle)
-- Tipo de tarea (Depart Clean, Service Clean, etc.)
-- Detalles de reservas (nombres de HUÉSPEDES con fechas)
-- NOTAS internas (instrucciones de limpieza, llaves, etc.)
-- Nombre del cleaner asignado (columna "Assigned To", al final de la fila)
-
-REGLAS CRÍTICAS para identificar el cleaner:
-1. El cleaner asignado es el nombre que aparece en la columna "Assigned To" del reporte.
-   Generalmente aparece al final del bloque de cada propiedad, alineado a la derecha.
-2. NUNCA uses nombres que aparecen en las notas internas como cleaner.
-   Las notas contienen instrucciones como "pls return M set to base - Marga" o 
-   "(Ricka Joy Mangi-07/05/26)" — estos son AUTORES DE NOTAS, NO cleaners.
-3. NUNCA uses nombres de huéspedes (van con fechas de reserva, como "SMITH, John (2A0C)").
-4. Si no hay cleaner asignado, devolvé exactamente "Unassigned".
-
-REGLAS para direcciones:
-- La dirección siempre empieza con un número de unidad/piso seguido de "/" y luego 
-  el número de calle. Ejemplo: "1208/35 Hercules Street" o "2/71 Doggett Street".
-- Si una dirección aparece cortada o incompleta al final de la página, devolvela igual 
-  con lo que puedas leer. NO la inventes ni completes.
-- Ignorá encabezados, pies de página, fechas y textos de reserva.
-
-Para cada propiedad devolvé:
-- address: dirección completa
-- cleaner: nombre del cleaner de la columna "Assigned To"
-- page: número de página
-- address_confidence: número entre 0 y 1
-- cleaner_confidence: número entre 0 y 1
-- notes: texto corto si hubo ambigüedad, o ""
-
-Respondé SOLO con JSON válido:
-{
-  "records": [
-    {
-      "address": "...",
-      "cleaner": "...",
-      "page": 1,
-      "address_confidence": 0.93,
-      "cleaner_confidence": 0.88,
-      "notes": ""
-    }
-  ]
-}
-Si no hay propiedades visibles, respondé: {"records": []}
-"""
-
-
-def call_gpt_page(img_b64: str, page_num: int) -> list:
-    api_key = st.secrets.get("OPENAI_API_KEY", "")
-    if not api_key:
-        raise ValueError("Falta 'OPENAI_API_KEY' en los secrets de Streamlit.")
-
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        json={
-            "model": "gpt-4o",
-            "temperature": 0,
-            "max_tokens": 1800,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{img_b64}",
-                                "detail": "high",
-                            },
-                        },
-                        {
-                            "type": "text",
-                            "text": PROMPT,
-                        },
-                    ],
-                }
-            ],
-        },
-        timeout=90,
+    st.caption(
+        f"Límite compartido con OpenAI por minuto: {OPENAI_RPM_LIMIT} requests y {OPENAI_TPM_LIMIT} tokens "
+        "(variables OPENAI_RPM_LIMIT y OPENAI_TPM_LIMIT; 0 = sin límite)."
     )
+    st.caption("El Key Register se guarda en caché y se recarga solo cuando la planilla cambia.")
+    if st.button("🔄 Refrescar Key Register"):
+        refresh_key_register()
+        st.success("Listo: el Key Register se va a descargar de nuevo en el próximo reporte.")
 
-    if response.status_code != 200:
-        try:
-            err = response.json().get("error", {}).get("message", response.text)
-        except Exception:
-            err = response.text
-        raise ValueError(f"Error API GPT página {page_num}: {response.status_code} — {err}")
-
-    raw = response.json()["choices"][0]["message"]["content"].strip()
-    raw = re.sub(r"```json|```", "", raw).strip()
-
-    try:
-        parsed = json.loads(raw)
-    except json.JSONDecodeError:
-        st.warning(f"⚠️ Página {page_num}: no pude parsear JSON. Respuesta: {raw[:300]}")
-        return []
-
-    if isinstance(parsed, dict) and "records" in parsed:
-        records = parsed["records"]
-    elif isinstance(parsed, list):
-        records = parsed
-    else:
-        records = []
-
-    cleaned = []
-    for r in records:
-        try:
-            page_value = int(r.get("page", page_num) or page_num)
-        except Exception:
-            page_value = page_num
+if pdf_file:
+    pdf_bytes = pdf_file.getvalue()
+    job_id = job_id_for(pdf_bytes)
+    previous_run = JobCheckpoint(job_id).summary()
+    # Los casos de revisión guardados son de la corrida de otro PDF
+    if st.session_state.get("review_job_id") != job_id:
+        st.session_state.pop("review_df", None)
+
+    b1, b2 = st.columns([1, 3])
+    generate = b1.button("🚀 Generar Reporte", type="primary")
+    resume_run = False
+    if previous_run:
+        b2.caption(
+            f"Corrida previa de este PDF: {previous_run['ok']} de {previous_run['n_pages']} páginas guardadas, "
+            f"{previous_run['failed']} fallidas, {previous_run['missing']} sin leer."
+        )
+        resume_run = b2.button("♻️ Reanudar (solo páginas faltantes o fallidas)")
 
-        try:
-            address_conf = float(r.get("address_confidence", 0) or 0)
-        except Exception:
-            address_conf = 0.0
+    if generate or resume_run:
+        queue_box = st.empty()
+        progress = st.progress(0, text="Iniciando...")
 
-        try:
-            cleaner_conf = float(r.get("cleaner_confidence", 0) or 0)
-        except Exception:
-            cleaner_conf = 0.0
+        live = st.container()
+        live_extracted = live.empty()
+        live_matched = live.empty()
 
-        cleaned.append({
-            "address": str(r.get("address", "")).strip(),
-            "cleaner": str(r.get("cleaner", "Unassigned")).strip() or "Unassigned",
-            "page": page_value,
-            "address_confidence": address_conf,
-            "cleaner_confidence": cleaner_conf,
-            "notes": str(r.get("notes", "")).strip(),
-        })
+        def show_partial(df_pdf_so_far, matched_so_far):
+            live_extracted.dataframe(df_pdf_so_far, use_container_width=True)
+            if not matched_so_far.empty:
+                live_matched.dataframe(matched_so_far, use_container_width=True)
 
-    return cleaned
+        def show_queue(position, eta_s):
+            queue_box.info(
+                f"⏳ En cola: hay {position} reporte(s) antes que el tuyo · "
+                f"empieza en ~{max(1, round(eta_s / 60))} min"
+            )
 
+        try:
+            run_stats = {}
+            progress.progress(0.02, text="Cargando Key Register...")
+            with perf_stage(run_stats, "register"):
+                key_register = load_key_register()
+
+            # Todas las sesiones comparten la cuota de OpenAI: si ya hay
+            # reportes corriendo, este espera su turno
+            with JOB_QUEUE.slot(pdf_page_count(pdf_bytes), on_wait=show_queue):
+                queue_box.empty()
+                grouped_df, excel_data, extracted_df, matched_df, review_df, run_stats = create_report_excel(
+                    pdf_bytes,
+                    progress,
+                    key_register,
+                    st.secrets.get("OPENAI_API_KEY", ""),
+                    max_workers=page_concurrency,
+                    use_cache=use_page_cache,
+                    use_text_layer=use_text_layer,
+                    render_profile=render_profile,
+                    on_update=show_partial,
+                    retry_budget=retry_budget,
+                    resume=resume_run,
+                    stats=run_stats,
+                    profile_matching=profile_matching,
+                    include_debug=include_debug,
+                    use_aliases=use_aliases,
+                    use_prefilter=use_prefilter,
+                    pages_per_request=pages_per_request,
+                    batch_overlap=batch_overlap,
+                )
+            live_extracted.empty()
+            st.session_state["review_df"] = review_df
+            st.session_state["review_job_id"] = job_id
+            live_matched.empty()
 
-# ----------------------------------------------------------
-# FIX 2: FUSIONAR REGISTROS CON DIRECCIÓN CORTADA ENTRE PÁGINAS
-# ----------------------------------------------------------
-def _looks_like_address_fragment(addr: str) -> bool:
-    """
-    Devuelve True si la cadena parece un fragmento de dirección, no una dirección completa.
-    Señales: no empieza con dígito ni con patrón unit/number, o es solo suburb/estado.
-    """
-    addr = addr.strip()
-    if not addr:
-        return True
-    # Una dirección válida debe empezar con dígito (ej "1208/35") o letra+dígito (ej "A1/35")
-    if re.match(r"^[A-Za-z]?\d", addr):
-        return False
-    # Si empieza con letra pura, es un fragmento (ej "City Q 4000", "Street, South Brisbane...")
-    return True
-
-
-def merge_cross_page_fragments(records: list) -> list:
-    """
-    Detecta registros cuya dirección es un fragmento (no empieza con número)
-    y los fusiona con el registro anterior, que probablemente tenía la dirección cortada.
-    """
-    if not records:
-        return records
-
-    merged = []
-    i = 0
-    while i < len(records):
-        rec = records[i]
-        addr = rec.get("address", "").strip()
-
-        # Si este registro es un fragmento Y hay un registro anterior en merged
-        if _looks_like_address_fragment(addr) and merged:
-            prev = merged[-1]
-            prev_addr = prev.get("address", "").strip()
-
-            # Solo fusionar si están en páginas consecutivas
-            if rec.get("page", 0) == prev.get("page", 0) + 1:
-                fused_address = (prev_addr + " " + addr).strip()
-                prev["address"] = fused_address
-                prev["address_confidence"] = min(
-                    prev.get("address_confidence", 1.0),
-                    rec.get("address_confidence", 1.0),
+            st.success("✅ Reporte generado correctamente")
+            if grouped_df.empty:
+                st.warning("No hubo matches finales. Revisa la hoja Review_Needed.")
+            if run_stats.get("failed_pages"):
+                st.warning(
+                    "⚠️ Páginas que no se pudieron leer: "
+                    + ", ".join(str(f["page"]) for f in run_stats["failed_pages"])
+                    + ". El reporte no incluye sus propiedades."
                 )
-                prev["notes"] = (
-                    (prev.get("notes", "") + " [dirección fusionada entre páginas]").strip()
+            if run_stats.get("unparsed_pages"):
+                st.warning(
+                    "⚠️ Páginas donde GPT respondió algo que no se pudo leer (JSON inválido o cortado): "
+                    + ", ".join(str(f["page"]) for f in run_stats["unparsed_pages"])
+                    + ". Se vuelven a leer con «Reanudar»."
                 )
-                # Si el registro anterior no tenía cleaner pero este sí, usarlo
-                if prev.get("cleaner", "Unassigned") == "Unassigned" and rec.get("cleaner", "Unassigned") != "Unassigned":
-                    prev["cleaner"] = rec["cleaner"]
-                i += 1
-                continue
-
-        merged.append(rec)
-        i += 1
-
-    return merged
-
-
-def extract_all_pages(images: list, progress_bar) -> list:
-    all_records = []
-    n = len(images)
-
-    for i, img in enumerate(images):
-        page_num = i + 1
-        pct = 0.08 + (0.55 * ((i + 1) / max(n, 1)))
-        progress_bar.progress(min(pct, 0.63), text=f"Leyendo página {page_num} de {n} con IA...")
-        records = call_gpt_page(img, page_num)
-        all_records.extend(records)
-
-    # FIX 2: fusionar fragmentos de dirección que cruzan páginas
-    all_records = merge_cross_page_fragments(all_records)
-
-    return all_records
-
-
-# ----------------------------------------------------------
-# GPT TIEBREAKER
-# ----------------------------------------------------------
-def resolve_match_with_gpt(pdf_address: str, candidates: list) -> dict:
-    api_key = st.secrets.get("OPENAI_API_KEY", "")
-    if not api_key:
-        return {"selected_address": "", "confidence": 0, "reason": "No API key"}
-
-    prompt = f"""
-Debes elegir el mejor match entre una dirección extraída de un PDF y hasta 3 candidatos del Key Register.
-
-Dirección PDF:
-{pdf_address}
-
-Candidatos:
-{json.dumps(candidates, ensure_ascii=False, indent=2)}
-
-Responde SOLO JSON válido:
-{{
-  "selected_address": "dirección elegida o vacío",
-  "confidence": 0.0,
-  "reason": "motivo breve"
-}}
-"""
-
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        json={
-            "model": "gpt-4o",
-            "temperature": 0,
-            "max_tokens": 500,
-            "messages": [{"role": "user", "content": prompt}],
-        },
-        timeout=60,
-    )
-
-    if response.status_code != 200:
-        return {"selected_address": "", "confidence": 0, "reason": response.text[:200]}
-
-    raw = response.json()["choices"][0]["message"]["content"].strip()
-    raw = re.sub(r"```json|```", "", raw).strip()
-
-    try:
-        return json.loads(raw)
-    except Exception:
-        return {"selected_address": "", "confidence": 0, "reason": "JSON inválido"}
-
-
-# ----------------------------------------------------------
-# BUILD MATCHES
-# ----------------------------------------------------------
-def build_matches(df_pdf: pd.DataFrame, df_keys: pd.DataFrame):
-    matched_rows = []
-    review_rows = []
-
-    for _, pdf_row in df_pdf.iterrows():
-        pdf_addr = str(pdf_row["Property Nickname"])
-        best, top3 = find_best_match(pdf_addr, df_keys)
-
-        final_address = ""
-        final_tag = ""
-        final_m_keys = ""
-        match_score = 0
-        match_method = "none"
-        review_reason = ""
-
-        if best is not None:
-            match_score = float(best["score"])
-
-            if match_score >= 75:
-                final_address = best["Property Address"]
-                final_tag = best["Tag"]
-                match_method = "rule_auto"
-
-            elif match_score >= 55:
-                gpt_decision = resolve_match_with_gpt(
-                    pdf_addr,
-                    [{"address": c["Property Address"], "score": c["score"]} for c in top3],
+            st.caption(
+                f"Páginas: {run_stats.get('pages', 0)} · "
+                f"reanudadas: {run_stats.get('resumed_pages', 0)} · "
+                f"salteadas: {run_stats.get('skipped_pages', 0)} · "
+                f"solo fragmento: {run_stats.get('fragment_pages', 0)} · "
+                f"capa de texto: {run_stats.get('text_layer_pages', 0)} · "
+                f"desde caché: {run_stats.get('cache_hits', 0)} · "
+                f"leídas con IA: {run_stats.get('gpt_pages', 0)} "
+                f"en {run_stats.get('gpt_requests', 0)} requests · "
+                f"direcciones distintas: {run_stats.get('match_addresses', 0)} "
+                f"de {run_stats.get('match_rows', 0)} filas · "
+                f"por alias: {run_stats.get('alias_hits', 0)}"
+            )
+            register_sync = get_key_register_sync().last_sync
+            if register_sync.get("mode") not in (None, "cached"):
+                st.caption(
+                    f"Key Register: {REGISTER_SYNC_MODES[register_sync['mode']]} · "
+                    f"{register_sync['changed']} filas cambiadas, "
+                    f"{register_sync['added']} nuevas, {register_sync['removed']} borradas "
+                    f"({register_sync['seconds']:.2f} s)"
                 )
-                selected = str(gpt_decision.get("selected_address", "")).strip()
-
-                if selected:
-                    chosen = next((c for c in top3 if c["Property Address"] == selected), None)
-                    if chosen:
-                        final_address = chosen["Property Address"]
-                        final_tag = chosen["Tag"]
-                        match_score = chosen["score"]
-                        match_method = "gpt_tiebreak"
-                    else:
-                        review_reason = f"GPT eligió dirección fuera del top3: {selected}"
-                else:
-                    review_reason = str(gpt_decision.get("reason", "No selection"))
-
-            else:
-                review_reason = "Low score"
-
-        if final_address:
-            final_m_keys = get_m_keys_for_address(final_address, df_keys)
-
-            matched_rows.append({
-                **pdf_row.to_dict(),
-                "Matched Address": final_address,
-                "Matched Tag": final_tag,
-                "Match Score": match_score,
-                "Match Method": match_method,
-                "Llave M": final_m_keys,
-            })
-        else:
-            top_candidates_str = " | ".join(
-                [f"{c['Property Address']} ({c['score']})" for c in top3]
-            ) if top3 else ""
-
-            review_rows.append({
-                **pdf_row.to_dict(),
-                "Top Candidates": top_candidates_str,
-                "Review Reason": review_reason or "No match found",
-            })
-
-    matched_df = pd.DataFrame(matched_rows)
-    review_df = pd.DataFrame(review_rows)
-
-    return matched_df, review_df
-
-
-# ----------------------------------------------------------
-# GENERAR EXCEL
-# ----------------------------------------------------------
-def create_report_excel(pdf_bytes: bytes, progress_bar):
-    progress_bar.progress(0.03, text="Convirtiendo PDF a imágenes...")
-    images = pdf_to_base64_images(pdf_bytes)
-
-    records = extract_all_pages(images, progress_bar)
-    progress_bar.progress(0.66, text="Preparando extracción...")
-
-    if not records:
-        raise ValueError("GPT no encontró propiedades en el PDF.")
-
-    df_pdf = pd.DataFrame(records)
-    df_pdf = df_pdf.rename(columns={"address": "Property Nickname", "cleaner": "Cleaner"})
 
-    for col in ["Cleaner", "Property Nickname", "notes"]:
-        if col in df_pdf.columns:
-            df_pdf[col] = df_pdf[col].fillna("").astype(str).str.strip()
+            page_log = [run_stats["page_log"][p] for p in sorted(run_stats.get("page_log", {}))]
+            if page_log:
+                with st.expander("Detalle por página: tamaño de imagen y tokens"):
+                    st.dataframe(pd.DataFrame(page_log), use_container_width=True)
 
-    df_pdf["Cleaner"] = df_pdf["Cleaner"].replace("", "Unassigned")
-    df_pdf = df_pdf[df_pdf["Property Nickname"] != ""].reset_index(drop=True)
+            if run_stats.get("page_classes"):
+                with st.expander("Pre-filtro: clase de cada página"):
+                    st.dataframe(pd.DataFrame(run_stats["page_classes"]), use_container_width=True)
 
-    progress_bar.progress(0.72, text="Cargando Key Register...")
-    df_keys = load_key_register()
-
-    progress_bar.progress(0.80, text="Haciendo match inteligente...")
-    matched_df, review_df = build_matches(df_pdf, df_keys)
-
-    if matched_df.empty and review_df.empty:
-        raise ValueError("No se pudo construir ningún resultado. Revisa el PDF y el Key Register.")
-
-    if matched_df.empty:
-        st.warning("No hubo matches finales. Revisa la hoja Review_Needed.")
-        grouped = pd.DataFrame(columns=["Dirección", "Encargado", "Llave M"])
-    else:
-        df_report = matched_df[["Cleaner", "Property Nickname", "Llave M"]].rename(
-            columns={"Cleaner": "Encargado", "Property Nickname": "Dirección"}
-        )
-
-        df_report = df_report.fillna("").astype(str)
-        df_report["Encargado"] = df_report["Encargado"].str.strip().replace("", "Unassigned")
-        df_report["Dirección"] = df_report["Dirección"].str.strip()
-        df_report["Llave M"] = df_report["Llave M"].str.strip()
-        df_report = df_report[df_report["Dirección"] != ""]
-
-        grouped = (
-            df_report.groupby(["Encargado", "Dirección"], as_index=False)
-            .agg({"Llave M": lambda x: ", ".join(sorted({v.strip() for v in x if v.strip()}))})
-            .sort_values(["Encargado", "Dirección"])
-        )[["Dirección", "Encargado", "Llave M"]]
-
-    progress_bar.progress(0.92, text="Generando Excel...")
-
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        grouped.to_excel(writer, sheet_name="Reporte", index=False)
-        df_pdf.to_excel(writer, sheet_name="Extraido_PDF", index=False)
-
-        if matched_df.empty:
-            matched_df = pd.DataFrame(columns=[
-                "Cleaner", "Property Nickname", "page",
-                "address_confidence", "cleaner_confidence", "notes",
-                "Matched Address", "Matched Tag", "Match Score",
-                "Match Method", "Llave M"
-            ])
-        matched_df.to_excel(writer, sheet_name="Matched_Debug", index=False)
-
-        if review_df.empty:
-            review_df = pd.DataFrame(columns=[
-                "Cleaner", "Property Nickname", "page", "address_confidence",
-                "cleaner_confidence", "notes", "Top Candidates", "Review Reason"
-            ])
-        review_df.to_excel(writer, sheet_name="Review_Needed", index=False)
-
-        wb = writer.book
-        hdr = wb.add_format({
-            "bold": True,
-            "bg_color": "#305496",
-            "font_color": "white",
-            "border": 1,
-            "align": "center",
-            "valign": "vcenter",
-        })
-        cel = wb.add_format({
-            "border": 1,
-            "align": "left",
-            "valign": "vcenter",
-        })
-        alt = wb.add_format({
-            "border": 1,
-            "bg_color": "#F2F2F2",
-            "align": "left",
-            "valign": "vcenter",
-        })
-
-        ws = writer.sheets["Reporte"]
-        for col, name in enumerate(grouped.columns):
-            ws.write(0, col, name, hdr)
-        ws.set_column("A:A", 48, cel)
-        ws.set_column("B:B", 30, cel)
-        ws.set_column("C:C", 40, cel)
-        for row in range(1, len(grouped) + 1):
-            ws.set_row(row, None, alt if row % 2 == 0 else cel)
-
-        ws2 = writer.sheets["Extraido_PDF"]
-        for col, name in enumerate(df_pdf.columns):
-            ws2.write(0, col, name, hdr)
-        ws2.set_column("A:A", 55)
-        ws2.set_column("B:B", 28)
-        ws2.set_column("C:F", 18)
-
-        ws3 = writer.sheets["Matched_Debug"]
-        for col, name in enumerate(matched_df.columns):
-            ws3.write(0, col, name, hdr)
-        ws3.set_column(0, len(matched_df.columns) - 1, 24)
-
-        ws4 = writer.sheets["Review_Needed"]
-        for col, name in enumerate(review_df.columns):
-            ws4.write(0, col, name, hdr)
-        ws4.set_column(0, len(review_df.columns) - 1, 28)
-
-    output.seek(0)
-    progress_bar.progress(1.0, text="¡Listo!")
-    return grouped, output.read(), df_pdf, matched_df, review_df
-
-
-# ----------------------------------------------------------
-# UI
-# ----------------------------------------------------------
-st.title("🗝️ Reporte de Llaves M desde PDF")
-st.caption("Lectura visual con IA + matching inteligente + recuperación de todas las llaves M por propiedad.")
-
-pdf_file = st.file_uploader("📥 Sube tu PDF", type=["pdf"])
-
-if pdf_file:
-    if st.button("🚀 Generar Reporte", type="primary"):
-        progress = st.progress(0, text="Iniciando...")
-
-        try:
-            pdf_bytes = pdf_file.read()
-
-            grouped_df, excel_data, extracted_df, matched_df, review_df = create_report_excel(
-                pdf_bytes,
-                progress
-            )
-
-            st.success("✅ Reporte generado correctamente")
+            if run_stats.get("text_layer_confidence"):
+                with st.expander("Confianza de la capa de texto por página"):
+                    st.dataframe(pd.DataFrame(run_stats["text_layer_confidence"]), use_container_width=True)
 
             c1, c2, c3, c4 = st.columns(4)
             c1.metric("Trabajos detectados", len(extracted_df))
@@ -739,6 +287,20 @@ if pdf_file:
             c3.metric("Pendientes revisión", len(review_df))
             c4.metric("Filas reporte final", len(grouped_df))
 
+            totals = perf_totals(run_stats)
+            p1, p2, p3, p4 = st.columns(4)
+            p1.metric("Tiempo total", f"{totals['seconds']:.1f} s")
+            p2.metric("Llamadas OpenAI", totals["openai_calls"])
+            p3.metric("Tokens de entrada", f"{totals['prompt_tokens']:,}")
+            p4.metric("Tokens de salida", f"{totals['completion_tokens']:,}")
+
+            with st.expander("Tiempos y tokens por etapa (hoja Perf)"):
+                st.dataframe(perf_table(run_stats), use_container_width=True)
+                st.caption("En la hoja Perf del Excel, «excel» no incluye el cierre (compresión) del archivo.")
+                if run_stats.get("matching_profile"):
+                    st.caption("cProfile del matching (por tiempo acumulado)")
+                    st.code(run_stats["matching_profile"])
+
             st.subheader("Vista previa: extraído del PDF")
             st.dataframe(extracted_df, use_container_width=True)
 
@@ -756,9 +318,59 @@ if pdf_file:
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
 
+            if not include_debug:
+                d1, d2 = st.columns(2)
+                d1.download_button(
+                    label="⬇️ Extraido_PDF (CSV)",
+                    data=extracted_df.to_csv(index=False),
+                    file_name="extraido_pdf.csv",
+                    mime="text/csv",
+                )
+                d2.download_button(
+                    label="⬇️ Matched_Debug (CSV)",
+                    data=matched_df.to_csv(index=False),
+                    file_name="matched_debug.csv",
+                    mime="text/csv",
+                )
+
         except Exception as e:
             st.error(f"❌ Error: {e}")
             import traceback
             st.code(traceback.format_exc())
+
+    # Resolver a mano los casos de revisión; queda en session_state para
+    # sobrevivir al rerun de Streamlit al editar la tabla
+    pending_review = st.session_state.get("review_df")
+    key_index = get_key_register_sync().key_index if pending_review is not None else None
+    if key_index is not None and not pending_review.empty:
+        with st.expander("✍️ Resolver casos de revisión (se recuerdan para las próximas corridas)"):
+            to_resolve = (
+                pending_review[["Property Nickname", "Top Candidates"]]
+                .drop_duplicates("Property Nickname")
+                .assign(**{"Dirección correcta": None})
+                .reset_index(drop=True)
+            )
+            edited = st.data_editor(
+                to_resolve,
+                column_config={
+                    "Dirección correcta": st.column_config.SelectboxColumn(
+                        "Dirección correcta",
+                        options=sorted(set(key_index.addresses)),
+                        help="Dirección del Key Register que corresponde a esta fila del PDF.",
+                    ),
+                },
+                disabled=["Property Nickname", "Top Candidates"],
+                hide_index=True,
+                use_container_width=True,
+                key=f"review_editor_{job_id}",
+            )
+            if st.button("💾 Guardar resoluciones"):
+                resolutions = {
+                    row["Property Nickname"]: row["Dirección correcta"]
+                    for _, row in edited.iterrows()
+                    if row["Dirección correcta"]
+                }
+                saved = get_alias_store().learn_manual(resolutions, key_index)
+                st.success(f"Listo: {saved} direcciones guardadas como alias.")
 else:
     st.info("📄 Esperando que subas un PDF")
\ No newline at end of file
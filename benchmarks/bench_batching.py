@@ -0,0 +1,197 @@
+"""
+Benchmark de lectura con varias páginas por request contra una página por
+request, con el stub local de OpenAI: requests, tokens, tiempo de lectura y
+cuántas direcciones cortadas entre páginas quedan bien en los registros
+finales (después de merge_cross_page_fragments).
+
+    python benchmarks/bench_batching.py --pages 24 --cut-rate 0.5
+
+Cada corte de página elegido parte la última dirección de la página en dos:
+antes del suburb o del tipo de calle (la cola empieza con letra), antes del
+postcode o después de la unidad (la cola empieza con número y la heurística
+no la pega). Con solapamiento todos los cortes tienen que quedar bien: si no,
+el script termina con código 1. El stub
+devuelve la dirección entera cuando las dos páginas van en la misma request.
+La latencia del stub crece por imagen (--image-latency-ms) porque la
+respuesta de una ventana es más larga.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pipeline  # noqa: E402
+from openai_stub import OpenAIStub  # noqa: E402
+from synthetic import synthetic_pdf, synthetic_pdf_records, synthetic_register  # noqa: E402
+
+MODES = [(1, False), (2, False), (2, True), (3, False), (3, True)]
+# Corte antes del tipo de calle: la cola ("Street, South Brisbane QLD 4101")
+# se normaliza distinto sola que dentro de la dirección entera
+_STREET_TYPE_RE = re.compile(
+    r" (?:street|road|terrace|avenue|boulevard|drive|place|court|lane|quay"
+    r"|st|rd|tce|ave|bvd|dr|pl|ct|ln|qy)\b",
+    re.IGNORECASE,
+)
+
+
+def _cut(address: str, rng: random.Random):
+    """(cabeza, cola) de una dirección cortada, o None si no hay dónde cortarla."""
+    cuts = []
+    if ", " in address:
+        head, tail = address.split(", ", 1)
+        cuts.append((head + ",", tail))
+    if address[-4:].isdigit() and " " in address:
+        cuts.append((address[:-5], address[-4:]))
+    if "/" in address:
+        head, tail = address.split("/", 1)
+        cuts.append((head + "/", tail))
+    street_type = _STREET_TYPE_RE.search(address)
+    if street_type:
+        cuts.append((address[:street_type.start()], address[street_type.start() + 1:]))
+    return rng.choice(cuts) if cuts else None
+
+
+def cut_records(records: list, cut_rate: float, seed: int) -> tuple:
+    """
+    Registros como se ven en cada página (con las direcciones cortadas) y los
+    cortes [(página, cabeza, cola, dirección entera)].
+    """
+    rng = random.Random(seed)
+    by_page = {}
+    for r in records:
+        by_page.setdefault(r["page"], []).append(dict(r))
+
+    cuts = []
+    for page in sorted(by_page)[:-1]:
+        last = by_page[page][-1]
+        parts = _cut(last["address"], rng) if rng.random() < cut_rate else None
+        if parts is None:
+            continue
+        head, tail = parts
+        cuts.append((page, head, tail, last["address"]))
+        last["address"] = head
+        by_page[page + 1].insert(0, {
+            "address": tail,
+            "cleaner": "Unassigned",
+            "page": page + 1,
+            "address_confidence": 0.6,
+            "cleaner_confidence": 0.5,
+            "notes": "",
+        })
+    return [r for page in sorted(by_page) for r in by_page[page]], cuts
+
+
+def read_pages(pdf_bytes: bytes, n_pages: int, args, pages_per_request: int, batch_overlap: bool) -> tuple:
+    stats = {}
+    profile = pipeline.RENDER_PROFILES[args.render_profile]
+    pages = pipeline.iter_pdf_pages(pdf_bytes, profile=profile, use_text_layer=False, stats=stats, use_prefilter=False)
+    page_records = pipeline.iter_page_records(
+        pages,
+        n_pages,
+        None,
+        max_workers=args.page_concurrency,
+        stats=stats,
+        profile=profile,
+        api_key="stub",
+        pages_per_request=pages_per_request,
+        batch_overlap=batch_overlap,
+    )
+    records = [r for chunk in pipeline.iter_merged_records(page_records, stats) for r in chunk]
+    return records, stats
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=24)
+    parser.add_argument("--records-per-page", type=int, default=12)
+    parser.add_argument("--cut-rate", type=float, default=0.5, help="Fracción de cortes de página con una dirección partida")
+    parser.add_argument("--page-concurrency", type=int, default=pipeline.DEFAULT_PAGE_CONCURRENCY)
+    parser.add_argument("--render-profile", choices=list(pipeline.RENDER_PROFILES), default=pipeline.DEFAULT_RENDER_PROFILE)
+    parser.add_argument("--latency-ms", type=float, default=300, help="Latencia del stub con una imagen")
+    parser.add_argument("--image-latency-ms", type=float, default=200, help="Latencia extra por cada imagen más")
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", default=None, help="Guardar resultados en este archivo")
+    args = parser.parse_args()
+    args.json = os.path.abspath(args.json) if args.json else None
+
+    # Checkpoints y caché del pipeline quedan en un directorio temporal
+    os.chdir(tempfile.mkdtemp(prefix="bedspoke-bench-"))
+    # Sin límite de RPM/TPM: se mide la lectura, no la espera por la cuota
+    pipeline.set_rate_limits(0, 0)
+
+    df_keys = synthetic_register(2000, seed=args.seed)
+    truth = synthetic_pdf_records(df_keys, args.pages * args.records_per_page, seed=args.seed)
+    for i, r in enumerate(truth):
+        r["page"] = 1 + i // args.records_per_page
+    seen, cuts = cut_records(truth, args.cut_rate, args.seed)
+    pdf_bytes = synthetic_pdf(seen)
+    n_pages = pipeline.pdf_page_count(pdf_bytes)
+
+    expected = Counter(pipeline.normalize_address(r["address"]) for r in truth)
+    cut_addresses = Counter(pipeline.normalize_address(full) for _, _, _, full in cuts)
+    images = pipeline.pdf_to_base64_images(pdf_bytes, profile=pipeline.RENDER_PROFILES[args.render_profile])
+
+    print(f"{n_pages} páginas, {len(truth)} propiedades, {len(cuts)} direcciones cortadas entre páginas")
+    print(
+        f"{'páginas/req':>11} {'solapa':>6} {'requests':>8} {'prompt tok':>10} {'compl tok':>9} "
+        f"{'segundos':>8} {'cortes ok':>9} {'de más':>6} {'faltan':>6}"
+    )
+    results = []
+    for pages_per_request, batch_overlap in MODES:
+        with OpenAIStub(
+            latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+            image_latency_ms=args.image_latency_ms, seed=args.seed,
+        ) as stub:
+            pipeline.set_openai_base_url(stub.base_url)
+            for page_num, img_b64 in enumerate(images, start=1):
+                stub.add_page(img_b64, [r for r in seen if r["page"] == page_num])
+            for page, head, tail, full in cuts:
+                stub.add_join(images[page - 1], images[page], head, tail, full)
+
+            started = time.perf_counter()
+            records, stats = read_pages(pdf_bytes, n_pages, args, pages_per_request, batch_overlap)
+            seconds = time.perf_counter() - started
+
+        got = Counter(pipeline.normalize_address(r["address"]) for r in records)
+        perf = stats["perf"]["gpt_page"]
+        row = {
+            "pages_per_request": pages_per_request,
+            "overlap": batch_overlap,
+            "requests": stub.requests,
+            "prompt_tokens": perf["prompt_tokens"],
+            "completion_tokens": perf["completion_tokens"],
+            "seconds": round(seconds, 3),
+            "cuts_ok": len(cuts) - sum(min(n, max(expected[a] - got[a], 0)) for a, n in cut_addresses.items()),
+            "cuts": len(cuts),
+            "extra": sum((got - expected).values()),
+            "missing": sum((expected - got).values()),
+        }
+        results.append(row)
+        print(
+            f"{pages_per_request:>11} {'sí' if batch_overlap else 'no':>6} {row['requests']:>8} "
+            f"{row['prompt_tokens']:>10} {row['completion_tokens']:>9} {row['seconds']:>8.2f} "
+            f"{row['cuts_ok']:>5}/{row['cuts']:<3} {row['extra']:>6} {row['missing']:>6}",
+            flush=True,
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+    broken = [r for r in results if r["overlap"] and (r["cuts_ok"] < r["cuts"] or r["extra"] or r["missing"])]
+    for r in broken:
+        print(f"ERROR: con {r['pages_per_request']} páginas/req y solapamiento quedaron cortes mal")
+    return 1 if broken else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""
+Benchmark del scoring de direcciones: bucle fila a fila (score_address_match
+sobre iterrows, como el matching original) contra el índice vectorizado. El
+bucle usa las mismas reglas que top_k (fuzzy=True), así que los top 3 tienen
+que coincidir.
+
+Uso:
+    python benchmarks/bench_scoring.py --sizes 1000 10000 100000 --queries 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pipeline  # noqa: E402
+from synthetic import synthetic_address, synthetic_register  # noqa: E402
+
+
+def loop_top3(pdf_addr: str, df_keys: pd.DataFrame) -> list:
+    scored = []
+    for pos, (_, row) in enumerate(df_keys.iterrows()):
+        score = pipeline.score_address_match(pdf_addr, str(row["Property Address"]), fuzzy=True)
+        if score > 0:
+            scored.append((pos, score))
+    scored.sort(key=lambda item: (-item[1], item[0]))
+    return scored[:3]
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--loop-max", type=int, default=10000,
+                        help="No correr el bucle fila a fila por encima de este tamaño")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{'filas':>8} {'índice s':>9} {'loop ms/q':>10} {'vect ms/q':>10} {'speedup':>8}")
+    for size in args.sizes:
+        rng = random.Random(args.seed)
+        df_keys = synthetic_register(size, seed=args.seed)
+        queries = [synthetic_address(rng) for _ in range(args.queries)]
+
+        key_index, build_s = timed(lambda: pipeline.KeyRegisterIndex(df_keys))
+        vect, vect_s = timed(lambda: key_index.top_k_many(queries, 3))
+        vect_ms = vect_s / len(queries) * 1000
+
+        if size <= args.loop_max:
+            loop, loop_s = timed(lambda: [loop_top3(q, df_keys) for q in queries])
+            if loop != vect:
+                raise SystemExit(f"Resultados distintos con {size} filas")
+            loop_ms = loop_s / len(queries) * 1000
+            print(f"{size:>8} {build_s:>9.2f} {loop_ms:>10.1f} {vect_ms:>10.2f} {loop_ms / vect_ms:>7.0f}x")
+        else:
+            print(f"{size:>8} {build_s:>9.2f} {'-':>10} {vect_ms:>10.2f} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Servidor local que imita POST /v1/chat/completions para medir el pipeline sin
+gastar tokens ni depender de la red.
+
+- Lectura de páginas (request con imágenes): devuelve los registros cargados
+  con add_page(img_b64, records) para cada imagen; una imagen desconocida no
+  suma registros. Con add_join(...) una dirección cortada entre dos páginas
+  sale entera cuando las dos imágenes van seguidas en la misma request, como
+  haría el modelo.
+- Tiebreak (request de solo texto): elige el primer candidato de cada caso.
+- Latencia configurable (media ± jitter, más image_latency_ms por cada imagen
+  después de la primera) y una tasa de errores que responde 429 con
+  retry-after-ms o 500/503.
+- prompt_tokens: texto / 4 más image_tokens por imagen.
+
+Uso suelto, por ejemplo para la CLI:
+    python benchmarks/openai_stub.py --port 8900 --latency-ms 300 --error-rate 0.05
+    python cli.py pdfs/ --openai-base-url http://127.0.0.1:8900/v1 ...
+"""
+import argparse
+import copy
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def image_key(img_b64: str) -> str:
+    return hashlib.sha256(img_b64.encode()).hexdigest()
+
+
+class OpenAIStub:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        seed: int = 0,
+        image_latency_ms: float = 0,
+        image_tokens: int = 765,
+    ):
+        self.latency_ms = latency_ms
+        self.image_latency_ms = image_latency_ms
+        self.image_tokens = image_tokens
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.pages = {}
+        self.joins = {}
+        self.requests = 0
+        self.errors = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def add_page(self, img_b64: str, records: list):
+        self.pages[image_key(img_b64)] = records
+
+    def add_join(self, head_img: str, tail_img: str, head_address: str, tail_address: str, full_address: str):
+        """Dirección cortada: `head_address` al final de una página y `tail_address` al principio de la otra."""
+        self.joins[(image_key(head_img), image_key(tail_img))] = (head_address, tail_address, full_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------------------------------------
+    def _draw(self, n_images: int = 0) -> tuple:
+        with self._lock:
+            self.requests += 1
+            delay = self.latency_ms + self.image_latency_ms * max(n_images - 1, 0)
+            delay = max(0.0, delay + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            failed = self._rng.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return delay, failed
+
+    def _answer(self, payload: dict) -> dict:
+        content = payload["messages"][0]["content"]
+
+        if isinstance(content, list):
+            keys = [
+                image_key(c["image_url"]["url"].split("base64,", 1)[1])
+                for c in content if c.get("type") == "image_url"
+            ]
+            records = [copy.deepcopy(r) for key in keys for r in self.pages.get(key, [])]
+            for pair in zip(keys, keys[1:]):
+                if pair not in self.joins:
+                    continue
+                head, tail, full = self.joins[pair]
+                heads = [r for r in records if r["address"] == head]
+                tails = [r for r in records if r["address"] == tail]
+                if heads and tails:
+                    heads[0]["address"] = full
+                    records.remove(tails[0])
+            text = json.dumps({"records": records}, ensure_ascii=False)
+            prompt_text = sum(len(c.get("text", "")) for c in content if c.get("type") == "text")
+            prompt_tokens = prompt_text // 4 + self.image_tokens * len(keys)
+        else:
+            match = re.search(r"Casos:\s*(\[.*\])\s*Responde", content, re.DOTALL)
+            cases = json.loads(match.group(1)) if match else []
+            text = json.dumps({"results": [
+                {
+                    "id": case["id"],
+                    "selected_address": case["candidates"][0]["address"] if case["candidates"] else "",
+                    "confidence": 0.8,
+                    "reason": "stub",
+                }
+                for case in cases
+            ]}, ensure_ascii=False)
+            prompt_tokens = len(content) // 4
+
+        return {
+            "choices": [{"message": {"role": "assistant", "content": text}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(text) // 4},
+        }
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict, headers: dict = None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if not self.path.endswith("/chat/completions"):
+                    self._send(404, {"error": {"message": f"Ruta desconocida {self.path}"}})
+                    return
+
+                content = payload.get("messages", [{}])[0].get("content")
+                n_images = sum(1 for c in content if c.get("type") == "image_url") if isinstance(content, list) else 0
+                delay, failed = stub._draw(n_images)
+                time.sleep(delay)
+
+                if failed:
+                    headers = {"retry-after-ms": "50"} if stub.error_status == 429 else {}
+                    self._send(stub.error_status, {"error": {"message": "stub: error simulado"}}, headers)
+                    return
+
+                self._send(200, stub._answer(payload))
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub local de /v1/chat/completions")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--image-latency-ms", type=float, default=0, help="Latencia extra por cada imagen después de la primera")
+    args = parser.parse_args()
+
+    stub = OpenAIStub(
+        args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.error_status,
+        image_latency_ms=args.image_latency_ms,
+    )
+    print(f"Stub escuchando en {stub.base_url}")
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Benchmarks de punta a punta sin red: Key Register sintético, registros de PDF
+con ruido y el stub local de OpenAI. Mide por etapa el tiempo, la memoria
+pico (tracemalloc) y el throughput.
+
+    python benchmarks/run_benchmarks.py --sizes 1000 10000 100000 --json base.json
+    python benchmarks/run_benchmarks.py --compare base.json --tolerance 0.25
+
+Con --compare el script termina con código 1 si alguna etapa es más lenta que
+la referencia en más de la tolerancia.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pipeline  # noqa: E402
+from openai_stub import OpenAIStub  # noqa: E402
+from synthetic import synthetic_pdf, synthetic_pdf_records, synthetic_register  # noqa: E402
+
+
+class StageTimer:
+    def __init__(self, track_memory: bool = True):
+        self.track_memory = track_memory
+        self.results = []
+
+    def run(self, size: int, stage: str, items: int, fn):
+        if self.track_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        value = fn()
+        seconds = time.perf_counter() - start
+        peak_mb = None
+        if self.track_memory:
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+
+        self.results.append({
+            "size": size,
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "items": items,
+            "items_per_s": round(items / seconds, 1) if seconds else None,
+            "peak_mb": round(peak_mb, 1) if peak_mb is not None else None,
+        })
+        row = self.results[-1]
+        print(
+            f"{size:>8} {stage:<16} {row['seconds']:>9.3f}s {items:>8} "
+            f"{row['items_per_s'] or 0:>11.1f}/s {row['peak_mb'] if peak_mb is not None else '-':>9} MB",
+            flush=True,
+        )
+        return value
+
+
+def bench_size(timer: StageTimer, size: int, args, stub: OpenAIStub):
+    df_keys = timer.run(size, "register", size, lambda: synthetic_register(size, seed=args.seed))
+    key_index = timer.run(size, "index", size, lambda: pipeline.KeyRegisterIndex(df_keys))
+
+    records = synthetic_pdf_records(df_keys, args.records, seed=args.seed)
+    addresses = [r["address"] for r in records]
+    best = timer.run(
+        size, "find_best_match", len(addresses),
+        lambda: [pipeline.find_best_match(a, key_index)[0] for a in addresses],
+    )
+    matched = [b["Property Address"] for b in best if b is not None]
+    timer.run(
+        size, "m_keys", len(matched),
+        lambda: [pipeline.get_m_keys_for_address(a, key_index) for a in matched],
+    )
+
+    df_pdf = pipeline.records_to_dataframe(records)
+    matched_df, review_df = timer.run(
+        size, "build_matches", len(df_pdf),
+        lambda: pipeline.build_matches(df_pdf, key_index, {}, args.api_key),
+    )
+
+    if matched_df.empty:
+        matched_df = pipeline.pd.DataFrame(columns=pipeline.MATCHED_COLUMNS)
+    if review_df.empty:
+        review_df = pipeline.pd.DataFrame(columns=pipeline.REVIEW_COLUMNS)
+    grouped = pipeline.group_report(matched_df)
+    timer.run(
+        size, "excel", len(df_pdf),
+        lambda: pipeline.write_report_excel(grouped, df_pdf, matched_df, review_df),
+    )
+    timer.run(
+        size, "excel_no_debug", len(df_pdf),
+        lambda: pipeline.write_report_excel(grouped, df_pdf, matched_df, review_df, include_debug=False),
+    )
+
+    if args.e2e_pages:
+        pdf_records = synthetic_pdf_records(df_keys, args.e2e_pages * 12, seed=args.seed + 1)
+        pdf_bytes = synthetic_pdf(pdf_records)
+        profile = pipeline.RENDER_PROFILES[args.render_profile]
+        for page_num, img_b64 in enumerate(pipeline.pdf_to_base64_images(pdf_bytes, profile=profile), start=1):
+            stub.add_page(img_b64, [r for r in pdf_records if r["page"] == page_num])
+
+        timer.run(
+            size, "e2e", args.e2e_pages,
+            lambda: pipeline.create_report_excel(
+                pdf_bytes,
+                None,
+                (df_keys, key_index),
+                args.api_key,
+                max_workers=args.page_concurrency,
+                use_cache=False,
+                use_text_layer=False,
+                use_aliases=False,
+                render_profile=args.render_profile,
+            ),
+        )
+
+
+def compare(results: list, baseline_path: str, tolerance: float) -> list:
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["size"], r["stage"]): r for r in json.load(f)["results"]}
+
+    regressions = []
+    for r in results:
+        base = baseline.get((r["size"], r["stage"]))
+        if not base or not base["seconds"]:
+            continue
+        ratio = r["seconds"] / base["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append({**r, "baseline_seconds": base["seconds"], "ratio": round(ratio, 2)})
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--records", type=int, default=300, help="Registros de PDF por tamaño")
+    parser.add_argument("--e2e-pages", type=int, default=8, help="Páginas del PDF de punta a punta (0 = no correr)")
+    parser.add_argument("--page-concurrency", type=int, default=pipeline.DEFAULT_PAGE_CONCURRENCY)
+    parser.add_argument("--render-profile", choices=list(pipeline.RENDER_PROFILES), default=pipeline.DEFAULT_RENDER_PROFILE)
+    parser.add_argument("--latency-ms", type=float, default=200, help="Latencia media del stub")
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fracción de requests con 429")
+    parser.add_argument("--no-memory", action="store_true", help="Sin tracemalloc (tiempos más cercanos a producción)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", default=None, help="Guardar resultados en este archivo")
+    parser.add_argument("--compare", default=None, help="JSON de referencia para detectar regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    args.api_key = "stub"
+    args.json = os.path.abspath(args.json) if args.json else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+
+    # Checkpoints y caché del pipeline quedan en un directorio temporal
+    os.chdir(tempfile.mkdtemp(prefix="bedspoke-bench-"))
+    # Sin límite de RPM/TPM: contra el stub se mide el pipeline, no la cuota
+    pipeline.set_rate_limits(0, 0)
+
+    timer = StageTimer(track_memory=not args.no_memory)
+    print(f"{'filas':>8} {'etapa':<16} {'tiempo':>10} {'items':>8} {'throughput':>13} {'pico':>12}")
+    with OpenAIStub(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate) as stub:
+        pipeline.set_openai_base_url(stub.base_url)
+        for size in args.sizes:
+            bench_size(timer, size, args, stub)
+        print(f"Stub: {stub.requests} requests, {stub.errors} errores simulados")
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"RSS máximo del proceso: {max_rss_mb:.0f} MB")
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("json", "compare", "api_key")},
+        "max_rss_mb": round(max_rss_mb, 1),
+        "results": timer.results,
+    }
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        regressions = compare(timer.results, args.compare, args.tolerance)
+        for r in regressions:
+            print(f"REGRESIÓN {r['size']} {r['stage']}: {r['seconds']:.3f}s vs {r['baseline_seconds']:.3f}s (x{r['ratio']})")
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Datos sintéticos para los benchmarks: Key Register con direcciones al estilo
+Brisbane (unidades, tipos de calle, postcodes, varias llaves por propiedad),
+registros de PDF con el ruido típico de la lectura y PDFs de Daily Summary
+con capa de texto.
+"""
+import random
+
+import pandas as pd
+
+STREETS = [
+    "Vulture", "Boundary", "Hardgrave", "Montague", "Melbourne", "Grey", "Merivale", "Hercules",
+    "Doggett", "Ann", "Wickham", "Brunswick", "Little Stanley", "Macquarie", "Saint Pauls",
+    "Kent", "Commercial", "Skyring", "Gladstone", "Logan", "Stanley", "Annerley", "Main",
+    "Lambert", "Ernest", "Cordelia", "Russell", "Edmondstone", "Petrie", "Given",
+]
+STREET_TYPES = [
+    ("Street", "St"), ("Road", "Rd"), ("Terrace", "Tce"), ("Avenue", "Ave"), ("Drive", "Dr"),
+    ("Place", "Pl"), ("Court", "Ct"), ("Lane", "Ln"), ("Boulevard", "Bvd"), ("Quay", "Qy"),
+]
+SUBURBS = [
+    ("West End", "4101"), ("South Brisbane", "4101"), ("Highgate Hill", "4101"),
+    ("Woolloongabba", "4102"), ("Kangaroo Point", "4169"), ("Paddington", "4064"),
+    ("New Farm", "4005"), ("Teneriffe", "4005"), ("Fortitude Valley", "4006"),
+    ("Newstead", "4006"), ("Spring Hill", "4000"), ("Brisbane City", "4000"),
+    ("Hamilton", "4007"), ("Milton", "4064"), ("Toowong", "4066"), ("Bulimba", "4171"),
+]
+CLEANERS = ["Maria Lopez", "Juan Perez", "Ana Silva", "Lucas Gomez", "Sofia Diaz", "Unassigned"]
+
+
+def synthetic_address(rng: random.Random) -> str:
+    street = rng.choice(STREETS)
+    street_type = rng.choice(STREET_TYPES)[rng.random() < 0.3]
+    suburb, postcode = rng.choice(SUBURBS)
+
+    unit = ""
+    roll = rng.random()
+    if roll < 0.55:
+        unit = f"{rng.randint(1, 30)}{rng.randint(1, 12):02d}/"
+    elif roll < 0.75:
+        unit = f"{rng.randint(1, 9)}/"
+
+    state = rng.choice(["QLD", "QLD", "Queensland", ""])
+    address = f"{unit}{rng.randint(1, 250)} {street} {street_type}, {suburb} {state} {postcode}"
+    return " ".join(address.split())
+
+
+def synthetic_register(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Key Register de n_rows filas. Algunas propiedades tienen varias llaves
+    (M y de otro tipo) y algunos tags se repiten, como en la planilla real.
+    """
+    rng = random.Random(seed)
+    addresses, tags = [], []
+    while len(addresses) < n_rows:
+        address = synthetic_address(rng)
+        n_keys = rng.choice([1, 1, 1, 2, 2, 3])
+        for _ in range(min(n_keys, n_rows - len(addresses))):
+            prefix = rng.choice("MMMAK")
+            tags.append(f"{prefix}{rng.randint(1, max(n_rows // 2, 10))}")
+            addresses.append(address)
+
+    return pd.DataFrame({
+        "Property Address": addresses,
+        "Tag": tags,
+        "Observation": [""] * n_rows,
+    })
+
+
+def _noisy(address: str, rng: random.Random) -> str:
+    ops = [
+        lambda a: a,
+        lambda a: a,
+        lambda a: a.upper(),
+        lambda a: a.replace(",", ""),
+        lambda a: a.replace("Street", "St").replace("Road", "Rd"),
+        lambda a: a.replace(" QLD", "").replace(" Queensland", ""),
+        lambda a: a.split(",")[0],
+        lambda a: a.replace("l", "1", 1),
+        lambda a: a.split("/", 1)[-1],
+    ]
+    return rng.choice(ops)(address)
+
+
+def synthetic_pdf_records(df_keys: pd.DataFrame, n_records: int, seed: int = 0, unknown_rate: float = 0.1) -> list:
+    """
+    Registros como los que devuelve la lectura de páginas: direcciones del
+    register con ruido y una fracción de direcciones que no están.
+    """
+    rng = random.Random(seed)
+    addresses = df_keys["Property Address"].drop_duplicates().tolist()
+    records = []
+    for i in range(n_records):
+        if rng.random() < unknown_rate or not addresses:
+            address = synthetic_address(rng)
+        else:
+            address = _noisy(rng.choice(addresses), rng)
+        records.append({
+            "address": address,
+            "cleaner": rng.choice(CLEANERS),
+            "page": 1 + i // 12,
+            "address_confidence": round(rng.uniform(0.8, 1.0), 2),
+            "cleaner_confidence": round(rng.uniform(0.7, 1.0), 2),
+            "notes": "",
+        })
+    return records
+
+
+def synthetic_pdf(records: list) -> bytes:
+    """Daily Summary con capa de texto, una página por cada valor de "page"."""
+    import fitz
+
+    cols = {"Property": 36, "Task": 250, "Notes": 380, "Assigned To": 480}
+    doc = fitz.open()
+    by_page = {}
+    for r in records:
+        by_page.setdefault(r["page"], []).append(r)
+
+    for page_num in sorted(by_page):
+        page = doc.new_page(width=612, height=792)
+        page.insert_text((36, 30), "Housekeeping Daily Summary", fontsize=11)
+        for name, x in cols.items():
+            page.insert_text((x, 60), name, fontsize=9)
+
+        y = 85
+        for r in by_page[page_num]:
+            page.insert_text((cols["Property"], y), r["address"][:45], fontsize=8)
+            page.insert_text((cols["Task"], y), "Depart Clean", fontsize=8)
+            if r["cleaner"] != "Unassigned":
+                page.insert_text((cols["Assigned To"], y), r["cleaner"], fontsize=8)
+            y += 50
+
+        page.insert_text((500, 770), f"Page {page_num} of {len(by_page)}", fontsize=8)
+
+    data = doc.tobytes()
+    doc.close()
+    return data
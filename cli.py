@@ -0,0 +1,329 @@
+"""
+Reporte de llaves M sin Streamlit, para cron o para procesar un atraso de
+Daily Summaries de una vez.
+
+    python cli.py pdfs/ -o reportes/ --workers 4
+
+Cada PDF de la carpeta genera su propio <nombre>.xlsx. El Key Register se
+descarga una sola vez (o se lee de --register-csv) y los procesos del pool lo
+heredan ya indexado.
+
+Secrets: se leen de .streamlit/secrets.toml (mismo formato que la app) y la
+variable de entorno OPENAI_API_KEY tiene prioridad sobre el archivo.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import tomllib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pipeline import (
+    DEFAULT_PAGE_CONCURRENCY,
+    DEFAULT_PAGES_PER_REQUEST,
+    DEFAULT_RENDER_PROFILE,
+    MAX_PAGE_CONCURRENCY,
+    MAX_PAGES_PER_REQUEST,
+    OPENAI_BASE_URL,
+    OPENAI_RETRY_BUDGET_S,
+    OPENAI_RPM_LIMIT,
+    OPENAI_TPM_LIMIT,
+    RENDER_PROFILES,
+    KeyRegisterIndex,
+    create_report_excel,
+    export_debug_tables,
+    job_id_for,
+    load_key_register,
+    perf_totals,
+    read_key_register_csv,
+    OPENAI_TRANSPORT_MODES,
+    TRANSPORT_DIR,
+    set_openai_base_url,
+    set_openai_transport,
+    set_rate_limits,
+)
+
+logger = logging.getLogger("bedspoke.cli")
+
+DEFAULT_SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+
+def load_secrets(path: str) -> dict:
+    secrets = {}
+    if path and os.path.exists(path):
+        with open(path, "rb") as f:
+            secrets = tomllib.load(f)
+    if os.environ.get("OPENAI_API_KEY"):
+        secrets["OPENAI_API_KEY"] = os.environ["OPENAI_API_KEY"]
+    return secrets
+
+
+def load_register(args, secrets: dict) -> tuple:
+    if args.register_csv:
+        df_keys = read_key_register_csv(args.register_csv)
+        return df_keys, KeyRegisterIndex(df_keys)
+
+    if "gcp_service_account" not in secrets:
+        raise ValueError(
+            f"Falta 'gcp_service_account' en {args.secrets}; "
+            "usá --register-csv para trabajar con un Key Register exportado."
+        )
+    return load_key_register(dict(secrets["gcp_service_account"]))
+
+
+# ----------------------------------------------------------
+# WORKERS
+# ----------------------------------------------------------
+# Estado de cada proceso del pool. Con fork, el Key Register y su índice se
+# heredan del proceso padre sin volver a serializarlos.
+_worker = {}
+
+
+def _init_worker(key_register: tuple, api_key: str, options: dict, debug_export: str = None, rate_limits: tuple = None):
+    # El limitador vive en cada proceso: cada worker recibe su parte de la cuota
+    if rate_limits:
+        set_rate_limits(*rate_limits)
+    _worker["key_register"] = key_register
+    _worker["api_key"] = api_key
+    _worker["options"] = options
+    _worker["debug_export"] = debug_export
+
+
+def process_pdf(pdf_path: str, output_path: str) -> dict:
+    started = time.perf_counter()
+    result = {"pdf": pdf_path, "output": output_path}
+    # El Excel se escribe directo a disco; el rename evita dejar un .xlsx a medias
+    tmp_path = f"{output_path}.tmp"
+
+    try:
+        with open(pdf_path, "rb") as f:
+            pdf_bytes = f.read()
+
+        grouped, _, df_pdf, matched_df, review_df, stats = create_report_excel(
+            pdf_bytes,
+            None,
+            _worker["key_register"],
+            _worker["api_key"],
+            output_path=tmp_path,
+            **_worker["options"],
+        )
+        os.replace(tmp_path, output_path)
+
+        if _worker["debug_export"]:
+            export_debug_tables(df_pdf, matched_df, os.path.splitext(output_path)[0], _worker["debug_export"])
+
+        if stats.get("matching_profile"):
+            with open(os.path.splitext(output_path)[0] + ".matching_profile.txt", "w", encoding="utf-8") as f:
+                f.write(stats["matching_profile"])
+
+        result.update(
+            status="incompleto" if stats.get("failed_pages") else "ok",
+            pages=stats.get("pages", 0),
+            gpt_pages=stats.get("gpt_pages", 0),
+            gpt_requests=stats.get("gpt_requests", 0),
+            skipped_pages=stats.get("skipped_pages", 0),
+            fragment_pages=stats.get("fragment_pages", 0),
+            failed_pages=[p["page"] for p in stats.get("failed_pages", [])],
+            unparsed_pages=[p["page"] for p in stats.get("unparsed_pages", [])],
+            extracted=len(df_pdf),
+            matched=len(matched_df),
+            review=len(review_df),
+            **perf_totals(stats),
+        )
+    except Exception as e:
+        logger.exception("Error procesando %s", pdf_path)
+        result.update(status="error", error=str(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    result["seconds"] = round(time.perf_counter() - started, 2)
+    return result
+
+
+def _pool_context():
+    if "fork" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("fork")
+    return multiprocessing.get_context()
+
+
+# ----------------------------------------------------------
+# MAIN
+# ----------------------------------------------------------
+def collect_jobs(input_dir: str, output_dir: str, overwrite: bool) -> list:
+    """[(pdf_path, output_path)] sin PDFs repetidos (mismo contenido = mismo checkpoint)."""
+    jobs = []
+    seen = {}
+    for name in sorted(os.listdir(input_dir)):
+        if not name.lower().endswith(".pdf"):
+            continue
+        pdf_path = os.path.join(input_dir, name)
+        output_path = os.path.join(output_dir, os.path.splitext(name)[0] + ".xlsx")
+
+        if os.path.exists(output_path) and not overwrite:
+            logger.info("Salteo %s: ya existe %s", name, output_path)
+            continue
+
+        with open(pdf_path, "rb") as f:
+            job_id = job_id_for(f.read())
+        if job_id in seen:
+            logger.warning("Salteo %s: es el mismo PDF que %s", name, seen[job_id])
+            continue
+        seen[job_id] = name
+
+        jobs.append((pdf_path, output_path))
+    return jobs
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Genera el reporte de llaves M para cada PDF de una carpeta.",
+    )
+    parser.add_argument("input_dir", help="Carpeta con los PDFs (Housekeeping Daily Summary)")
+    parser.add_argument("-o", "--output-dir", default=None, help="Carpeta de salida (por defecto, la de entrada)")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=min(os.cpu_count() or 1, 4),
+        help="PDFs procesados en paralelo (uno por proceso)",
+    )
+    parser.add_argument(
+        "--page-concurrency", type=int, default=DEFAULT_PAGE_CONCURRENCY,
+        help=f"Páginas leídas en paralelo dentro de cada PDF (máx. {MAX_PAGE_CONCURRENCY}). "
+        "El total de llamadas simultáneas a OpenAI es workers × page-concurrency.",
+    )
+    parser.add_argument(
+        "--pages-per-request", type=int, default=DEFAULT_PAGES_PER_REQUEST,
+        help=f"Páginas consecutivas por request de visión (máx. {MAX_PAGES_PER_REQUEST})",
+    )
+    parser.add_argument(
+        "--batch-overlap", action="store_true",
+        help="Con --pages-per-request > 1, repetir la última página de cada request en la siguiente",
+    )
+    parser.add_argument("--render-profile", choices=list(RENDER_PROFILES), default=DEFAULT_RENDER_PROFILE)
+    parser.add_argument("--retry-budget", type=float, default=OPENAI_RETRY_BUDGET_S)
+    parser.add_argument("--no-cache", action="store_true", help="No reusar páginas ya leídas")
+    parser.add_argument("--no-text-layer", action="store_true", help="Leer todas las páginas con visión")
+    parser.add_argument(
+        "--no-prefilter", action="store_true",
+        help="Mandar a visión también las páginas vacías, de solo encabezado o de solo fragmento",
+    )
+    parser.add_argument("--resume", action="store_true", help="Reanudar desde el checkpoint de cada PDF")
+    parser.add_argument(
+        "--profile-matching", action="store_true",
+        help="Correr el matching bajo cProfile y guardar <nombre>.matching_profile.txt",
+    )
+    parser.add_argument(
+        "--no-debug-sheets", action="store_true",
+        help="No escribir Extraido_PDF ni Matched_Debug en el Excel",
+    )
+    parser.add_argument(
+        "--debug-export", choices=["csv", "parquet"], default=None,
+        help="Guardar Extraido_PDF y Matched_Debug como <nombre>.<hoja>.csv|parquet",
+    )
+    parser.add_argument(
+        "--no-aliases", action="store_true",
+        help="No usar ni aprender alias de direcciones ya confirmadas",
+    )
+    parser.add_argument("--overwrite", action="store_true", help="Regenerar aunque el .xlsx ya exista")
+    parser.add_argument("--secrets", default=DEFAULT_SECRETS_PATH, help="Archivo TOML con los secrets")
+    parser.add_argument("--register-csv", default=None, help="Key Register exportado a CSV en vez de Google Sheets")
+    parser.add_argument(
+        "--openai-base-url", default=OPENAI_BASE_URL,
+        help="API compatible con OpenAI (por ejemplo el stub de benchmarks/openai_stub.py)",
+    )
+    parser.add_argument(
+        "--transport", choices=OPENAI_TRANSPORT_MODES, default=os.environ.get("OPENAI_TRANSPORT", "live"),
+        help="live: API real · record: API real y guarda las respuestas · replay: solo respuestas guardadas, sin red",
+    )
+    parser.add_argument("--transport-dir", default=TRANSPORT_DIR, help="Dónde se guardan las respuestas grabadas")
+    parser.add_argument(
+        "--replay-latency", action="store_true",
+        help="En replay, esperar la latencia grabada y los backoffs (para pruebas de carga)",
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=OPENAI_RPM_LIMIT,
+        help=(
+            "Requests por minuto permitidas a OpenAI, repartidas entre los workers "
+            "(por defecto %(default)s, de OPENAI_RPM_LIMIT; 0 = sin límite)"
+        ),
+    )
+    parser.add_argument(
+        "--tpm", type=int, default=OPENAI_TPM_LIMIT,
+        help=(
+            "Tokens por minuto (estimados) permitidos a OpenAI, repartidos entre los workers "
+            "(por defecto %(default)s, de OPENAI_TPM_LIMIT; 0 = sin límite)"
+        ),
+    )
+    parser.add_argument("--log-level", default="INFO")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        format="%(asctime)s %(processName)s %(levelname)s %(message)s",
+    )
+
+    set_openai_base_url(args.openai_base_url)
+    set_openai_transport(args.transport, args.transport_dir, args.replay_latency)
+    output_dir = args.output_dir or args.input_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs = collect_jobs(args.input_dir, output_dir, args.overwrite)
+    if not jobs:
+        logger.info("No hay PDFs para procesar en %s", args.input_dir)
+        return 0
+
+    secrets = load_secrets(args.secrets)
+    logger.info("Cargando Key Register...")
+    key_register = load_register(args, secrets)
+    logger.info("Key Register: %s filas", len(key_register[1]))
+
+    options = {
+        "max_workers": args.page_concurrency,
+        "use_cache": not args.no_cache,
+        "use_text_layer": not args.no_text_layer,
+        "render_profile": args.render_profile,
+        "retry_budget": args.retry_budget,
+        "resume": args.resume,
+        "profile_matching": args.profile_matching,
+        "include_debug": not args.no_debug_sheets,
+        "use_aliases": not args.no_aliases,
+        "use_prefilter": not args.no_prefilter,
+        "pages_per_request": args.pages_per_request,
+        "batch_overlap": args.batch_overlap,
+    }
+
+    workers = max(1, min(args.workers, len(jobs)))
+    rate_limits = (args.rpm / workers, args.tpm / workers)
+    results = []
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=_pool_context(),
+        initializer=_init_worker,
+        initargs=(key_register, secrets.get("OPENAI_API_KEY", ""), options, args.debug_export, rate_limits),
+    ) as pool:
+        futures = [pool.submit(process_pdf, pdf_path, output_path) for pdf_path, output_path in jobs]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if result["status"] == "error":
+                logger.error("%s: error (%s)", result["pdf"], result["error"])
+            else:
+                logger.info(
+                    "%s → %s: %s, %s páginas (%s con IA en %s requests, %s salteadas, %s solo fragmento), "
+                    "%s matches, %s a revisar, %.1fs, %s tokens de entrada / %s de salida",
+                    result["pdf"], result["output"], result["status"], result["pages"],
+                    result["gpt_pages"], result["gpt_requests"], result["skipped_pages"], result["fragment_pages"],
+                    result["matched"], result["review"], result["seconds"],
+                    result["prompt_tokens"], result["completion_tokens"],
+                )
+
+    errors = [r for r in results if r["status"] != "ok"]
+    logger.info("Listo: %s PDFs, %s con errores o páginas fallidas", len(results), len(errors))
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
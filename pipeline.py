@@ -0,0 +1,3732 @@
+"""
+Pipeline del reporte de llaves M sin Streamlit: PDF → registros → matching
+contra el Key Register → Excel. Lo usan la app (app.py) y la CLI (cli.py);
+los secrets se pasan como argumentos.
+"""
+import base64
+import copy
+import difflib
+import functools
+import hashlib
+import importlib.util
+import json
+import logging
+import math
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import cProfile
+import pstats
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from email.utils import parsedate_to_datetime
+from io import BytesIO, StringIO
+
+import gspread
+import numpy as np
+import pandas as pd
+import requests
+from google.oauth2.service_account import Credentials
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("bedspoke")
+
+# ----------------------------------------------------------
+# MÉTRICAS POR ETAPA
+# ----------------------------------------------------------
+# stats["perf"][etapa] = {"seconds", "calls", "prompt_tokens", "completion_tokens"}.
+# gpt_page y parse suman el tiempo de cada página aunque corran en paralelo,
+# así que pueden superar el total de la corrida.
+PERF_STAGES = [
+    "register", "prefilter", "text_layer", "render", "gpt_page", "parse",
+    "merge", "matching", "tiebreak", "excel",
+]
+
+
+def record_perf(stats: dict, stage: str, seconds: float, calls: int = 1, usage: dict = None):
+    if stats is None:
+        return
+    entry = stats.setdefault("perf", {}).setdefault(
+        stage, {"seconds": 0.0, "calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    )
+    entry["seconds"] += seconds
+    entry["calls"] += calls
+    if usage:
+        entry["prompt_tokens"] += int(usage.get("prompt_tokens", 0) or 0)
+        entry["completion_tokens"] += int(usage.get("completion_tokens", 0) or 0)
+
+
+@contextmanager
+def perf_stage(stats: dict, stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_perf(stats, stage, time.perf_counter() - started)
+
+
+def perf_totals(stats: dict) -> dict:
+    perf = stats.get("perf", {})
+    return {
+        "seconds": stats.get("total_s", 0.0) + perf.get("register", {}).get("seconds", 0.0),
+        "prompt_tokens": sum(e["prompt_tokens"] for e in perf.values()),
+        "completion_tokens": sum(e["completion_tokens"] for e in perf.values()),
+        "openai_calls": sum(perf.get(stage, {}).get("calls", 0) for stage in ("gpt_page", "tiebreak")),
+    }
+
+
+def perf_table(stats: dict) -> pd.DataFrame:
+    perf = stats.get("perf", {})
+    order = {stage: i for i, stage in enumerate(PERF_STAGES)}
+    rows = [
+        {
+            "Etapa": stage,
+            "Segundos": round(entry["seconds"], 3),
+            "Llamadas": entry["calls"],
+            "Prompt tokens": entry["prompt_tokens"],
+            "Completion tokens": entry["completion_tokens"],
+        }
+        for stage, entry in sorted(perf.items(), key=lambda item: (order.get(item[0], len(order)), item[0]))
+    ]
+    totals = perf_totals(stats)
+    rows.append({
+        "Etapa": "total",
+        "Segundos": round(totals["seconds"], 3),
+        "Llamadas": totals["openai_calls"],
+        "Prompt tokens": totals["prompt_tokens"],
+        "Completion tokens": totals["completion_tokens"],
+    })
+    return pd.DataFrame(rows)
+
+
+def _profile_report(profiler: cProfile.Profile, limit: int = 40) -> str:
+    out = StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(limit)
+    return out.getvalue()
+
+
+# ----------------------------------------------------------
+# GOOGLE SHEETS
+# ----------------------------------------------------------
+def authorize_gspread(service_account: dict):
+    credentials = Credentials.from_service_account_info(
+        service_account,
+        scopes=[
+            "https://www.googleapis.com/auth/spreadsheets",
+            "https://www.googleapis.com/auth/drive",
+        ],
+    )
+    return gspread.authorize(credentials)
+
+
+def open_key_register_spreadsheet(service_account: dict):
+    """`service_account` es la sección gcp_service_account de los secrets (incluye spreadsheet_id)."""
+    client = authorize_gspread(service_account)
+    return client.open_by_key(service_account["spreadsheet_id"])
+
+
+def _clean_key_register(df_keys: pd.DataFrame) -> pd.DataFrame:
+    for col in ["Property Address", "Tag"]:
+        if col not in df_keys.columns:
+            raise ValueError(f"No encontré la columna '{col}' en 'Key Register'.")
+
+    if "Observation" in df_keys.columns:
+        df_keys = df_keys[df_keys["Observation"].fillna("").str.strip() == ""]
+
+    df_keys["Property Address"] = df_keys["Property Address"].fillna("").astype(str).str.strip()
+    df_keys["Tag"] = df_keys["Tag"].fillna("").astype(str).str.strip()
+
+    return df_keys.reset_index(drop=True)
+
+
+def _parse_key_register(data: list) -> pd.DataFrame:
+    if len(data) < 2:
+        raise ValueError("La hoja 'Key Register' no tiene suficiente información.")
+
+    df_keys = pd.DataFrame(data[2:], columns=data[1]).drop(columns="", errors="ignore")
+    return _clean_key_register(df_keys)
+
+
+def read_key_register(spreadsheet) -> pd.DataFrame:
+    return _parse_key_register(spreadsheet.worksheet("Key Register").get_all_values())
+
+
+def read_key_register_csv(path: str) -> pd.DataFrame:
+    """Key Register exportado a CSV (encabezados en la primera fila)."""
+    df_keys = pd.read_csv(path, dtype=str, keep_default_na=False)
+    return _clean_key_register(df_keys.drop(columns=[c for c in df_keys.columns if c.startswith("Unnamed:")]))
+
+
+def load_key_register(service_account: dict, directory: str = None):
+    """
+    Devuelve (df_keys, key_index) partiendo del snapshot local: si la
+    planilla no cambió no se descarga, y si cambió solo se reparsean las
+    filas distintas.
+    """
+    spreadsheet = open_key_register_spreadsheet(service_account)
+    return KeyRegisterSync(spreadsheet, directory or REGISTER_SNAPSHOT_DIR).sync()
+
+
+# ----------------------------------------------------------
+# NORMALIZACIÓN DE DIRECCIONES
+# ----------------------------------------------------------
+# Direcciones parseadas que se guardan en memoria. Alcanza para un Key
+# Register grande más todas las variantes que trae un PDF.
+NORMALIZE_CACHE_SIZE = 200_000
+
+# Reemplazos de normalize_address, en orden. Los de la primera tanda no se
+# pisan entre sí (todos empiezan con espacio y no tienen espacios internos),
+# así que van en una sola pasada de regex. " saint " sí puede compartir el
+# espacio con " street" (" saint street" → " st st"), por eso esa y la de
+# " queensland" se aplican después, una por una, como siempre.
+_ADDRESS_REPLACEMENTS = {
+    " street": " st",
+    " road": " rd",
+    " terrace": " tce",
+    " avenue": " ave",
+    " boulevard": " bvd",
+    " drive": " dr",
+    " place": " pl",
+    " court": " ct",
+    " lane": " ln",
+    " quay": " qy",
+}
+_ADDRESS_REPLACEMENTS_AFTER = [
+    (" saint ", " st "),
+    (" queensland", " qld"),
+]
+
+_STATE_WORDS = frozenset({"qld", "nsw", "vic", "act", "wa", "sa", "tas", "nt"})
+_TYPE_WORDS = frozenset({"st", "rd", "tce", "ave", "bvd", "dr", "pl", "ct", "ln", "qy"})
+
+
+class AddressNormalizer:
+    """
+    Normalización y parseo de direcciones con los patrones compilados una
+    vez y un LRU de resultados: la misma dirección aparece miles de veces
+    por corrida (register, candidatos, llaves M). Los *_many trabajan sobre
+    una Serie completa y dan lo mismo que llamar de a una.
+    Los dicts que devuelve parse() salen del caché: no hay que modificarlos.
+    """
+
+    _replace_re = re.compile("|".join(re.escape(k) for k in _ADDRESS_REPLACEMENTS))
+    _junk_re = re.compile(r"[^a-z0-9\s/]")
+    _space_re = re.compile(r"\s+")
+    _unit_re = re.compile(r"^([a-z]?\d+[a-z]?/\d+[a-z]?)\b")
+    _number_re = re.compile(r"\b(\d+)\b")
+    _postcode_re = re.compile(r"\b([2-9]\d{3})\b")
+    _street_type_re = re.compile(r"\b(st|rd|tce|ave|bvd|dr|pl|ct|ln|qy)\b")
+    _digit_re = re.compile(r"\d")
+    _simple_junk_re = re.compile(r"[^0-9A-Za-z\s]")
+
+    def __init__(self, cache_size: int = NORMALIZE_CACHE_SIZE):
+        self._normalize_cached = functools.lru_cache(maxsize=cache_size)(self._normalize)
+        self._parse_cached = functools.lru_cache(maxsize=cache_size)(self._parse)
+        self._simplify_cached = functools.lru_cache(maxsize=cache_size)(self._simplify)
+
+    def cache_clear(self):
+        self._normalize_cached.cache_clear()
+        self._parse_cached.cache_clear()
+        self._simplify_cached.cache_clear()
+
+    # -- de a una ------------------------------------------------------
+    def normalize(self, addr: str) -> str:
+        return self._normalize_cached(addr) if isinstance(addr, str) else ""
+
+    def parse(self, addr: str) -> dict:
+        return self._parse_cached(addr if isinstance(addr, str) else "")
+
+    def simplify(self, address: str) -> str:
+        return self._simplify_cached(address) if isinstance(address, str) else ""
+
+    def _normalize(self, addr: str) -> str:
+        addr = addr.lower().strip()
+        addr = self._replace_re.sub(lambda m: _ADDRESS_REPLACEMENTS[m.group(0)], addr)
+        for old, new in _ADDRESS_REPLACEMENTS_AFTER:
+            addr = addr.replace(old, new)
+        addr = self._junk_re.sub(" ", addr)
+        return self._space_re.sub(" ", addr).strip()
+
+    def _parse(self, addr: str) -> dict:
+        return self._parts_from_normalized(self.normalize(addr))
+
+    def _parts_from_normalized(self, a: str) -> dict:
+        unit_match = self._unit_re.match(a)
+        num_match = self._number_re.search(a)
+        pc_match = self._postcode_re.search(a)
+        stype_match = self._street_type_re.search(a)
+
+        text_tokens = [
+            t for t in a.split()
+            if not self._digit_re.search(t) and t not in _STATE_WORDS and t not in _TYPE_WORDS
+        ]
+
+        return {
+            "normalized": a,
+            "unit": unit_match.group(1) if unit_match else "",
+            "street_number": num_match.group(1) if num_match else "",
+            "postcode": pc_match.group(1) if pc_match else "",
+            "street_type": stype_match.group(1) if stype_match else "",
+            "suburb": " ".join(text_tokens[-2:]),
+            "tokens": set(text_tokens),
+        }
+
+    def _simplify(self, address: str) -> str:
+        address = address.strip()
+        m = self._digit_re.search(address)
+        substr = address[m.start():m.start() + 15] if m else address[:15]
+        return self._simple_junk_re.sub("", substr).lower().strip()
+
+    # -- en lote -------------------------------------------------------
+    @staticmethod
+    def _as_text(values) -> pd.Series:
+        s = pd.Series(values, dtype=object)
+        return s.where(s.map(lambda v: isinstance(v, str)), "")
+
+    def normalize_many(self, values) -> pd.Series:
+        s = self._as_text(values)
+        codes, uniques = pd.factorize(s)
+        out = pd.Series(uniques, dtype=object).str.lower().str.strip()
+        out = out.str.replace(self._replace_re, lambda m: _ADDRESS_REPLACEMENTS[m.group(0)], regex=True)
+        for old, new in _ADDRESS_REPLACEMENTS_AFTER:
+            out = out.str.replace(old, new, regex=False)
+        out = out.str.replace(self._junk_re, " ", regex=True)
+        out = out.str.replace(self._space_re, " ", regex=True).str.strip()
+        return pd.Series(out.to_numpy()[codes], index=s.index, dtype=object)
+
+    def parse_many(self, values) -> pd.DataFrame:
+        """
+        Una fila por dirección con las mismas claves que parse(): normalized,
+        unit, street_number, postcode, street_type, suburb y tokens (set).
+        """
+        s = self._as_text(values)
+        codes, uniques = pd.factorize(s)
+        norm = self.normalize_many(uniques)
+
+        parts = pd.DataFrame({"normalized": norm})
+        parts["unit"] = norm.str.extract(self._unit_re, expand=False)
+        parts["street_number"] = norm.str.extract(self._number_re, expand=False)
+        parts["postcode"] = norm.str.extract(self._postcode_re, expand=False)
+        parts["street_type"] = norm.str.extract(self._street_type_re, expand=False)
+        parts = parts.fillna("")
+
+        text_tokens = [
+            [t for t in a.split() if not self._digit_re.search(t) and t not in _STATE_WORDS and t not in _TYPE_WORDS]
+            for a in norm
+        ]
+        parts["suburb"] = [" ".join(tokens[-2:]) for tokens in text_tokens]
+        parts["tokens"] = [set(tokens) for tokens in text_tokens]
+
+        out = parts.iloc[codes].reset_index(drop=True)
+        out.index = s.index
+        return out
+
+    def simplify_many(self, values) -> pd.Series:
+        s = self._as_text(values).str.strip()
+        from_digit = s.str.extract(r"(\d[\s\S]{0,14})", expand=False)
+        substr = from_digit.where(from_digit.notna(), s.str.slice(0, 15))
+        return substr.str.replace(self._simple_junk_re, "", regex=True).str.lower().str.strip()
+
+
+NORMALIZER = AddressNormalizer()
+
+
+def simplify_address_15chars(address: str) -> str:
+    return NORMALIZER.simplify(address)
+
+
+def normalize_address(addr: str) -> str:
+    return NORMALIZER.normalize(addr)
+
+
+def extract_address_parts(addr: str) -> dict:
+    return NORMALIZER.parse(addr)
+
+
+# Puntos por cada parte que coincide (solo si la parte existe en la dirección PDF)
+_SCORE_WEIGHTS = (
+    ("unit", 35),
+    ("street_number", 20),
+    ("street_type", 10),
+    ("postcode", 10),
+    ("suburb", 10),
+)
+
+
+def _score_parts(p: dict, k: dict, p_simple: str, k_simple: str, fuzzy: bool = False) -> float:
+    score = 0.0
+
+    for field, points in _SCORE_WEIGHTS:
+        if p[field] and p[field] == k[field]:
+            score += points
+
+    if fuzzy:
+        token_overlap = fuzzy_token_overlap(p["tokens"], k["tokens"], p["normalized"], k["normalized"])
+    else:
+        token_overlap = len(p["tokens"] & k["tokens"])
+    score += min(token_overlap * 5, 20)
+
+    if p_simple == k_simple:
+        score += 10
+
+    return round(score, 2)
+
+
+def score_address_match(pdf_addr: str, key_addr: str, fuzzy: bool = False) -> float:
+    """
+    Score de una dirección PDF contra una del register. Con fuzzy=True se
+    aplican las mismas reglas que KeyRegisterIndex.top_k: dígitos mal leídos
+    corregidos y crédito por palabras casi iguales.
+    """
+    if fuzzy:
+        pdf_addr = fix_ocr_digits(pdf_addr)
+    return _score_parts(
+        extract_address_parts(pdf_addr),
+        extract_address_parts(key_addr),
+        simplify_address_15chars(pdf_addr),
+        simplify_address_15chars(key_addr),
+        fuzzy,
+    )
+
+
+# ----------------------------------------------------------
+# COINCIDENCIA APROXIMADA (ERRORES DE LECTURA)
+# ----------------------------------------------------------
+# Confusiones típicas de la lectura visual dentro de palabras ("Hercu1es")
+_OCR_DIGITS = str.maketrans({"0": "o", "1": "l", "5": "s", "8": "b"})
+FUZZY_TOKEN_MIN_LEN = 5
+FUZZY_TOKEN_RATIO = 0.8
+
+
+def _trigrams(text: str) -> set:
+    text = f" {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+_MIXED_WORD_RE = re.compile(r"\b(?=[a-z0-9]*\d)(?=(?:[0-9]*[a-z]){3})[a-z0-9]+\b", re.IGNORECASE)
+# "Unit5", "Lot10", "Level2": prefijo pegado al número, no una palabra mal leída
+_UNIT_PREFIX_RE = re.compile(r"(?:unit|lot|level|lvl|shop|suite|apt)\d", re.IGNORECASE)
+
+
+# Solo dígitos entre letras: los del principio o el final de una palabra
+# ("105Doggett", "15Hercules" después de la barra, "Bldg5") son números
+_OCR_DIGIT_RUN_RE = re.compile(r"(?<=[a-z])[0158]+(?=[a-z])", re.IGNORECASE)
+
+
+def _fix_ocr_word(m) -> str:
+    word = m.group(0)
+    if _UNIT_PREFIX_RE.match(word):
+        return word
+    return _OCR_DIGIT_RUN_RE.sub(lambda d: d.group(0).translate(_OCR_DIGITS), word)
+
+
+def fix_ocr_digits(address: str) -> str:
+    """Dígitos mal leídos dentro de una palabra ("Hercu1es" → "Hercules", "Me1bourne" → "Melbourne")."""
+    return _MIXED_WORD_RE.sub(_fix_ocr_word, address)
+
+
+@functools.lru_cache(maxsize=100_000)
+def _similar_tokens(a: str, b: str) -> bool:
+    if len(a) < FUZZY_TOKEN_MIN_LEN or len(b) < FUZZY_TOKEN_MIN_LEN or abs(len(a) - len(b)) > 2:
+        return False
+    return difflib.SequenceMatcher(None, a, b).ratio() >= FUZZY_TOKEN_RATIO
+
+
+@functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def street_name_tokens(normalized: str) -> frozenset:
+    """
+    Palabras del nombre de la calle (antes del tipo de calle) de una
+    dirección normalizada. Sin tipo de calle, todas menos las del suburb.
+    """
+    stype = AddressNormalizer._street_type_re.search(normalized)
+    words = normalized[:stype.start()].split() if stype else normalized.split()
+    tokens = [w for w in words if not AddressNormalizer._digit_re.search(w) and w not in _STATE_WORDS]
+    return frozenset(tokens if stype else tokens[:-2])
+
+
+def fuzzy_token_overlap(p_tokens: set, k_tokens: set, p_normalized: str, k_normalized: str) -> int:
+    """
+    Como len(p_tokens & k_tokens), pero también cuenta palabras casi iguales
+    ("doget" / "doggett"). Solo las del nombre de la calle: suburbs parecidos
+    ("hamilton" / "milton") son otro lugar. Cada palabra del register se usa
+    una sola vez.
+    """
+    matched = p_tokens & k_tokens
+    overlap = len(matched)
+    if overlap >= 4:
+        return overlap
+    free = (k_tokens - matched) & street_name_tokens(k_normalized)
+    if not free:
+        return overlap
+    for token in (p_tokens - matched) & street_name_tokens(p_normalized):
+        hit = next((k for k in free if _similar_tokens(token, k)), None)
+        if hit is not None:
+            free.discard(hit)
+            overlap += 1
+    return overlap
+
+
+# ----------------------------------------------------------
+# ÍNDICE DEL KEY REGISTER
+# ----------------------------------------------------------
+def _encode_column(values: list) -> tuple:
+    """Devuelve ({valor: código}, array de códigos) para comparar columnas enteras."""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object), sort=False)
+    return {value: code for code, value in enumerate(uniques)}, codes.astype(np.int32)
+
+
+def register_row_hashes(df_keys: pd.DataFrame) -> np.ndarray:
+    """Hash por fila (todas las columnas), para saber qué filas cambiaron entre descargas."""
+    return pd.util.hash_pandas_object(df_keys.astype(str), index=False).to_numpy()
+
+
+def _postings(keys: np.ndarray) -> dict:
+    """{clave: array de posiciones} para un array de códigos enteros."""
+    order = np.argsort(keys, kind="stable").astype(np.int32)
+    uniques, starts = np.unique(keys[order], return_index=True)
+    return {int(key): rows for key, rows in zip(uniques, np.split(order, starts[1:]))}
+
+
+def _patch_postings(postings: dict, drop: dict, add: dict) -> dict:
+    """Copia de `postings` sin las posiciones de `drop` y con las de `add` ({clave: [pos]})."""
+    postings = dict(postings)
+    for key, rows in drop.items():
+        remaining = np.setdiff1d(postings[key], rows).astype(np.int32)
+        if len(remaining):
+            postings[key] = remaining
+        else:
+            del postings[key]
+    for key, rows in add.items():
+        rows = np.array(rows, dtype=np.int32)
+        postings[key] = np.sort(np.concatenate([postings[key], rows])) if key in postings else np.sort(rows)
+    return postings
+
+
+def _contains(sorted_rows: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Máscara de qué `positions` están en `sorted_rows` (una lista invertida ordenada)."""
+    idx = np.searchsorted(sorted_rows, positions)
+    return sorted_rows[np.minimum(idx, len(sorted_rows) - 1)] == positions
+
+
+def _gram_idf(n_docs: int, df) -> np.ndarray:
+    return np.log((1 + n_docs) / (1 + np.asarray(df, dtype=np.float64))) + 1
+
+
+def _m_tag(row: dict) -> str:
+    tag = row.get("Tag", "")
+    tag = "" if pd.isna(tag) else str(tag).strip()
+    return tag if tag.upper().startswith("M") else ""
+
+
+class KeyRegisterIndex:
+    """
+    Partes de cada dirección del Key Register parseadas una sola vez y
+    guardadas como columnas: cada parte es un array de códigos enteros y los
+    tokens van como listas invertidas (token → filas), una codificación rala.
+    Puntuar una dirección PDF contra todo el register son unas pocas
+    comparaciones de arrays, con los mismos scores que score_address_match.
+
+    Para registers grandes, top_k() no recorre todas las filas: un índice de
+    trigramas de caracteres (TF-IDF, similitud coseno) sobre las direcciones
+    normalizadas distintas, más las filas con la misma unidad o número de
+    calle, traen los candidatos, que se puntúan con las mismas reglas de
+    score_address_match más crédito por palabras mal leídas.
+
+    `parts` y `simple` permiten construirlo desde un snapshot sin volver a
+    parsear; update() aplica una nueva versión del register parseando solo
+    las filas que cambiaron.
+    """
+
+    # Con más filas cambiadas que esto se rearma todo (reusando lo parseado)
+    PATCH_MAX_CHANGED = 0.2
+    # Direcciones distintas que trae el índice de trigramas por consulta
+    RETRIEVAL_K = 20
+    # Hasta este tamaño top_k() puntúa todas las filas en vez de usar el
+    # índice de trigramas (exacto y más barato que armar candidatos)
+    RETRIEVAL_MIN_ROWS = 20_000
+    # Trigramas presentes en más de esta fracción de direcciones no suman
+    # candidatos (" st", "qld"): aportan poco y son las listas más largas.
+    # Lo mismo para unidades o números de calle demasiado comunes.
+    RETRIEVAL_MAX_DF = 0.05
+    # Partes exactas cuyas filas entran siempre como candidatas
+    RETRIEVAL_FIELDS = ("unit", "street_number")
+
+    def __init__(self, df_keys: pd.DataFrame, parts: pd.DataFrame = None, simple: list = None):
+        self.df_keys = df_keys
+        self.addresses = df_keys["Property Address"].astype(str).tolist()
+        self.rows = df_keys.to_dict("records")
+        self.row_hashes = register_row_hashes(df_keys)
+        self.parts = parts if parts is not None else NORMALIZER.parse_many(self.addresses)
+        self.simple = simple if simple is not None else NORMALIZER.simplify_many(self.addresses).tolist()
+        self._build()
+
+    def _build(self):
+        self.vocab = {}
+        self.codes = {}
+        for field, _ in _SCORE_WEIGHTS:
+            self.vocab[field], self.codes[field] = _encode_column(self.parts[field].tolist())
+        self.vocab["simple"], self.codes["simple"] = _encode_column(self.simple)
+        self.vocab["normalized"], self.codes["normalized"] = _encode_column(self.parts["normalized"].tolist())
+        self.norm_rows = _postings(self.codes["normalized"])
+        self.field_rows = {field: _postings(self.codes[field]) for field in self.RETRIEVAL_FIELDS}
+        self._build_grams()
+
+        by_token = defaultdict(list)
+
+        # Tags M por forma normalizada y por forma de 15 caracteres
+        self.m_tags_by_norm = defaultdict(set)
+        self.m_tags_by_simple = defaultdict(set)
+
+        for pos, (tokens, k_norm, k_simple) in enumerate(
+            zip(self.parts["tokens"], self.parts["normalized"], self.simple)
+        ):
+            for token in tokens:
+                by_token[token].append(pos)
+
+            tag = _m_tag(self.rows[pos])
+            if tag:
+                self.m_tags_by_norm[k_norm].add(tag)
+                self.m_tags_by_simple[k_simple].add(tag)
+
+        self.token_rows = {token: np.array(rows, dtype=np.int32) for token, rows in by_token.items()}
+
+    def _build_grams(self):
+        """Listas invertidas trigrama → códigos de dirección normalizada, y la norma de cada una."""
+        texts = [f" {text} " for text in self.vocab["normalized"]]
+        lengths = np.array([max(len(text) - 2, 0) for text in texts], dtype=np.int64)
+        grams = [text[i:i + 3] for text in texts for i in range(len(text) - 2)]
+        docs = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+        gram_ids, uniques = pd.factorize(pd.Series(grams, dtype=object))
+        # Un par (trigrama, dirección) por repetición dentro de la misma dirección
+        pairs = np.unique(gram_ids.astype(np.int64) * max(len(texts), 1) + docs)
+        gram_ids, docs = np.divmod(pairs, max(len(texts), 1))
+        starts = np.flatnonzero(np.diff(gram_ids, prepend=-1))
+        self.gram_codes = {
+            uniques[gram_ids[start]]: codes.astype(np.int32)
+            for start, codes in zip(starts, np.split(docs, starts[1:]))
+        }
+        self.gram_norm = self._gram_norms(self.gram_codes, len(texts))
+
+    @staticmethod
+    def _gram_norms(gram_codes: dict, n_docs: int) -> np.ndarray:
+        if not gram_codes:
+            return np.ones(n_docs)
+        lengths = np.array([len(codes) for codes in gram_codes.values()])
+        weights = np.repeat(_gram_idf(n_docs, lengths) ** 2, lengths)
+        norms = np.bincount(np.concatenate(list(gram_codes.values())), weights=weights, minlength=n_docs)
+        return np.sqrt(np.maximum(norms, 1e-12))
+
+    def candidates(self, normalized: str, k: int = None) -> np.ndarray:
+        """
+        Códigos de las k direcciones normalizadas más parecidas por coseno
+        de trigramas TF-IDF. Solo se tocan las listas de los trigramas de la
+        consulta; el costo no crece con el largo del register.
+        """
+        k = k or self.RETRIEVAL_K
+        n_docs = len(self.gram_norm)
+        grams = [(gram, self.gram_codes.get(gram)) for gram in _trigrams(normalized)]
+        found = [(gram, codes) for gram, codes in grams if codes is not None]
+        if not found:
+            return np.array([], dtype=np.int32)
+
+        idf = _gram_idf(n_docs, [len(codes) for _, codes in found])
+        query_norm = math.sqrt(float((idf ** 2).sum()))
+        max_df = max(self.RETRIEVAL_MAX_DF * n_docs, 1)
+        selected = [(codes, w) for (_, codes), w in zip(found, idf ** 2) if len(codes) <= max_df]
+        if not selected:
+            selected = [min(zip((c for _, c in found), idf ** 2), key=lambda item: len(item[0]))]
+
+        # Cada lista tiene códigos distintos: sumar por lista no pisa valores
+        acc = np.zeros(n_docs)
+        for codes, w in selected:
+            acc[codes] += w
+        docs = np.flatnonzero(acc > 0)
+        sims = acc[docs] / (self.gram_norm[docs] * query_norm)
+        if len(docs) > k:
+            best = np.argpartition(-sims, k - 1)[:k]
+            docs, sims = docs[best], sims[best]
+        return docs[np.argsort(-sims, kind="stable")]
+
+    def candidate_rows(self, p: dict, k: int = None) -> np.ndarray:
+        """
+        Filas de las direcciones que devuelve candidates() más las que
+        comparten unidad o número de calle (si no son demasiado comunes).
+        """
+        rows = [self.norm_rows[code] for code in self.candidates(p["normalized"], k) if code in self.norm_rows]
+        max_rows = max(self.RETRIEVAL_MAX_DF * len(self), 1)
+        for field in self.RETRIEVAL_FIELDS:
+            code = self.vocab[field].get(p[field]) if p[field] else None
+            field_rows = self.field_rows[field].get(code)
+            if field_rows is not None and len(field_rows) <= max_rows:
+                rows.append(field_rows)
+        return np.unique(np.concatenate(rows)) if rows else np.array([], dtype=np.int32)
+
+    def score_rows(self, p: dict, p_simple: str, positions: np.ndarray, fuzzy: bool = True) -> np.ndarray:
+        """
+        Score de score_address_match para algunas filas; con fuzzy=True las
+        palabras casi iguales también cuentan (fuzzy_token_overlap).
+        """
+        scores = np.zeros(len(positions), dtype=np.int16)
+        for field, points in _SCORE_WEIGHTS:
+            code = self.vocab[field].get(p[field]) if p[field] else None
+            if code is not None:
+                scores[self.codes[field][positions] == code] += points
+
+        code = self.vocab["simple"].get(p_simple)
+        if code is not None:
+            scores[self.codes["simple"][positions] == code] += 10
+
+        if fuzzy:
+            tokens = self.parts["tokens"].to_numpy()
+            normalized = self.parts["normalized"].to_numpy()
+            overlap = np.array([
+                fuzzy_token_overlap(p["tokens"], tokens[pos], p["normalized"], normalized[pos])
+                for pos in positions
+            ], dtype=np.int16)
+        else:
+            overlap = np.zeros(len(positions), dtype=np.int16)
+            for token in p["tokens"]:
+                rows = self.token_rows.get(token)
+                if rows is not None:
+                    overlap += _contains(rows, positions)
+        scores += np.minimum(overlap * 5, 20).astype(np.int16)
+        return scores
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def rows_for_address(self, address: str) -> np.ndarray:
+        """Filas cuya Property Address es `address` (o, si no hay exacta, la misma normalizada)."""
+        code = self.vocab["normalized"].get(normalize_address(address))
+        rows = self.norm_rows.get(code, np.array([], dtype=np.int32))
+        exact = rows[[self.addresses[pos] == address for pos in rows]] if len(rows) else rows
+        return exact if len(exact) else rows
+
+    def update(self, df_keys: pd.DataFrame) -> dict:
+        """
+        Pasa el índice a `df_keys` comparando hashes por fila. Si cambiaron
+        pocas filas (ediciones, filas agregadas o borradas al final) se
+        parchean solo esas posiciones; si no, se rearma reusando las partes
+        ya parseadas de las direcciones conocidas. Nunca modifica arrays,
+        listas ni sets existentes, solo reasigna atributos: sobre un
+        copy.copy() del índice, el original sigue sirviendo a quien lo use.
+        Devuelve {"mode", "changed", "added", "removed", "parsed"}.
+        """
+        hashes = register_row_hashes(df_keys)
+        n_old, n_new = len(self), len(df_keys)
+        common = min(n_old, n_new)
+        changed = np.flatnonzero(self.row_hashes[:common] != hashes[:common])
+        diff = {
+            "mode": "none",
+            "changed": len(changed),
+            "added": max(n_new - n_old, 0),
+            "removed": max(n_old - n_new, 0),
+            "parsed": 0,
+        }
+        n_diff = diff["changed"] + diff["added"] + diff["removed"]
+        if n_diff == 0:
+            self.df_keys = df_keys
+            return diff
+
+        if n_diff > self.PATCH_MAX_CHANGED * max(n_new, 1):
+            diff["mode"] = "rebuild"
+            diff["parsed"] = self._rebuild(df_keys, hashes)
+        else:
+            diff["mode"] = "patch"
+            diff["parsed"] = self._patch(df_keys, hashes, changed, common)
+        return diff
+
+    def _rebuild(self, df_keys: pd.DataFrame, hashes: np.ndarray) -> int:
+        addresses = df_keys["Property Address"].astype(str).tolist()
+        known = {}
+        for pos, address in enumerate(self.addresses):
+            known.setdefault(address, pos)
+        old_pos = np.array([known.get(a, -1) for a in addresses], dtype=np.int64)
+        new = np.flatnonzero(old_pos < 0)
+
+        parts = self.parts.iloc[np.maximum(old_pos, 0)].reset_index(drop=True)
+        simple = [self.simple[pos] if pos >= 0 else "" for pos in old_pos]
+        if len(new):
+            fresh = NORMALIZER.parse_many([addresses[i] for i in new])
+            fresh.index = new
+            parts.loc[new, fresh.columns] = fresh
+            for i, value in zip(new, NORMALIZER.simplify_many([addresses[i] for i in new])):
+                simple[i] = value
+
+        self.df_keys = df_keys
+        self.addresses = addresses
+        self.rows = df_keys.to_dict("records")
+        self.row_hashes = hashes
+        self.parts = parts
+        self.simple = simple
+        self._build()
+        return len(new)
+
+    def _patch(self, df_keys: pd.DataFrame, hashes: np.ndarray, changed: np.ndarray, common: int) -> int:
+        n_old, n_new = len(self), len(df_keys)
+        positions = np.concatenate([changed, np.arange(common, n_new)]).astype(np.int64)
+        stale = np.concatenate([changed, np.arange(common, n_old)]).astype(np.int64)
+
+        new_rows = df_keys.iloc[positions].to_dict("records")
+        new_addresses = [str(row["Property Address"]) for row in new_rows]
+        new_parts = NORMALIZER.parse_many(new_addresses)
+        new_simple = NORMALIZER.simplify_many(new_addresses).tolist()
+
+        # Claves de tags M afectadas, antes y después del cambio
+        touched_norm = {self.parts["normalized"].iat[pos] for pos in stale} | set(new_parts["normalized"])
+        touched_simple = {self.simple[pos] for pos in stale} | set(new_simple)
+
+        # Listas invertidas: sacar las filas viejas y sumar las nuevas
+        drop, add = defaultdict(list), defaultdict(list)
+        for pos in stale:
+            for token in self.parts["tokens"].iat[pos]:
+                drop[token].append(pos)
+        for pos, tokens in zip(positions, new_parts["tokens"]):
+            for token in tokens:
+                add[token].append(pos)
+        token_rows = _patch_postings(self.token_rows, drop, add)
+
+        # Columnas: recortar o extender a n_new y pisar las posiciones nuevas
+        def resize(values: np.ndarray, fill) -> np.ndarray:
+            if n_new <= len(values):
+                return values[:n_new].copy()
+            return np.concatenate([values, np.full(n_new - len(values), fill, dtype=values.dtype)])
+
+        parts = {}
+        for col in self.parts.columns:
+            values = resize(self.parts[col].to_numpy(dtype=object), None)
+            values[positions] = new_parts[col].to_numpy(dtype=object)
+            parts[col] = values
+        simple = resize(np.array(self.simple, dtype=object), None)
+        simple[positions] = np.array(new_simple, dtype=object)
+        addresses = resize(np.array(self.addresses, dtype=object), None)
+        addresses[positions] = np.array(new_addresses, dtype=object)
+        rows = self.rows[:n_new] + [None] * max(n_new - n_old, 0)
+        for pos, row in zip(positions, new_rows):
+            rows[pos] = row
+
+        vocab, codes = {}, {}
+        for field in self.codes:
+            vocab[field] = dict(self.vocab[field])
+            codes[field] = resize(self.codes[field], -1)
+            column = simple if field == "simple" else parts[field]
+            for pos in positions:
+                codes[field][pos] = vocab[field].setdefault(column[pos], len(vocab[field]))
+
+        drop, add = defaultdict(list), defaultdict(list)
+        for pos in stale:
+            drop[int(self.codes["normalized"][pos])].append(pos)
+        for pos in positions:
+            add[int(codes["normalized"][pos])].append(pos)
+        norm_rows = _patch_postings(self.norm_rows, drop, add)
+        field_rows = {}
+        for field in self.RETRIEVAL_FIELDS:
+            drop, add = defaultdict(list), defaultdict(list)
+            for pos in stale:
+                drop[int(self.codes[field][pos])].append(pos)
+            for pos in positions:
+                add[int(codes[field][pos])].append(pos)
+            field_rows[field] = _patch_postings(self.field_rows[field], drop, add)
+
+        # Trigramas: las direcciones nuevas se suman al índice (con el IDF de
+        # ahora); las que quedaron sin filas no molestan, candidate_rows las salta
+        n_docs, n_old_docs = len(vocab["normalized"]), len(self.gram_norm)
+        gram_codes = self.gram_codes
+        gram_norm = self.gram_norm
+        if n_docs > n_old_docs:
+            new_grams = defaultdict(list)
+            for code, text in enumerate(list(vocab["normalized"])[n_old_docs:], start=n_old_docs):
+                for gram in _trigrams(text):
+                    new_grams[gram].append(code)
+            gram_codes = _patch_postings(gram_codes, {}, new_grams)
+            new_norms = np.zeros(n_docs - n_old_docs)
+            for gram, doc_codes in new_grams.items():
+                new_norms[np.array(doc_codes) - n_old_docs] += _gram_idf(n_docs, len(gram_codes[gram])) ** 2
+            gram_norm = np.concatenate([gram_norm, np.sqrt(np.maximum(new_norms, 1e-12))])
+
+        self.df_keys = df_keys
+        self.addresses = addresses.tolist()
+        self.rows = rows
+        self.row_hashes = hashes
+        self.parts = pd.DataFrame(parts)
+        self.simple = simple.tolist()
+        self.vocab = vocab
+        self.codes = codes
+        self.token_rows = token_rows
+        self.norm_rows = norm_rows
+        self.field_rows = field_rows
+        self.gram_codes = gram_codes
+        self.gram_norm = gram_norm
+
+        # Tags M: recalcular solo las claves tocadas
+        for attr, field, touched in (
+            ("m_tags_by_norm", "normalized", touched_norm),
+            ("m_tags_by_simple", "simple", touched_simple),
+        ):
+            m_tags = defaultdict(set, getattr(self, attr))
+            for key in touched:
+                if field == "normalized":
+                    key_rows = norm_rows.get(vocab[field][key], [])
+                else:
+                    key_rows = np.flatnonzero(codes[field] == vocab[field][key])
+                tags = {_m_tag(rows[pos]) for pos in key_rows}
+                tags.discard("")
+                if tags:
+                    m_tags[key] = tags
+                else:
+                    m_tags.pop(key, None)
+            setattr(self, attr, m_tags)
+
+        return len(positions)
+
+    def score_parts(self, p: dict, p_simple: str) -> np.ndarray:
+        """Score de una dirección PDF (ya parseada) contra todas las filas."""
+        scores = np.zeros(len(self), dtype=np.int16)
+
+        for field, points in _SCORE_WEIGHTS:
+            code = self.vocab[field].get(p[field]) if p[field] else None
+            if code is not None:
+                scores[self.codes[field] == code] += points
+
+        overlap = np.zeros(len(self), dtype=np.int16)
+        for token in p["tokens"]:
+            rows = self.token_rows.get(token)
+            if rows is not None:
+                overlap[rows] += 1
+        scores += np.minimum(overlap * 5, 20).astype(np.int16)
+
+        code = self.vocab["simple"].get(p_simple)
+        if code is not None:
+            scores[self.codes["simple"] == code] += 10
+
+        return scores
+
+    def score(self, pdf_addr: str) -> np.ndarray:
+        return self.score_parts(extract_address_parts(pdf_addr), simplify_address_15chars(pdf_addr))
+
+    def score_many(self, pdf_addrs) -> np.ndarray:
+        """Matriz (direcciones PDF × filas del register) de scores."""
+        pdf_addrs = list(pdf_addrs)
+        matrix = np.zeros((len(pdf_addrs), len(self)), dtype=np.int16)
+        for i, addr in enumerate(pdf_addrs):
+            matrix[i] = self.score(addr)
+        return matrix
+
+    def top_k(self, pdf_addr: str, k: int = 3) -> list:
+        """
+        [(posición, score)] de los k mejores candidatos con score > 0, sobre
+        la dirección con los dígitos mal leídos ya corregidos. En registers
+        chicos se puntúan todas las filas; en los grandes, los candidatos del
+        índice de trigramas. Después se refinan con score_rows(fuzzy=True).
+        """
+        pdf_addr = fix_ocr_digits(pdf_addr)
+        p = extract_address_parts(pdf_addr)
+        p_simple = simplify_address_15chars(pdf_addr)
+        if len(self) <= self.RETRIEVAL_MIN_ROWS:
+            scores = self.score_parts(p, p_simple)
+            pool = np.arange(len(self), dtype=np.int32)
+        else:
+            pool = self.candidate_rows(p)
+            if not len(pool):
+                return []
+            scores = self.score_rows(p, p_simple, pool, fuzzy=False)
+
+        # El crédito aproximado es a lo sumo 5 por palabra de la calle que
+        # puede contar como casi igual: las filas que ni así llegan al
+        # k-ésimo score exacto no hace falta refinarlas
+        fuzzy_words = [t for t in street_name_tokens(p["normalized"]) & p["tokens"] if len(t) >= FUZZY_TOKEN_MIN_LEN]
+        if fuzzy_words:
+            if len(pool) > k:
+                bar = np.partition(scores, -k)[-k]
+                pool = pool[scores + 5 * len(fuzzy_words) >= bar]
+            scores = self.score_rows(p, p_simple, pool)
+        keep = scores > 0
+        pool, scores = pool[keep], scores[keep]
+        order = np.lexsort((pool, -scores))[:k]
+        return [(int(pool[i]), float(scores[i])) for i in order]
+
+    def top_k_many(self, pdf_addrs, k: int = 3) -> list:
+        return [self.top_k(addr, k) for addr in pdf_addrs]
+
+
+def find_best_match(pdf_addr: str, key_index: KeyRegisterIndex):
+    scored = key_index.top_k(pdf_addr, 3)
+
+    if not scored:
+        return None, []
+
+    candidates = [
+        {
+            "Property Address": key_index.addresses[pos],
+            "Tag": key_index.rows[pos].get("Tag", ""),
+            "score": score,
+            "row_data": dict(key_index.rows[pos]),
+        }
+        for pos, score in scored
+    ]
+    best = candidates[0]
+    return best, candidates
+
+
+def get_m_keys_for_address(matched_address: str, key_index: KeyRegisterIndex) -> str:
+    if not matched_address:
+        return ""
+
+    m_tags = (
+        key_index.m_tags_by_norm.get(normalize_address(matched_address), set())
+        | key_index.m_tags_by_simple.get(simplify_address_15chars(matched_address), set())
+    )
+
+    return ", ".join(sorted(m_tags))
+
+
+# ----------------------------------------------------------
+# SNAPSHOT LOCAL Y SINCRONIZACIÓN DEL KEY REGISTER
+# ----------------------------------------------------------
+# Drive solo expone la fecha de modificación de toda la planilla, no qué
+# filas cambiaron: cuando cambia se descarga la hoja (una sola llamada) y se
+# compara fila por fila contra el snapshot. Lo caro (parsear direcciones y
+# armar el índice) se hace solo para las filas nuevas o editadas.
+REGISTER_SNAPSHOT_DIR = os.path.join(".cache", "key_register")
+# Subir si cambia la normalización/parseo de direcciones: invalida los snapshots
+REGISTER_SNAPSHOT_VERSION = 1
+
+
+class KeyRegisterSnapshot:
+    """
+    Key Register limpio y sus partes parseadas en Parquet, más un JSON con la
+    revisión sincronizada y un checksum de las filas. Sin pyarrow no se
+    guarda nada y cada proceso arranca descargando la hoja.
+    """
+
+    def __init__(self, sheet_id: str, directory: str = REGISTER_SNAPSHOT_DIR):
+        self.base = os.path.join(directory, re.sub(r"[^\w-]", "_", sheet_id))
+        self.enabled = importlib.util.find_spec("pyarrow") is not None
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def meta(self) -> dict:
+        try:
+            with open(f"{self.base}.json", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return meta if meta.get("version") == REGISTER_SNAPSHOT_VERSION else {}
+
+    def load(self):
+        """(key_index, revision), o None si no hay snapshot válido."""
+        meta = self.meta()
+        if not self.enabled or not meta:
+            return None
+        try:
+            df_keys = pd.read_parquet(f"{self.base}.parquet")
+            parts = pd.read_parquet(f"{self.base}.parts.parquet")
+        except Exception as e:
+            logger.warning("Snapshot del Key Register ilegible, se descarga de nuevo: %s", e)
+            return None
+        if len(df_keys) != meta.get("rows") or len(parts) != len(df_keys):
+            return None
+
+        simple = parts.pop("simple").tolist()
+        parts["tokens"] = [set(tokens) for tokens in parts["tokens"]]
+        key_index = KeyRegisterIndex(df_keys, parts=parts, simple=simple)
+        if register_checksum(key_index) != meta.get("checksum"):
+            return None
+        return key_index, meta.get("revision")
+
+    def save(self, key_index: KeyRegisterIndex, revision: str, rows_changed: bool = True):
+        """Con rows_changed=False solo se actualiza la revisión (la hoja cambió en otra cosa)."""
+        if not self.enabled:
+            return
+        if rows_changed:
+            parts = key_index.parts.assign(
+                tokens=[sorted(tokens) for tokens in key_index.parts["tokens"]],
+                simple=key_index.simple,
+            )
+            key_index.df_keys.astype(str).to_parquet(f"{self.base}.parquet.tmp", index=False)
+            parts.to_parquet(f"{self.base}.parts.parquet.tmp", index=False)
+            os.replace(f"{self.base}.parquet.tmp", f"{self.base}.parquet")
+            os.replace(f"{self.base}.parts.parquet.tmp", f"{self.base}.parts.parquet")
+        _write_json_atomic(f"{self.base}.json", {
+            "version": REGISTER_SNAPSHOT_VERSION,
+            "revision": revision,
+            "rows": len(key_index),
+            "checksum": register_checksum(key_index),
+            "synced_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+
+
+def register_checksum(key_index: KeyRegisterIndex) -> str:
+    h = hashlib.sha256()
+    h.update("\0".join(map(str, key_index.df_keys.columns)).encode())
+    h.update(key_index.row_hashes.tobytes())
+    return h.hexdigest()
+
+
+class KeyRegisterSync:
+    """
+    Key Register vivo de una planilla: arranca del snapshot local y en cada
+    sync() consulta la revisión en Drive. Si cambió (o pasó `max_age`), baja
+    la hoja y aplica las diferencias a una copia del índice, así los reportes
+    que están usando la versión anterior no ven cambios a mitad de camino.
+    """
+
+    def __init__(self, spreadsheet, directory: str = REGISTER_SNAPSHOT_DIR, max_age: float = None):
+        self.spreadsheet = spreadsheet
+        self.snapshot = KeyRegisterSnapshot(spreadsheet.id, directory)
+        self.max_age = max_age
+        self.key_index = None
+        self.revision = None
+        self.checked_at = 0.0
+        self.last_sync = {}
+        self._force = False
+        self._loaded_snapshot = False
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        """El próximo sync() descarga la hoja aunque la revisión no haya cambiado."""
+        self._force = True
+
+    def sync(self) -> tuple:
+        """Devuelve (df_keys, key_index) al día con la planilla."""
+        with self._lock:
+            started = time.perf_counter()
+            if not self._loaded_snapshot:
+                self._loaded_snapshot = True
+                loaded = self.snapshot.load()
+                if loaded is not None:
+                    self.key_index, self.revision = loaded
+
+            revision = self.spreadsheet.get_lastUpdateTime()
+            expired = self.max_age is not None and time.monotonic() - self.checked_at > self.max_age
+            if self.key_index is not None and revision == self.revision and not self._force and not expired:
+                self.last_sync = {"mode": "cached", "seconds": round(time.perf_counter() - started, 3)}
+                return self.key_index.df_keys, self.key_index
+
+            df_keys = read_key_register(self.spreadsheet)
+            if self.key_index is None:
+                key_index = KeyRegisterIndex(df_keys)
+                diff = {"mode": "full", "changed": 0, "added": len(df_keys), "removed": 0, "parsed": len(df_keys)}
+            else:
+                key_index = copy.copy(self.key_index)
+                diff = key_index.update(df_keys)
+
+            self.snapshot.save(key_index, revision, rows_changed=diff["mode"] != "none")
+            self.key_index = key_index
+            self.revision = revision
+            self.checked_at = time.monotonic()
+            self._force = False
+            self.last_sync = {**diff, "seconds": round(time.perf_counter() - started, 3)}
+            logger.info("Key Register sincronizado: %s", self.last_sync)
+            return key_index.df_keys, key_index
+
+
+# ----------------------------------------------------------
+# PDF → IMÁGENES BASE64
+# ----------------------------------------------------------
+GPT_MODEL = "gpt-4o"
+
+# Cómo se renderiza cada página antes de mandarla a GPT. El perfil forma parte
+# de la clave de caché: si cambia, las páginas se vuelven a leer.
+#
+# En "detail": "high" OpenAI achica la imagen hasta que el lado corto mida 768 px
+# y la cobra en tiles de 512 px, así que renderizar más grande solo agranda el
+# upload. max_short_side/max_long_side limitan el render a lo que el modelo ve:
+# 768x1024 entra en 2x2 tiles (765 tokens) y 512x1024 en 1x2 (425 tokens).
+# PyMuPDF no escribe WebP, por eso los perfiles comprimidos usan JPEG.
+RENDER_PROFILES = {
+    "original": {
+        "zoom": 1.5, "format": "png", "gray": False, "crop_margins": False,
+        "trim_top": 0.0, "trim_bottom": 0.0, "max_short_side": None, "max_long_side": None,
+        "detail": "high",
+    },
+    "estandar": {
+        "zoom": 1.5, "format": "png", "gray": False, "crop_margins": False,
+        "trim_top": 0.0, "trim_bottom": 0.0, "max_short_side": 768, "max_long_side": 1024,
+        "detail": "high",
+    },
+    "gris_jpeg": {
+        "zoom": 2.0, "format": "jpeg", "quality": 80, "gray": True, "crop_margins": True,
+        "trim_top": 0.0, "trim_bottom": 0.0, "max_short_side": 768, "max_long_side": 1024,
+        "detail": "high",
+    },
+    "economico": {
+        "zoom": 2.0, "format": "jpeg", "quality": 70, "gray": True, "crop_margins": True,
+        "trim_top": 0.0, "trim_bottom": 0.0, "max_short_side": 512, "max_long_side": 1024,
+        "detail": "high",
+    },
+}
+DEFAULT_RENDER_PROFILE = "estandar"
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """Tokens que OpenAI cobra por una imagen (85 base + 170 por tile de 512 px)."""
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def _render_clip(page, profile: dict):
+    """Recorta márgenes en blanco y, si el perfil lo pide, encabezado/pie."""
+    rect = page.rect
+    if profile.get("crop_margins"):
+        content = None
+        for _, bbox in page.get_bboxlog():
+            box = type(rect)(bbox)
+            if box.is_empty or box.is_infinite:
+                continue
+            content = box if content is None else content | box
+        if content is not None:
+            rect = (content + (-8, -8, 8, 8)) & page.rect
+
+    top, bottom = profile.get("trim_top", 0.0), profile.get("trim_bottom", 0.0)
+    if top or bottom:
+        h = rect.height
+        rect = type(rect)(rect.x0, rect.y0 + h * top, rect.x1, rect.y1 - h * bottom)
+    return rect
+
+
+def render_page(page, profile: dict) -> tuple:
+    """Devuelve (bytes de la imagen, ancho, alto) según el perfil de render."""
+    import fitz
+
+    clip = _render_clip(page, profile)
+    # El -0.5 evita que el redondeo de PyMuPDF se pase un pixel del límite
+    zoom = profile["zoom"]
+    if profile.get("max_short_side"):
+        zoom = min(zoom, (profile["max_short_side"] - 0.5) / min(clip.width, clip.height))
+    if profile.get("max_long_side"):
+        zoom = min(zoom, (profile["max_long_side"] - 0.5) / max(clip.width, clip.height))
+
+    pix = page.get_pixmap(
+        matrix=fitz.Matrix(zoom, zoom),
+        clip=clip,
+        colorspace=fitz.csGRAY if profile.get("gray") else fitz.csRGB,
+    )
+    if profile["format"] == "jpeg":
+        data = pix.tobytes("jpeg", jpg_quality=profile.get("quality", 80))
+    else:
+        data = pix.tobytes("png")
+    return data, pix.width, pix.height
+
+
+def _render_page_b64(page, page_num: int, profile: dict, page_log: dict) -> str:
+    data, width, height = render_page(page, profile)
+    est_tokens = estimate_image_tokens(width, height, profile["detail"])
+    page_log[page_num] = {
+        "page": page_num,
+        "width": width,
+        "height": height,
+        "image_bytes": len(data),
+        "image_tokens_est": est_tokens,
+    }
+    logger.info("Página %s: %sx%s px, %s bytes, ~%s tokens de imagen", page_num, width, height, len(data), est_tokens)
+    return base64.b64encode(data).decode()
+
+
+def pdf_to_base64_images(
+    pdf_bytes: bytes,
+    pages: set = None,
+    profile: dict = None,
+    stats: dict = None,
+) -> list:
+    """
+    Renderiza el PDF a base64, una entrada por página.
+    Si se pasa `pages` (índices desde 0), el resto queda en None sin renderizar.
+    En stats["page_log"] queda el tamaño y los tokens estimados de cada imagen.
+    """
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError("Falta PyMuPDF. Agregá 'pymupdf' a requirements.txt")
+
+    profile = profile or RENDER_PROFILES[DEFAULT_RENDER_PROFILE]
+    page_log = stats.setdefault("page_log", {}) if stats is not None else {}
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    images = []
+
+    for i, page in enumerate(doc):
+        if pages is not None and i not in pages:
+            images.append(None)
+            continue
+        images.append(_render_page_b64(page, i + 1, profile, page_log))
+
+    doc.close()
+    return images
+
+
+# ----------------------------------------------------------
+# CAPA DE TEXTO: LECTURA SIN IA
+# ----------------------------------------------------------
+# Por debajo de esta confianza la página se lee con GPT como imagen
+TEXT_LAYER_MIN_CONFIDENCE = 0.8
+
+_TEXT_ADDRESS_RE = re.compile(
+    r"^(?:[A-Za-z]?\d+[A-Za-z]?/\d+[A-Za-z]?\s+[A-Za-z]"
+    r"|\d+[A-Za-z]?\s+[A-Za-z].*\b(?:street|st|road|rd|terrace|tce|avenue|ave|boulevard|bvd"
+    r"|drive|dr|place|pl|court|ct|lane|ln|quay|qy)\b)",
+    re.IGNORECASE,
+)
+_TEXT_ADDRESS_END_RE = re.compile(r"\b(?:qld|queensland|\d{4})\s*$", re.IGNORECASE)
+_TEXT_NOT_ADDRESS_RE = re.compile(
+    r"\b(?:clean|inspection|maintenance|linen|arrival|depart)\b|\d{1,2}/\d{1,2}/\d{2,4}",
+    re.IGNORECASE,
+)
+_TEXT_PAGE_RE = re.compile(r"\bpage\s+(\d+)\s+(?:of|/)\s+\d+\b", re.IGNORECASE)
+
+
+def _text_lines(page) -> list:
+    """Agrupa las palabras de PyMuPDF en líneas con su posición."""
+    lines = {}
+    for x0, y0, x1, y1, word, block, line, _ in page.get_text("words"):
+        ln = lines.setdefault((block, line), {"x0": x0, "y0": y0, "x1": x1, "y1": y1, "words": []})
+        ln["x0"] = min(ln["x0"], x0)
+        ln["y0"] = min(ln["y0"], y0)
+        ln["x1"] = max(ln["x1"], x1)
+        ln["y1"] = max(ln["y1"], y1)
+        ln["words"].append((x0, word))
+
+    for ln in lines.values():
+        ln["words"].sort()
+        ln["text"] = " ".join(w for _, w in ln["words"])
+
+    return sorted(lines.values(), key=lambda ln: (round(ln["y0"]), ln["x0"]))
+
+
+def _clip_line(ln: dict, x_min: float, x_max: float) -> str:
+    """Texto de la línea limitado a una columna (PyMuPDF a veces junta columnas)."""
+    return " ".join(w for x, w in ln["words"] if x_min <= x < x_max)
+
+
+def _find_header(lines: list) -> tuple:
+    """(línea del encabezado de columnas, x de "Assigned To"), o (None, None)."""
+    for ln in lines:
+        words = [w for _, w in ln["words"]]
+        for j in range(len(words) - 1):
+            if words[j].lower() == "assigned" and words[j + 1].lower() == "to":
+                return ln, ln["words"][j][0]
+    return None, None
+
+
+def parse_text_layer_page(page, page_num: int) -> dict:
+    """
+    Lee una página del Housekeeping Daily Summary desde su capa de texto.
+    Devuelve {"page", "records", "confidence"}; con confianza baja la página
+    tiene que pasar por call_gpt_page.
+    """
+    result = {"page": page_num, "records": [], "confidence": 0.0}
+    lines = _text_lines(page)
+    if not lines:
+        return result
+
+    page_value = page_num
+    footer_ids = set()
+    for ln in lines:
+        m = _TEXT_PAGE_RE.search(ln["text"])
+        if m:
+            page_value = int(m.group(1))
+            footer_ids.add(id(ln))
+    result["page"] = page_value
+
+    # La columna "Assigned To" marca dónde buscar el cleaner
+    header, assigned_x = _find_header(lines)
+    if header is None:
+        result["confidence"] = 0.3
+        return result
+
+    body = [
+        ln for ln in lines
+        if ln is not header and id(ln) not in footer_ids and ln["y0"] >= header["y1"] - 1
+    ]
+    addr_lines = [ln for ln in body if ln["x0"] < assigned_x and _TEXT_ADDRESS_RE.match(ln["text"])]
+    if not addr_lines:
+        return result
+
+    addr_x = min(ln["x0"] for ln in addr_lines)
+    addr_lines = [ln for ln in addr_lines if abs(ln["x0"] - addr_x) <= 3]
+    column = [ln for ln in body if abs(ln["x0"] - addr_x) <= 3]
+
+    # La columna de dirección termina donde empieza el siguiente encabezado
+    header_xs = [
+        x for ln in lines if abs(ln["y0"] - header["y0"]) <= 2
+        for x, _ in ln["words"] if x > addr_x + 20
+    ]
+    addr_x_max = min(header_xs + [assigned_x])
+
+    confidence = 1.0
+    # Texto en la columna de dirección antes de la primera dirección:
+    # probablemente la cola de una dirección cortada en la página anterior.
+    if any(ln["y0"] < addr_lines[0]["y0"] - 1 for ln in column):
+        confidence = 0.5
+
+    page_bottom = min([ln["y0"] for ln in lines if id(ln) in footer_ids] or [page.rect.y1])
+
+    records = []
+    for idx, ln in enumerate(addr_lines):
+        next_y = addr_lines[idx + 1]["y0"] if idx + 1 < len(addr_lines) else page_bottom
+
+        parts = [_clip_line(ln, addr_x - 3, addr_x_max)]
+        for cont in column:
+            if cont is ln or not (ln["y0"] < cont["y0"] < next_y):
+                continue
+            text = _clip_line(cont, addr_x - 3, addr_x_max)
+            if re.match(r"^[A-Za-z]?\d", text):
+                # Empieza con número pero no pasó como dirección: no la adivinamos
+                confidence = min(confidence, 0.5)
+                break
+            if _TEXT_NOT_ADDRESS_RE.search(text) or len(parts) == 3:
+                break
+            ends = _TEXT_ADDRESS_END_RE.search(text.rstrip(" ,."))
+            if _TEXT_ADDRESS_END_RE.search(parts[-1].rstrip(" ,.")) or (
+                ends and re.search(r"\d", text[:ends.start()])
+            ):
+                # La dirección ya terminó, o la línea trae su propio número y
+                # postcode: otra propiedad que el patrón no reconoció
+                if ends:
+                    confidence = min(confidence, 0.5)
+                break
+            parts.append(text)
+        address = re.sub(r"\s+", " ", " ".join(parts)).strip().rstrip(",")
+
+        names = []
+        for c in body:
+            if not (ln["y0"] - 2 <= c["y0"] < next_y - 2):
+                continue
+            name = _clip_line(c, assigned_x - 2, float("inf")).strip()
+            if name and name not in names:
+                names.append(name)
+
+        if len(names) == 1:
+            cleaner, cleaner_conf = names[0], 0.95
+        elif not names:
+            cleaner, cleaner_conf = "Unassigned", 0.8
+        else:
+            cleaner, cleaner_conf = names[0], 0.6
+
+        address_conf = 0.95 if _TEXT_ADDRESS_END_RE.search(address) else 0.85
+
+        records.append({
+            "address": address,
+            "cleaner": cleaner,
+            "page": page_value,
+            "address_confidence": address_conf,
+            "cleaner_confidence": cleaner_conf,
+            "notes": "",
+        })
+        confidence = min(confidence, address_conf, cleaner_conf)
+
+    result["records"] = records
+    result["confidence"] = confidence
+    return result
+
+
+def parse_text_layer(pdf_bytes: bytes) -> list:
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError("Falta PyMuPDF. Agregá 'pymupdf' a requirements.txt")
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    pages = [parse_text_layer_page(page, i + 1) for i, page in enumerate(doc)]
+    doc.close()
+    return pages
+
+
+# ----------------------------------------------------------
+# PRE-FILTRO DE PÁGINAS
+# ----------------------------------------------------------
+# Antes de pagar una lectura con visión se mira la página barato: capa de
+# texto, cuántas líneas parecen dirección y cuánta tinta tiene. Quedan tres
+# clases:
+#   "skip":     en blanco, solo encabezado/pie o leyenda → sin registros
+#   "fragment": sin direcciones y con pocos renglones bajo el encabezado de
+#               columnas (la cola de una dirección cortada en la página
+#               anterior, quizás con su cleaner) → visión con un render y una
+#               respuesta chicos
+#   "full":     el camino de siempre
+PREFILTER_ZOOM = 0.25
+# Un pixel es tinta si es más oscuro que esto (escala de grises 0-255)
+PREFILTER_INK_LEVEL = 160
+# Fracción de tinta fuera de las líneas de texto por debajo de la cual la
+# página no tiene nada más que ese texto (o nada: página en blanco). Por
+# encima hay contenido que la capa de texto no ve (escaneos, tablas como imagen)
+PREFILTER_BLANK_INK = 0.001
+PREFILTER_FRAGMENT_PROFILE = "economico"
+PREFILTER_FRAGMENT_MAX_TOKENS = 400
+# Renglones bajo el encabezado que todavía pueden ser solo una cola cortada;
+# con más, la página tiene propiedades que el patrón no reconoció y va "full"
+PREFILTER_FRAGMENT_MAX_ROWS = 3
+
+
+def page_ink_density(page, exclude: list = (), zoom: float = PREFILTER_ZOOM) -> float:
+    """
+    Fracción de pixeles oscuros en un render mínimo en escala de grises,
+    sin contar los rectángulos de `exclude` (coordenadas de la página).
+    """
+    import fitz
+
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=fitz.csGRAY, alpha=False)
+    if not pix.width or not pix.height:
+        return 0.0
+    pixels = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+    ink = pixels < PREFILTER_INK_LEVEL
+    x_off, y_off = page.rect.x0, page.rect.y0
+    for x0, y0, x1, y1 in exclude:
+        ink[
+            max(int((y0 - y_off) * zoom) - 1, 0):int((y1 - y_off) * zoom) + 2,
+            max(int((x0 - x_off) * zoom) - 1, 0):int((x1 - x_off) * zoom) + 2,
+        ] = False
+    return float(ink.mean())
+
+
+def classify_page(page) -> dict:
+    """
+    Clasifica una página como "skip", "fragment" o "full" (ver arriba).
+    Devuelve {"kind", "chars", "addresses", "body", "tails", "ink"}; la tinta
+    solo se mide cuando el texto no alcanza para decidir.
+    """
+    all_lines = _text_lines(page)
+    lines = [ln for ln in all_lines if not _TEXT_PAGE_RE.search(ln["text"])]
+    texts = [ln["text"] for ln in lines]
+    info = {
+        "kind": "full",
+        "chars": sum(len(t) for t in texts),
+        "addresses": sum(1 for t in texts if _TEXT_ADDRESS_RE.match(t)),
+        "body": 0,
+        "tails": 0,
+        "ink": None,
+    }
+    if info["addresses"]:
+        return info
+
+    # Con encabezado de columnas, cualquier renglón debajo es la continuación
+    # de la página anterior ("Street, South Brisbane", un cleaner suelto...).
+    # Sin encabezado (leyendas, totales) solo cuenta lo que termina como una
+    # dirección: en estado o postcode.
+    header, _ = _find_header(lines)
+    if header is not None:
+        info["body"] = len({
+            round(ln["y0"]) for ln in lines
+            if ln["y0"] >= header["y1"] - 1 and abs(ln["y0"] - header["y0"]) > 2
+        })
+    info["tails"] = sum(
+        1 for t in texts
+        if _TEXT_ADDRESS_END_RE.search(t.rstrip(" ,.")) and not _TEXT_NOT_ADDRESS_RE.search(t)
+    )
+    info["ink"] = round(page_ink_density(page, [(ln["x0"], ln["y0"], ln["x1"], ln["y1"]) for ln in all_lines]), 4)
+
+    if info["ink"] < PREFILTER_BLANK_INK:
+        if max(info["body"], info["tails"]) > PREFILTER_FRAGMENT_MAX_ROWS:
+            info["kind"] = "full"
+        else:
+            info["kind"] = "fragment" if info["body"] or info["tails"] else "skip"
+    return info
+
+
+# ----------------------------------------------------------
+# FIX 1: PROMPT MEJORADO
+# ----------------------------------------------------------
+PROMPT = """Esta es una página de un "Housekeeping Daily Summary" de Resly/Bedspoke.
+
+Cada propiedad tiene este formato típico:
+- Dirección (en negrita o destacada, con número de unidad/piso y calle)
+- Tipo de tarea (Depart Clean, Service Clean, etc.)
+- Detalles de reservas (nombres de HUÉSPEDES con fechas)
+- NOTAS internas (instrucciones de limpieza, llaves, etc.)
+- Nombre del cleaner asignado (columna "Assigned To", al final de la fila)
+
+REGLAS CRÍTICAS para identificar el cleaner:
+1. El cleaner asignado es el nombre que aparece en la columna "Assigned To" del reporte.
+   Generalmente aparece al final del bloque de cada propiedad, alineado a la derecha.
+2. NUNCA uses nombres que aparecen en las notas internas como cleaner.
+   Las notas contienen instrucciones como "pls return M set to base - Marga" o 
+   "(Ricka Joy Mangi-07/05/26)" — estos son AUTORES DE NOTAS, NO cleaners.
+3. NUNCA uses nombres de huéspedes (van con fechas de reserva, como "SMITH, John (2A0C)").
+4. Si no hay cleaner asignado, devolvé exactamente "Unassigned".
+
+REGLAS para direcciones:
+- La dirección siempre empieza con un número de unidad/piso seguido de "/" y luego 
+  el número de calle. Ejemplo: "1208/35 Hercules Street" o "2/71 Doggett Street".
+- Si una dirección aparece cortada o incompleta al final de la página, devolvela igual 
+  con lo que puedas leer. NO la inventes ni completes.
+- Ignorá encabezados, pies de página, fechas y textos de reserva.
+
+Para cada propiedad devolvé:
+- address: dirección completa
+- cleaner: nombre del cleaner de la columna "Assigned To"
+- page: número de página
+- address_confidence: número entre 0 y 1
+- cleaner_confidence: número entre 0 y 1
+- notes: texto corto si hubo ambigüedad, o ""
+
+Respondé SOLO con JSON válido:
+{
+  "records": [
+    {
+      "address": "...",
+      "cleaner": "...",
+      "page": 1,
+      "address_confidence": 0.93,
+      "cleaner_confidence": 0.88,
+      "notes": ""
+    }
+  ]
+}
+Si no hay propiedades visibles, respondé: {"records": []}
+"""
+
+
+# ----------------------------------------------------------
+# CLIENTE HTTP OPENAI: SESIÓN COMPARTIDA + REINTENTOS
+# ----------------------------------------------------------
+# OPENAI_BASE_URL permite apuntar a un proxy o al stub local de benchmarks/
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_CHAT_URL = f"{OPENAI_BASE_URL.rstrip('/')}/chat/completions"
+
+# Reintentos por request: hasta OPENAI_MAX_ATTEMPTS intentos y no más de
+# OPENAI_RETRY_BUDGET_S segundos esperando entre ellos. Pasado eso, la página
+# queda marcada como fallida y el resto del reporte sigue.
+OPENAI_MAX_ATTEMPTS = 5
+OPENAI_RETRY_BUDGET_S = 120
+OPENAI_BACKOFF_BASE_S = 1.0
+OPENAI_BACKOFF_MAX_S = 30.0
+_RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def set_openai_base_url(base_url: str):
+    global OPENAI_BASE_URL, OPENAI_CHAT_URL
+    OPENAI_BASE_URL = base_url
+    OPENAI_CHAT_URL = f"{base_url.rstrip('/')}/chat/completions"
+
+
+class OpenAIRequestError(ValueError):
+    def __init__(self, message: str, status_code: int = None, attempts: int = 0):
+        super().__init__(message)
+        self.status_code = status_code
+        self.attempts = attempts
+
+
+class PageParseError(OpenAIRequestError):
+    """La lectura de una página respondió, pero sin registros que se puedan leer."""
+
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Una sesión (pool de conexiones) por proceso, compartida entre hilos."""
+    pid = os.getpid()
+    with _http_sessions_lock:
+        session = _http_sessions.get(pid)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_PAGE_CONCURRENCY * 2)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_sessions[pid] = session
+    return session
+
+
+def _parse_duration(value: str) -> float:
+    """Convierte '1s', '6m0s', '250ms' (headers x-ratelimit-reset-*) a segundos."""
+    total = 0.0
+    for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value or ""):
+        total += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return total
+
+
+def _server_retry_delay(response) -> float:
+    """Espera pedida por el servidor (Retry-After o headers de rate limit), o None."""
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        value = headers["retry-after"]
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    if response.status_code == 429:
+        resets = [
+            _parse_duration(headers.get(f"x-ratelimit-reset-{kind}", ""))
+            for kind in ("requests", "tokens")
+            if headers.get(f"x-ratelimit-remaining-{kind}") == "0"
+        ]
+        if resets:
+            return max(resets)
+    return None
+
+
+def _response_error(response) -> str:
+    try:
+        return response.json().get("error", {}).get("message", response.text)
+    except Exception:
+        return response.text
+
+
+# ----------------------------------------------------------
+# TRANSPORTE OPENAI: LIVE / RECORD / REPLAY
+# ----------------------------------------------------------
+# "live" llama a la API como siempre. "record" además guarda cada intento
+# (status, headers, cuerpo, latencia) bajo la huella de la request, y
+# "replay" los devuelve sin red: la misma request recibe la misma secuencia
+# de respuestas, incluidos los 429/5xx, así que los reintentos se reproducen.
+# En la app se elige con las variables OPENAI_TRANSPORT y OPENAI_TRANSPORT_DIR.
+OPENAI_TRANSPORT_MODES = ("live", "record", "replay")
+TRANSPORT_DIR = os.environ.get("OPENAI_TRANSPORT_DIR", os.path.join(".cache", "transport"))
+
+
+def request_fingerprint(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class _ReplayResponse:
+    """Lo mínimo de requests.Response que usa post_chat_completion."""
+
+    def __init__(self, exchange: dict):
+        self.status_code = exchange["status"]
+        self.headers = requests.structures.CaseInsensitiveDict(exchange.get("headers") or {})
+        self._body = exchange.get("body")
+        self.text = self._body if isinstance(self._body, str) else json.dumps(self._body)
+
+    def json(self):
+        if isinstance(self._body, str):
+            return json.loads(self._body)
+        return self._body
+
+
+class OpenAITransport:
+    def __init__(self, mode: str = "live", directory: str = TRANSPORT_DIR, replay_latency: bool = False):
+        if mode not in OPENAI_TRANSPORT_MODES:
+            raise ValueError(f"Modo de transporte desconocido: {mode}")
+        self.mode = mode
+        self.directory = directory
+        self.replay_latency = replay_latency
+        self._lock = threading.Lock()
+
+    @property
+    def offline(self) -> bool:
+        return self.mode == "replay"
+
+    def _path(self, fingerprint: str) -> str:
+        return os.path.join(self.directory, fingerprint[:2], f"{fingerprint}.json")
+
+    def post(self, payload: dict, headers: dict, timeout: float, attempt: int):
+        if self.mode == "replay":
+            return self._replay(payload, attempt)
+
+        t0 = time.monotonic()
+        try:
+            response = get_http_session().post(OPENAI_CHAT_URL, headers=headers, json=payload, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if self.mode == "record":
+                self._record(payload, attempt, {"status": None, "error": str(e), "latency_s": time.monotonic() - t0})
+            raise
+
+        if self.mode == "record":
+            try:
+                body = response.json()
+            except ValueError:
+                body = response.text
+            self._record(payload, attempt, {
+                "status": response.status_code,
+                "headers": dict(response.headers),
+                "body": body,
+                "latency_s": round(time.monotonic() - t0, 3),
+            })
+        return response
+
+    def _record(self, payload: dict, attempt: int, exchange: dict):
+        fingerprint = request_fingerprint(payload)
+        path = self._path(fingerprint)
+        with self._lock:
+            exchanges = []
+            # Un intento 1 empieza una grabación nueva para esta request
+            if attempt > 1 and os.path.exists(path):
+                with open(path, encoding="utf-8") as f:
+                    exchanges = json.load(f)["exchanges"][: attempt - 1]
+            exchanges.append(exchange)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_json_atomic(path, {"fingerprint": fingerprint, "exchanges": exchanges})
+
+    def _replay(self, payload: dict, attempt: int):
+        fingerprint = request_fingerprint(payload)
+        try:
+            with open(self._path(fingerprint), encoding="utf-8") as f:
+                exchanges = json.load(f)["exchanges"]
+        except FileNotFoundError:
+            raise OpenAIRequestError(
+                f"replay: no hay respuesta grabada para esta request ({fingerprint[:12]})", attempts=attempt
+            )
+
+        exchange = exchanges[min(attempt, len(exchanges)) - 1]
+        if self.replay_latency:
+            time.sleep(exchange.get("latency_s", 0))
+        if exchange["status"] is None:
+            raise requests.ConnectionError(exchange.get("error", "replay: error de red grabado"))
+        return _ReplayResponse(exchange)
+
+
+_transport = OpenAITransport(os.environ.get("OPENAI_TRANSPORT", "live"))
+
+
+def set_openai_transport(mode: str, directory: str = TRANSPORT_DIR, replay_latency: bool = False):
+    global _transport
+    _transport = OpenAITransport(mode, directory, replay_latency)
+
+
+def get_openai_transport() -> OpenAITransport:
+    return _transport
+
+
+# ----------------------------------------------------------
+# LÍMITE DE TASA COMPARTIDO Y COLA DE TRABAJOS
+# ----------------------------------------------------------
+# Límites de la organización en OpenAI (requests y tokens por minuto). Todas
+# las sesiones de la app corren en el mismo proceso y comparten un solo
+# limitador; se usa OPENAI_RATE_HEADROOM del límite para dejar margen.
+# 0 desactiva ese límite.
+OPENAI_RPM_LIMIT = int(os.environ.get("OPENAI_RPM_LIMIT", 500))
+OPENAI_TPM_LIMIT = int(os.environ.get("OPENAI_TPM_LIMIT", 30_000))
+OPENAI_RATE_HEADROOM = 0.9
+
+# Reportes que corren a la vez; el resto espera en la cola
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", 2))
+# Estimación de segundos por página hasta que haya corridas terminadas
+DEFAULT_SECONDS_PER_PAGE = 8.0
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        return max(0.0, (amount - self.level) / self.rate)
+
+
+class RateLimiter:
+    """
+    Dos token buckets (requests y tokens estimados por minuto) detrás de un
+    lock. acquire() bloquea hasta que haya lugar en ambos. Cuando la API
+    igual devuelve 429, pause() frena a todas las sesiones el tiempo que
+    pidió el servidor en vez de que cada una reintente por su cuenta.
+    """
+
+    def __init__(self, rpm: float = OPENAI_RPM_LIMIT, tpm: float = OPENAI_TPM_LIMIT):
+        self.requests = TokenBucket(rpm * OPENAI_RATE_HEADROOM) if rpm else None
+        self.tokens = TokenBucket(tpm * OPENAI_RATE_HEADROOM) if tpm else None
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, est_tokens: float) -> float:
+        """Reserva una request de `est_tokens` tokens; devuelve los segundos esperados."""
+        started = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    needs = []
+                    if self.requests is not None:
+                        self.requests.refill(now)
+                        needs.append((self.requests, 1))
+                    if self.tokens is not None:
+                        self.tokens.refill(now)
+                        # Una request más grande que el bucket entero nunca entraría
+                        needs.append((self.tokens, min(est_tokens, self.tokens.capacity)))
+                    wait = max((bucket.wait_for(amount) for bucket, amount in needs), default=0.0)
+                    if wait <= 0:
+                        for bucket, amount in needs:
+                            bucket.level -= amount
+                        return time.monotonic() - started
+            time.sleep(min(wait, 1.0))
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+_rate_limiter = RateLimiter()
+
+
+def get_rate_limiter() -> RateLimiter:
+    return _rate_limiter
+
+
+def set_rate_limits(rpm: float, tpm: float):
+    global _rate_limiter
+    _rate_limiter = RateLimiter(rpm, tpm)
+
+
+def estimate_request_tokens(payload: dict, image_tokens: int = None) -> int:
+    """
+    Tokens que OpenAI descuenta del TPM al recibir la request: texto (~4
+    caracteres por token), imágenes y max_tokens de la respuesta.
+    """
+    text_chars = 0
+    images = 0
+    for message in payload.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            text_chars += len(content)
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                text_chars += len(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                images += 1
+    if image_tokens is None:
+        # Imagen típica del perfil estándar: 768 x 1024 en detail high
+        image_tokens = images * estimate_image_tokens(768, 1024)
+    return text_chars // 4 + image_tokens + int(payload.get("max_tokens", 0))
+
+
+class JobQueue:
+    """
+    Cola FIFO de reportes compartida por todas las sesiones. Corren hasta
+    `max_running` a la vez; los demás esperan y ven su posición y un ETA
+    calculado con los segundos por página de las corridas anteriores.
+    """
+
+    def __init__(self, max_running: int = MAX_CONCURRENT_JOBS):
+        self.max_running = max(1, max_running)
+        self.seconds_per_page = DEFAULT_SECONDS_PER_PAGE
+        self._tickets = []
+        self._next_id = 0
+        self._cond = threading.Condition()
+
+    def _estimate(self, ticket: dict, now: float) -> float:
+        expected = ticket["n_pages"] * self.seconds_per_page
+        if ticket.get("started") is not None:
+            return max(0.0, expected - (now - ticket["started"]))
+        return expected
+
+    def status(self, ticket: dict) -> tuple:
+        """(posición, segundos estimados de espera); posición 0 = corriendo."""
+        with self._cond:
+            index = self._tickets.index(ticket)
+            if index < self.max_running:
+                return 0, 0.0
+            now = time.monotonic()
+            ahead = sum(self._estimate(t, now) for t in self._tickets[:index])
+            return index - self.max_running + 1, ahead / self.max_running
+
+    @contextmanager
+    def slot(self, n_pages: int, on_wait=None, poll_s: float = 1.0):
+        """
+        Espera turno y corre el bloque. on_wait(posición, eta_s) se llama
+        mientras espera, para mostrarlo en la UI.
+        """
+        with self._cond:
+            # El id evita que dos tickets con las mismas páginas se confundan
+            self._next_id += 1
+            ticket = {"id": self._next_id, "n_pages": max(1, n_pages), "started": None}
+            self._tickets.append(ticket)
+        try:
+            with self._cond:
+                while self._tickets.index(ticket) >= self.max_running:
+                    self._cond.release()
+                    try:
+                        if on_wait is not None:
+                            on_wait(*self.status(ticket))
+                    finally:
+                        self._cond.acquire()
+                    self._cond.wait(timeout=poll_s)
+                ticket["started"] = time.monotonic()
+            yield ticket
+        finally:
+            with self._cond:
+                if ticket.get("started") is not None:
+                    elapsed = time.monotonic() - ticket["started"]
+                    per_page = elapsed / ticket["n_pages"]
+                    self.seconds_per_page = 0.7 * self.seconds_per_page + 0.3 * per_page
+                self._tickets.remove(ticket)
+                self._cond.notify_all()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._tickets)
+
+
+JOB_QUEUE = JobQueue()
+
+
+def post_chat_completion(
+    payload: dict,
+    api_key: str,
+    timeout: float,
+    retry_budget: float = OPENAI_RETRY_BUDGET_S,
+    metrics: dict = None,
+    est_tokens: int = None,
+) -> dict:
+    """
+    POST a /v1/chat/completions por el transporte activo (la sesión
+    compartida, o las respuestas grabadas en modo replay). Reintenta 429, 5xx
+    y errores de red con backoff exponencial + jitter, respetando Retry-After.
+    En `metrics` deja intentos, latencia del último intento, latencia total,
+    la espera en el limitador compartido y el bloque `usage` de la respuesta.
+    Un 200 que no trae choices[0].message.content como texto también es
+    OpenAIRequestError: quien llama puede leer el contenido sin chequearlo.
+    """
+    transport = get_openai_transport()
+    limiter = None if transport.offline else get_rate_limiter()
+    if est_tokens is None:
+        est_tokens = estimate_request_tokens(payload)
+    rate_wait = 0.0
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+    started = time.monotonic()
+    waited = 0.0
+    attempt = 0
+
+    while True:
+        attempt += 1
+        if limiter is not None:
+            rate_wait += limiter.acquire(est_tokens)
+        t0 = time.monotonic()
+        response = None
+        try:
+            response = transport.post(payload, headers, timeout, attempt)
+            status, error = response.status_code, ""
+        except (requests.ConnectionError, requests.Timeout) as e:
+            status, error = None, str(e)
+
+        if metrics is not None:
+            metrics["attempts"] = attempt
+            metrics["latency_s"] = round(time.monotonic() - t0, 3)
+            metrics["total_latency_s"] = round(time.monotonic() - started, 3)
+            metrics["rate_limit_wait_s"] = round(rate_wait, 3)
+
+        if status == 200:
+            # Un 200 sin JSON o sin texto en choices no se arregla reintentando
+            try:
+                data = response.json()
+                content = data["choices"][0]["message"]["content"]
+            except (ValueError, KeyError, IndexError, TypeError) as e:
+                raise OpenAIRequestError(
+                    f"200 — respuesta inválida ({type(e).__name__})", status_code=status, attempts=attempt
+                ) from e
+            if not isinstance(content, str):
+                raise OpenAIRequestError("200 — respuesta sin texto", status_code=status, attempts=attempt)
+            if metrics is not None:
+                metrics["usage"] = data.get("usage") or {}
+            return data
+
+        retryable = status is None or status in _RETRY_STATUS
+        if response is not None:
+            error = _response_error(response)
+            # Sin crédito no se arregla esperando
+            if status == 429 and "quota" in str(error).lower():
+                retryable = False
+
+        delay = min(OPENAI_BACKOFF_MAX_S, OPENAI_BACKOFF_BASE_S * 2 ** (attempt - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        server_delay = _server_retry_delay(response) if response is not None else None
+        if server_delay is not None:
+            delay = server_delay + random.uniform(0, 0.5)
+            if status == 429 and limiter is not None:
+                limiter.pause(server_delay)
+
+        if not retryable or attempt >= OPENAI_MAX_ATTEMPTS or waited + delay > retry_budget:
+            raise OpenAIRequestError(f"{status or 'sin respuesta'} — {error}", status_code=status, attempts=attempt)
+
+        logger.warning("OpenAI %s (intento %s), reintento en %.1fs: %s", status, attempt, delay, str(error)[:200])
+        if not transport.offline or transport.replay_latency:
+            time.sleep(delay)
+        waited += delay
+
+
+# ----------------------------------------------------------
+# CACHÉ DE PÁGINAS LEÍDAS
+# ----------------------------------------------------------
+PAGE_CACHE_PATH = os.path.join(".cache", "page_cache.sqlite3")
+
+
+def page_cache_key(img_b64: str, profile: dict = None) -> str:
+    profile = profile or RENDER_PROFILES[DEFAULT_RENDER_PROFILE]
+    h = hashlib.sha256()
+    for part in (img_b64, PROMPT, GPT_MODEL, json.dumps(profile, sort_keys=True)):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class PageCache:
+    """
+    Registros ya limpios de call_gpt_page guardados en SQLite, por hash de
+    la imagen + prompt + modelo + render. Una página igual no se paga dos veces.
+    """
+
+    def __init__(self, path: str = PAGE_CACHE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages ("
+                "key TEXT PRIMARY KEY, records TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # Una conexión por llamada: el cache se usa desde los hilos del pool
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key: str):
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT records FROM pages WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, records: list):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO pages (key, records, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(records, ensure_ascii=False), time.time()),
+            )
+
+
+def _parse_page_response(data: dict, page_num: int, label: str = None) -> list:
+    """
+    Registros limpios de la respuesta de GPT. Si no es JSON válido o se cortó
+    por max_tokens levanta PageParseError: la página queda fallida y se
+    vuelve a leer al reanudar.
+    """
+    choice = data["choices"][0]
+    raw = choice["message"]["content"].strip()
+    raw = re.sub(r"```json|```", "", raw).strip()
+    if choice.get("finish_reason") == "length":
+        # Cortada por max_tokens: aunque el JSON cierre, faltan propiedades
+        raise PageParseError(
+            f"Respuesta de {label or f'página {page_num}'} cortada por max_tokens: {raw[-200:]}", status_code=200
+        )
+
+    try:
+        parsed = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise PageParseError(
+            f"No pude parsear el JSON de {label or f'página {page_num}'}: {raw[:200]}", status_code=200
+        ) from e
+
+    if isinstance(parsed, dict) and "records" in parsed:
+        records = parsed["records"]
+    elif isinstance(parsed, list):
+        records = parsed
+    else:
+        records = []
+
+    cleaned = []
+    for r in records:
+        try:
+            page_value = int(r.get("page", page_num) or page_num)
+        except Exception:
+            page_value = page_num
+
+        try:
+            address_conf = float(r.get("address_confidence", 0) or 0)
+        except Exception:
+            address_conf = 0.0
+
+        try:
+            cleaner_conf = float(r.get("cleaner_confidence", 0) or 0)
+        except Exception:
+            cleaner_conf = 0.0
+
+        cleaned.append({
+            "address": str(r.get("address", "")).strip(),
+            "cleaner": str(r.get("cleaner", "Unassigned")).strip() or "Unassigned",
+            "page": page_value,
+            "address_confidence": address_conf,
+            "cleaner_confidence": cleaner_conf,
+            "notes": str(r.get("notes", "")).strip(),
+        })
+    return cleaned
+
+
+# Respuesta máxima de una página completa (una página trae hasta ~15 propiedades)
+PAGE_MAX_TOKENS = 1800
+
+
+def _image_part(img_b64: str, profile: dict) -> dict:
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:image/{profile['format']};base64,{img_b64}",
+            "detail": profile["detail"],
+        },
+    }
+
+
+def _post_page_request(
+    content: list,
+    label: str,
+    max_tokens: int,
+    page_log: dict = None,
+    retry_budget: float = OPENAI_RETRY_BUDGET_S,
+    api_key: str = "",
+    image_tokens: int = None,
+) -> dict:
+    """Manda la request de lectura y deja el usage desglosado en page_log."""
+    if not api_key and not get_openai_transport().offline:
+        raise ValueError("Falta la API key de OpenAI ('OPENAI_API_KEY').")
+
+    payload = {
+        "model": GPT_MODEL,
+        "temperature": 0,
+        "max_tokens": max_tokens,
+        "messages": [{"role": "user", "content": content}],
+    }
+
+    try:
+        data = post_chat_completion(
+            payload,
+            api_key,
+            timeout=90,
+            retry_budget=retry_budget,
+            metrics=page_log,
+            est_tokens=estimate_request_tokens(payload, image_tokens),
+        )
+    except OpenAIRequestError as e:
+        raise OpenAIRequestError(
+            f"Error API GPT {label}: {e}", status_code=e.status_code, attempts=e.attempts
+        ) from e
+
+    usage = data.get("usage") or {}
+    if page_log is not None:
+        # post_chat_completion deja el bloque entero; acá queda desglosado
+        page_log.pop("usage", None)
+        page_log["prompt_tokens"] = usage.get("prompt_tokens", 0)
+        page_log["completion_tokens"] = usage.get("completion_tokens", 0)
+    logger.info("GPT %s: usage=%s", label, usage)
+    return data
+
+
+def call_gpt_page(
+    img_b64: str,
+    page_num: int,
+    cache: PageCache = None,
+    profile: dict = None,
+    page_log: dict = None,
+    retry_budget: float = OPENAI_RETRY_BUDGET_S,
+    api_key: str = "",
+    max_tokens: int = PAGE_MAX_TOKENS,
+) -> list:
+    profile = profile or RENDER_PROFILES[DEFAULT_RENDER_PROFILE]
+    data = _post_page_request(
+        [_image_part(img_b64, profile), {"type": "text", "text": PROMPT}],
+        f"página {page_num}",
+        max_tokens,
+        page_log,
+        retry_budget,
+        api_key,
+        (page_log or {}).get("image_tokens_est"),
+    )
+
+    parse_started = time.perf_counter()
+    try:
+        cleaned = _parse_page_response(data, page_num)
+    finally:
+        if page_log is not None:
+            page_log["parse_s"] = round(time.perf_counter() - parse_started, 4)
+
+    if cache is not None:
+        cache.put(page_cache_key(img_b64, profile), cleaned)
+
+    return cleaned
+
+
+# ----------------------------------------------------------
+# VARIAS PÁGINAS POR REQUEST
+# ----------------------------------------------------------
+# Con 2-3 páginas consecutivas por request el PROMPT se paga una vez por
+# ventana y una dirección cortada entre dos páginas de la misma ventana sale
+# entera, sin depender de merge_cross_page_fragments. Con solapamiento la
+# última página de cada ventana es también la primera de la siguiente, así
+# ningún corte de página queda entre dos requests; a cambio esa página se
+# manda y se responde dos veces, y con 2 por request sale más caro que de a
+# una (ver benchmarks/bench_batching.py).
+DEFAULT_PAGES_PER_REQUEST = 1
+MAX_PAGES_PER_REQUEST = 3
+PAGE_BATCH_OVERLAP = False
+
+PAGE_BATCH_PROMPT = """Estas son {n} páginas consecutivas del mismo reporte (páginas {pages}).
+Antes de cada imagen va su número de página.
+
+- En "page" poné el número de la página donde EMPIEZA la propiedad.
+- Si una dirección empieza al final de una página y sigue al principio de la siguiente,
+  devolvela UNA sola vez, completa, con la página donde empieza.
+- Las instrucciones de abajo valen para cada una de las páginas.
+
+"""
+
+
+def page_batch_cache_key(pages: list) -> str:
+    h = hashlib.sha256()
+    for _, img_b64, profile, _ in pages:
+        h.update(page_cache_key(img_b64, profile).encode())
+        h.update(b"\0")
+    h.update(PAGE_BATCH_PROMPT.encode())
+    return h.hexdigest()
+
+
+def call_gpt_pages(
+    pages: list,
+    cache: PageCache = None,
+    page_log: dict = None,
+    retry_budget: float = OPENAI_RETRY_BUDGET_S,
+    api_key: str = "",
+) -> dict:
+    """
+    Lee páginas consecutivas en una sola request y devuelve {page_num: registros}.
+    `pages` es [(page_num, img_b64, profile, max_tokens)] y `page_log` el de
+    todas las páginas (stats["page_log"]); las métricas de la request quedan
+    en la entrada de la primera. Con una sola página es call_gpt_page.
+    En `cache` se guarda la ventana entera, en el orden de `pages`.
+    """
+    page_log = page_log if page_log is not None else {}
+    page_nums = [p[0] for p in pages]
+    if len(pages) == 1:
+        page_num, img_b64, profile, max_tokens = pages[0]
+        log = page_log.setdefault(page_num, {"page": page_num})
+        return {page_num: call_gpt_page(img_b64, page_num, cache, profile, log, retry_budget, api_key, max_tokens)}
+
+    content = []
+    for page_num, img_b64, profile, _ in pages:
+        content.append({"type": "text", "text": f"Página {page_num}:"})
+        content.append(_image_part(img_b64, profile))
+    batch_prompt = PAGE_BATCH_PROMPT.format(n=len(pages), pages=", ".join(map(str, page_nums)))
+    content.append({"type": "text", "text": batch_prompt + PROMPT})
+
+    image_tokens = [page_log.get(p, {}).get("image_tokens_est") for p in page_nums]
+    label = f"páginas {page_nums[0]}-{page_nums[-1]}"
+    for p in page_nums:
+        page_log.setdefault(p, {"page": p})["batch"] = label
+    log = page_log[page_nums[0]]
+    data = _post_page_request(
+        content,
+        label,
+        sum(p[3] for p in pages),
+        log,
+        retry_budget,
+        api_key,
+        None if None in image_tokens else sum(image_tokens),
+    )
+
+    parse_started = time.perf_counter()
+    try:
+        cleaned = _parse_page_response(data, page_nums[0], label)
+    finally:
+        log["parse_s"] = round(time.perf_counter() - parse_started, 4)
+
+    by_page = {p: [] for p in page_nums}
+    for r in cleaned:
+        if r["page"] not in by_page:
+            # Número de imagen (1, 2, 3) en vez de número de página
+            r["page"] = page_nums[r["page"] - 1] if 1 <= r["page"] <= len(page_nums) else page_nums[0]
+        by_page[r["page"]].append(r)
+
+    if cache is not None:
+        cache.put(page_batch_cache_key(pages), [by_page[p] for p in page_nums])
+    return by_page
+
+
+def _ends_with_fragment(address: str, fragment: str) -> bool:
+    return len(address) > len(fragment) and address.endswith(fragment) and address[-len(fragment) - 1] in " /"
+
+
+def normalize_address_tail(fragment: str) -> str:
+    """
+    Normaliza una cola de dirección como si siguiera a otra palabra: las
+    abreviaturas necesitan un espacio antes ("Street, South Brisbane" →
+    "st south brisbane", igual que dentro de la dirección entera).
+    """
+    return normalize_address("x " + fragment)[2:]
+
+
+def merge_window_overlap(earlier: dict, later: dict, page_num: int) -> list:
+    """
+    Registros de una página leída por dos ventanas seguidas: es la última de
+    `earlier` y la primera de `later`. Vale la lectura de `later`, que ve cómo
+    sigue la última propiedad en la página siguiente; su primer registro se
+    descarta si es la cola que `earlier` ya pegó al último registro de la
+    página anterior. Si una de las dos ventanas falló (None) vale la otra.
+    """
+    if later is None:
+        return (earlier or {}).get(page_num, [])
+    records = list(later.get(page_num, []))
+    if earlier is None or not records:
+        return records
+
+    previous = [r for p in sorted(earlier) if p < page_num for r in earlier[p]]
+    if previous:
+        fragment = normalize_address_tail(records[0]["address"])
+        if fragment and _ends_with_fragment(normalize_address(previous[-1]["address"]), fragment):
+            records = records[1:]
+    return records
+
+
+# ----------------------------------------------------------
+# CHECKPOINTS DE CORRIDAS (REANUDAR)
+# ----------------------------------------------------------
+JOBS_DIR = os.path.join(".cache", "jobs")
+
+
+def job_id_for(pdf_bytes: bytes) -> str:
+    return hashlib.sha256(pdf_bytes).hexdigest()[:16]
+
+
+def _write_json_atomic(path: str, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class JobCheckpoint:
+    """
+    Estado de una corrida guardado en disco, por hash del PDF: registros de
+    cada página (ok o fallida) y decisiones del tiebreak. Al reanudar solo
+    se vuelven a leer las páginas que faltan o fallaron.
+    """
+
+    def __init__(self, job_id: str, root: str = JOBS_DIR):
+        self.job_id = job_id
+        self.path = os.path.join(root, job_id)
+        self.pages_path = os.path.join(self.path, "pages")
+
+    def _ensure_dirs(self):
+        os.makedirs(self.pages_path, exist_ok=True)
+
+    def _page_file(self, page_num: int) -> str:
+        return os.path.join(self.pages_path, f"{page_num:05d}.json")
+
+    def reset(self):
+        if not os.path.isdir(self.path):
+            return
+        for name in os.listdir(self.pages_path) if os.path.isdir(self.pages_path) else []:
+            os.remove(os.path.join(self.pages_path, name))
+        for name in ("job.json", "tiebreaks.json"):
+            if os.path.exists(os.path.join(self.path, name)):
+                os.remove(os.path.join(self.path, name))
+
+    def save_meta(self, **meta):
+        self._ensure_dirs()
+        data = {**self.load_meta(), **meta, "job_id": self.job_id, "updated_at": time.time()}
+        _write_json_atomic(os.path.join(self.path, "job.json"), data)
+
+    def load_meta(self) -> dict:
+        try:
+            with open(os.path.join(self.path, "job.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_page(self, page_num: int, records: list, status: str = "ok", error: str = ""):
+        self._ensure_dirs()
+        _write_json_atomic(
+            self._page_file(page_num),
+            {"page": page_num, "status": status, "error": error, "records": records},
+        )
+
+    def load_pages(self) -> dict:
+        pages = {}
+        if not os.path.isdir(self.pages_path):
+            return pages
+        for name in sorted(os.listdir(self.pages_path)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.pages_path, name), encoding="utf-8") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            pages[data["page"]] = data
+        return pages
+
+    def ok_pages(self) -> dict:
+        return {p: d["records"] for p, d in self.load_pages().items() if d["status"] == "ok"}
+
+    def save_tiebreaks(self, decisions: dict):
+        self._ensure_dirs()
+        _write_json_atomic(os.path.join(self.path, "tiebreaks.json"), decisions)
+
+    def load_tiebreaks(self) -> dict:
+        try:
+            with open(os.path.join(self.path, "tiebreaks.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def summary(self) -> dict:
+        """Páginas guardadas/fallidas/faltantes de la última corrida, o {} si no hay."""
+        meta = self.load_meta()
+        if not meta:
+            return {}
+        pages = self.load_pages()
+        n_pages = meta.get("n_pages", 0)
+        ok = sum(1 for d in pages.values() if d["status"] == "ok")
+        failed = sum(1 for d in pages.values() if d["status"] != "ok")
+        return {
+            "n_pages": n_pages,
+            "ok": ok,
+            "failed": failed,
+            "missing": max(n_pages - ok - failed, 0),
+            "status": meta.get("status", ""),
+        }
+
+
+# ----------------------------------------------------------
+# FIX 2: FUSIONAR REGISTROS CON DIRECCIÓN CORTADA ENTRE PÁGINAS
+# ----------------------------------------------------------
+def _looks_like_address_fragment(addr: str) -> bool:
+    """
+    Devuelve True si la cadena parece un fragmento de dirección, no una dirección completa.
+    Señales: no empieza con dígito ni con patrón unit/number, o es solo suburb/estado.
+    """
+    addr = addr.strip()
+    if not addr:
+        return True
+    # Una dirección válida debe empezar con dígito (ej "1208/35") o letra+dígito (ej "A1/35")
+    if re.match(r"^[A-Za-z]?\d", addr):
+        return False
+    # Si empieza con letra pura, es un fragmento (ej "City Q 4000", "Street, South Brisbane...")
+    return True
+
+
+def merge_cross_page_fragments(records: list) -> list:
+    """
+    Detecta registros cuya dirección es un fragmento (no empieza con número)
+    y los fusiona con el registro anterior, que probablemente tenía la dirección cortada.
+    """
+    if not records:
+        return records
+
+    merged = []
+    i = 0
+    while i < len(records):
+        rec = records[i]
+        addr = rec.get("address", "").strip()
+
+        # Si este registro es un fragmento Y hay un registro anterior en merged
+        if _looks_like_address_fragment(addr) and merged:
+            prev = merged[-1]
+            prev_addr = prev.get("address", "").strip()
+
+            # Solo fusionar si están en páginas consecutivas
+            if rec.get("page", 0) == prev.get("page", 0) + 1:
+                fused_address = (prev_addr + " " + addr).strip()
+                prev["address"] = fused_address
+                prev["address_confidence"] = min(
+                    prev.get("address_confidence", 1.0),
+                    rec.get("address_confidence", 1.0),
+                )
+                prev["notes"] = (
+                    (prev.get("notes", "") + " [dirección fusionada entre páginas]").strip()
+                )
+                # Si el registro anterior no tenía cleaner pero este sí, usarlo
+                if prev.get("cleaner", "Unassigned") == "Unassigned" and rec.get("cleaner", "Unassigned") != "Unassigned":
+                    prev["cleaner"] = rec["cleaner"]
+                i += 1
+                continue
+
+        merged.append(rec)
+        i += 1
+
+    return merged
+
+
+class NullProgress:
+    """Reemplazo de st.progress cuando no hay UI (CLI, benchmarks)."""
+
+    def progress(self, value: float, text: str = None):
+        pass
+
+
+# Cuántas páginas se mandan a GPT al mismo tiempo. Cada página es una llamada
+# independiente, así que el límite real lo pone el rate limit de OpenAI.
+DEFAULT_PAGE_CONCURRENCY = 4
+MAX_PAGE_CONCURRENCY = 8
+
+
+def iter_pdf_pages(
+    pdf_bytes: bytes,
+    profile: dict = None,
+    use_text_layer: bool = True,
+    stats: dict = None,
+    skip_pages: set = None,
+    use_prefilter: bool = True,
+):
+    """
+    Recorre el PDF de a una página y produce (page_num, img_b64, text_result).
+    La imagen se renderiza recién cuando se pide la página, y solo si la capa
+    de texto no alcanzó la confianza mínima (en ese caso img_b64 es None).
+    Las páginas de `skip_pages` (ya resueltas) salen como (page_num, None, None).
+    Con use_prefilter=True cada página pasa antes por classify_page: las
+    "skip" salen sin imagen y con text_result["prefilter"] == "skip", y las
+    "fragment" se renderizan con PREFILTER_FRAGMENT_PROFILE y llevan
+    text_result["prefilter"] == "fragment".
+    """
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError("Falta PyMuPDF. Agregá 'pymupdf' a requirements.txt")
+
+    profile = profile or RENDER_PROFILES[DEFAULT_RENDER_PROFILE]
+    stats = stats if stats is not None else {}
+    page_log = stats.setdefault("page_log", {})
+    text_log = stats.setdefault("text_layer_confidence", [])
+    class_log = stats.setdefault("page_classes", [])
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        for i, page in enumerate(doc):
+            page_num = i + 1
+            if skip_pages and page_num in skip_pages:
+                yield page_num, None, None
+                continue
+
+            kind = "full"
+            if use_prefilter:
+                with perf_stage(stats, "prefilter"):
+                    page_class = classify_page(page)
+                class_log.append({"page": page_num, **page_class})
+                kind = page_class["kind"]
+                if kind == "skip":
+                    yield page_num, None, {"page": page_num, "records": [], "confidence": 1.0, "prefilter": "skip"}
+                    continue
+
+            text_result = None
+            if use_text_layer:
+                with perf_stage(stats, "text_layer"):
+                    text_result = parse_text_layer_page(page, page_num)
+            if text_result is not None:
+                text_log.append({
+                    "page": page_num,
+                    "confidence": text_result["confidence"],
+                    "records": len(text_result["records"]),
+                    "path": "texto" if text_result["confidence"] >= TEXT_LAYER_MIN_CONFIDENCE else "visión",
+                })
+                if text_result["confidence"] >= TEXT_LAYER_MIN_CONFIDENCE:
+                    yield page_num, None, text_result
+                    continue
+
+            page_profile = profile
+            if kind == "fragment":
+                page_profile = RENDER_PROFILES[PREFILTER_FRAGMENT_PROFILE]
+                text_result = {
+                    **(text_result or {"page": page_num, "records": [], "confidence": 0.0}),
+                    "prefilter": "fragment",
+                }
+            with perf_stage(stats, "render"):
+                img_b64 = _render_page_b64(page, page_num, page_profile, page_log)
+            yield page_num, img_b64, text_result
+    finally:
+        doc.close()
+
+
+def iter_page_records(
+    pages,
+    n_pages: int,
+    progress_bar,
+    max_workers: int = DEFAULT_PAGE_CONCURRENCY,
+    cache: PageCache = None,
+    stats: dict = None,
+    profile: dict = None,
+    retry_budget: float = OPENAI_RETRY_BUDGET_S,
+    saved_pages: dict = None,
+    checkpoint: JobCheckpoint = None,
+    api_key: str = "",
+    pages_per_request: int = DEFAULT_PAGES_PER_REQUEST,
+    batch_overlap: bool = PAGE_BATCH_OVERLAP,
+):
+    """
+    Consume (page_num, img_b64, text_result) y produce (page_num, records) en
+    orden de página. Se piden páginas nuevas a `pages` solo cuando hay lugar
+    en el pool, así nunca hay más de `max_workers` requests esperando a GPT.
+    Una página que agota los reintentos, o cuya respuesta no se puede leer,
+    queda en stats["failed_pages"] y sale sin registros, en vez de cortar
+    todo el reporte; en el checkpoint queda "failed" y se relee al reanudar.
+    Las de respuesta ilegible también quedan en stats["unparsed_pages"].
+    Las páginas de `saved_pages` se toman tal cual; cada página resuelta se
+    guarda en `checkpoint`. Las que el pre-filtro marcó "skip" salen sin
+    registros y las "fragment" se leen con el render y la respuesta chicos.
+    Con pages_per_request > 1 las páginas de visión consecutivas se juntan en
+    ventanas (call_gpt_pages); con batch_overlap las ventanas comparten una
+    página y merge_window_overlap decide sus registros.
+    """
+    stats = stats if stats is not None else {}
+    page_log = stats.setdefault("page_log", {})
+    failed_pages = stats.setdefault("failed_pages", [])
+    unparsed_pages = stats.setdefault("unparsed_pages", [])
+    saved_pages = saved_pages or {}
+    for key in (
+        "cache_hits", "gpt_pages", "gpt_requests", "text_layer_pages",
+        "resumed_pages", "skipped_pages", "fragment_pages",
+    ):
+        stats.setdefault(key, 0)
+    stats["pages"] = n_pages
+
+    profile = profile or RENDER_PROFILES[DEFAULT_RENDER_PROFILE]
+    max_workers = max(1, min(int(max_workers or 1), MAX_PAGE_CONCURRENCY))
+    pages_per_request = max(1, min(int(pages_per_request or 1), MAX_PAGES_PER_REQUEST))
+    batch_overlap = batch_overlap and pages_per_request > 1
+
+    source = iter(pages)
+    exhausted = False
+    in_flight = {}
+    ready = {}
+    next_page = 1
+    done = 0
+
+    # Ventanas: cada página de visión se lee en una o dos (si es la compartida)
+    window = []
+    carried = None
+    reads = defaultdict(list)
+    results = {}
+    errors = {}
+
+    def resolve(page_num: int):
+        keys = reads[page_num]
+        if page_num == carried or any(k not in results for k in keys):
+            return
+        if all(results[k] is None for k in keys):
+            error = str(errors[keys[-1]])
+            logger.error("Página %s fallida: %s", page_num, error)
+            failed_pages.append({"page": page_num, "error": error})
+            if isinstance(errors[keys[-1]], PageParseError):
+                # GPT respondió pero no se pudo leer: se avisa aparte en la app
+                unparsed_pages.append({"page": page_num, "error": error})
+            ready[page_num] = []
+            if checkpoint is not None:
+                checkpoint.save_page(page_num, [], status="failed", error=error)
+            return
+        if len(keys) == 1:
+            ready[page_num] = results[keys[0]][page_num]
+        else:
+            ready[page_num] = merge_window_overlap(results[keys[0]], results[keys[1]], page_num)
+        if checkpoint is not None:
+            checkpoint.save_page(page_num, ready[page_num])
+
+    def submit(window_pages: list):
+        key = tuple(p[0] for p in window_pages)
+        for page_num in key:
+            reads[page_num].append(key)
+        new_pages = sum(1 for page_num in key if len(reads[page_num]) == 1)
+
+        cached = None
+        if cache is not None and len(window_pages) > 1:
+            cached = cache.get(page_batch_cache_key(window_pages))
+        if cached is not None:
+            results[key] = {
+                page_num: [{**r, "page": page_num} for r in records]
+                for page_num, records in zip(key, cached)
+            }
+            stats["cache_hits"] += new_pages
+            for page_num in key:
+                resolve(page_num)
+            return
+
+        stats["gpt_pages"] += new_pages
+        stats["gpt_requests"] += 1
+        future = pool.submit(call_gpt_pages, window_pages, cache, page_log, retry_budget, api_key)
+        in_flight[future] = key
+
+    def flush(full: bool = False):
+        nonlocal window, carried
+        released, carried = carried, None
+        if len(window) > (released is not None):
+            submit(window)
+            if full and batch_overlap:
+                carried, window = window[-1][0], window[-1:]
+                return
+        elif released is not None:
+            # No vino otra ventana: vale la lectura que ya tiene
+            resolve(released)
+        window = []
+
+    progress_bar = progress_bar or NullProgress()
+    progress_bar.progress(0.08, text=f"Leyendo {n_pages} páginas ({max_workers} en paralelo)...")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        try:
+            while True:
+                while not exhausted and len(in_flight) < max_workers:
+                    try:
+                        page_num, img, text_result = next(source)
+                    except StopIteration:
+                        exhausted = True
+                        flush()
+                        break
+
+                    prefilter = (text_result or {}).get("prefilter")
+                    local = None
+                    if page_num in saved_pages:
+                        local, counter = saved_pages[page_num], "resumed_pages"
+                    elif prefilter == "skip":
+                        local, counter = [], "skipped_pages"
+                    elif text_result is not None and text_result["confidence"] >= TEXT_LAYER_MIN_CONFIDENCE:
+                        local, counter = text_result["records"], "text_layer_pages"
+                    else:
+                        page_profile, max_tokens = profile, PAGE_MAX_TOKENS
+                        if prefilter == "fragment":
+                            page_profile = RENDER_PROFILES[PREFILTER_FRAGMENT_PROFILE]
+                            max_tokens = PREFILTER_FRAGMENT_MAX_TOKENS
+                            stats["fragment_pages"] += 1
+                        cached = cache.get(page_cache_key(img, page_profile)) if cache is not None else None
+                        if cached is not None:
+                            local, counter = cached, "cache_hits"
+
+                    if local is not None:
+                        # Una página que no va a GPT corta la ventana en curso
+                        flush()
+                        ready[page_num] = local
+                        stats[counter] += 1
+                        if checkpoint is not None and counter != "resumed_pages":
+                            checkpoint.save_page(page_num, local)
+                        continue
+
+                    if window and window[-1][0] != page_num - 1:
+                        flush()
+                    window.append((page_num, img, page_profile, max_tokens))
+                    if len(window) == pages_per_request:
+                        flush(full=True)
+
+                while next_page in ready:
+                    done += 1
+                    pct = 0.08 + (0.80 * (done / max(n_pages, 1)))
+                    progress_bar.progress(min(pct, 0.88), text=f"Página {next_page} lista ({done} de {n_pages})...")
+                    yield next_page, ready.pop(next_page)
+                    next_page += 1
+
+                if not in_flight:
+                    if exhausted:
+                        break
+                    continue
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    key = in_flight.pop(future)
+                    log = page_log.get(key[0], {})
+                    record_perf(stats, "gpt_page", log.get("total_latency_s", 0.0), usage=log)
+                    if "parse_s" in log:
+                        record_perf(stats, "parse", log["parse_s"])
+                    try:
+                        results[key] = future.result()
+                    except OpenAIRequestError as e:
+                        results[key] = None
+                        errors[key] = e
+                    for page_num in key:
+                        resolve(page_num)
+        except BaseException:
+            for future in in_flight:
+                future.cancel()
+            raise
+
+    # Páginas con numeración salteada (no debería pasar con PyMuPDF)
+    for page_num in sorted(ready):
+        yield page_num, ready[page_num]
+
+
+def iter_merged_records(page_records, stats: dict = None):
+    """
+    Aplica merge_cross_page_fragments a medida que llegan las páginas.
+    Un fragmento solo se pega al último registro de la página anterior, así
+    que todo menos ese último registro ya es definitivo y se puede emitir.
+    """
+    held = []
+    for _, records in page_records:
+        with perf_stage(stats, "merge"):
+            merged = merge_cross_page_fragments(held + list(records))
+        held = merged[-1:]
+        if len(merged) > 1:
+            yield merged[:-1]
+    if held:
+        yield held
+
+
+def extract_all_pages(
+    images: list,
+    progress_bar,
+    max_workers: int = DEFAULT_PAGE_CONCURRENCY,
+    cache: PageCache = None,
+    stats: dict = None,
+    text_pages: list = None,
+    profile: dict = None,
+    retry_budget: float = OPENAI_RETRY_BUDGET_S,
+    api_key: str = "",
+) -> list:
+    """
+    Lee todas las páginas ya renderizadas y devuelve los registros fusionados.
+    Las páginas que ya están en `cache`, o que `text_pages` leyó con
+    suficiente confianza desde la capa de texto, no se mandan a la API.
+    """
+    pages = [
+        (i + 1, img, text_pages[i] if text_pages else None)
+        for i, img in enumerate(images)
+    ]
+    page_records = iter_page_records(
+        pages,
+        len(images),
+        progress_bar,
+        max_workers=max_workers,
+        cache=cache,
+        stats=stats,
+        profile=profile,
+        retry_budget=retry_budget,
+        api_key=api_key,
+    )
+
+    all_records = []
+    for records in iter_merged_records(page_records):
+        all_records.extend(records)
+    return all_records
+
+
+# ----------------------------------------------------------
+# GPT TIEBREAKER
+# ----------------------------------------------------------
+# Casos ambiguos por request: suficientes para que un día cargado salga en
+# una o dos llamadas, sin que la respuesta se acerque al límite de tokens.
+TIEBREAK_BATCH_SIZE = 20
+
+
+def _tiebreak_fallback(reason: str, failed: bool = False) -> dict:
+    decision = {"selected_address": "", "confidence": 0, "reason": reason}
+    if failed:
+        # Error de transporte o de formato: no se guarda, se reintenta al reanudar
+        decision["failed"] = True
+    return decision
+
+
+def _resolve_tiebreak_chunk(chunk: list, api_key: str, stats: dict = None) -> dict:
+    cases = [
+        {"id": item["id"], "pdf_address": item["pdf_address"], "candidates": item["candidates"]}
+        for item in chunk
+    ]
+
+    prompt = f"""
+Para cada caso debes elegir el mejor match entre una dirección extraída de un PDF y hasta 3 candidatos del Key Register.
+La dirección elegida tiene que ser exactamente una de las de "candidates" de ese caso, o vacío si ninguna corresponde.
+
+Casos:
+{json.dumps(cases, ensure_ascii=False, indent=2)}
+
+Responde SOLO JSON válido, con un resultado por cada id:
+{{
+  "results": [
+    {{
+      "id": 0,
+      "selected_address": "dirección elegida o vacío",
+      "confidence": 0.0,
+      "reason": "motivo breve"
+    }}
+  ]
+}}
+"""
+
+    metrics = {}
+    try:
+        data = post_chat_completion(
+            {
+                "model": GPT_MODEL,
+                "temperature": 0,
+                "max_tokens": min(200 + 100 * len(chunk), 4000),
+                "messages": [{"role": "user", "content": prompt}],
+            },
+            api_key,
+            timeout=60 + 5 * len(chunk),
+            metrics=metrics,
+        )
+    except OpenAIRequestError as e:
+        record_perf(stats, "tiebreak", metrics.get("total_latency_s", 0.0))
+        return {item["id"]: _tiebreak_fallback(str(e)[:200], failed=True) for item in chunk}
+    record_perf(stats, "tiebreak", metrics["total_latency_s"], usage=metrics.get("usage"))
+    logger.info("Tiebreak de %s casos: %.1fs en %s intento(s)", len(chunk), metrics["total_latency_s"], metrics["attempts"])
+
+    raw = data["choices"][0]["message"]["content"].strip()
+    raw = re.sub(r"```json|```", "", raw).strip()
+
+    try:
+        parsed = json.loads(raw)
+    except Exception:
+        return {item["id"]: _tiebreak_fallback("JSON inválido", failed=True) for item in chunk}
+
+    results = parsed.get("results", []) if isinstance(parsed, dict) else parsed
+    if not isinstance(results, list):
+        results = []
+
+    ids = {str(item["id"]): item["id"] for item in chunk}
+    decisions = {}
+    for r in results:
+        if not isinstance(r, dict) or str(r.get("id")) not in ids:
+            continue
+        decisions[ids[str(r.get("id"))]] = r
+
+    for item in chunk:
+        decisions.setdefault(item["id"], _tiebreak_fallback("GPT no devolvió este caso", failed=True))
+
+    return decisions
+
+
+def resolve_matches_with_gpt(items: list, api_key: str, stats: dict = None) -> dict:
+    """
+    Resuelve varios casos ambiguos en pocas llamadas.
+    items: [{"id", "pdf_address", "candidates": [{"address", "score"}, ...]}]
+    Devuelve {id: {"selected_address", "confidence", "reason"}}.
+    """
+    if not api_key and not get_openai_transport().offline:
+        return {item["id"]: _tiebreak_fallback("No API key") for item in items}
+
+    decisions = {}
+    for start in range(0, len(items), TIEBREAK_BATCH_SIZE):
+        decisions.update(_resolve_tiebreak_chunk(items[start:start + TIEBREAK_BATCH_SIZE], api_key, stats))
+    return decisions
+
+
+def resolve_match_with_gpt(pdf_address: str, candidates: list, api_key: str) -> dict:
+    item = {"id": 0, "pdf_address": pdf_address, "candidates": candidates}
+    return resolve_matches_with_gpt([item], api_key)[0]
+
+
+# ----------------------------------------------------------
+# ALIAS DE DIRECCIONES CONFIRMADAS
+# ----------------------------------------------------------
+# Resly escribe las mismas propiedades igual todos los días: una dirección
+# PDF (normalizada) ya confirmada va directo a su dirección del register,
+# sin scoring ni tiebreak.
+ALIAS_STORE_PATH = os.path.join(".cache", "aliases.sqlite3")
+# Resultados que se aprenden solos; "manual" viene de resolver Review_Needed
+ALIAS_LEARN_METHODS = ("rule_auto", "gpt_tiebreak")
+# Un tiebreak con menos confianza que esto no se aprende
+ALIAS_MIN_TIEBREAK_CONFIDENCE = 0.7
+
+
+class AliasStore:
+    """
+    Alias en SQLite: dirección PDF normalizada → Property Address del Key
+    Register, con su origen (rule_auto, gpt_tiebreak o manual) y cuántas
+    veces se usó. Los aprendidos solos nunca pisan uno manual. Un alias cuya
+    dirección ya no está en el register se borra (al usarlo o con prune).
+    """
+
+    def __init__(self, path: str = ALIAS_STORE_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS aliases ("
+                "pdf_key TEXT PRIMARY KEY, address TEXT NOT NULL, source TEXT NOT NULL, "
+                "hits INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def lookup(self, keys: list) -> dict:
+        """{pdf_key: {"address", "source"}} de las claves que tienen alias."""
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        with closing(self._connect()) as conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT pdf_key, address, source FROM aliases WHERE pdf_key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update({key: {"address": address, "source": source} for key, address, source in rows})
+        return found
+
+    def learn(self, entries: list):
+        """entries: [(pdf_key, address, source)]."""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT INTO aliases (pdf_key, address, source, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(pdf_key) DO UPDATE SET address = excluded.address, source = excluded.source, "
+                "updated_at = excluded.updated_at "
+                "WHERE excluded.source = 'manual' OR aliases.source != 'manual'",
+                [(key, address, source, now) for key, address, source in entries if key and address],
+            )
+
+    def learn_manual(self, resolutions: dict, key_index: KeyRegisterIndex) -> int:
+        """
+        {dirección PDF: Property Address elegida a mano} de casos de revisión.
+        Solo guarda direcciones que existen en el register; devuelve cuántas.
+        """
+        entries = [
+            (normalize_address(pdf_address), address, "manual")
+            for pdf_address, address in resolutions.items()
+            if address and len(key_index.rows_for_address(address))
+        ]
+        self.learn(entries)
+        return len(entries)
+
+    def record_hits(self, keys: list):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("UPDATE aliases SET hits = hits + 1 WHERE pdf_key = ?", [(k,) for k in keys])
+
+    def forget(self, keys: list):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM aliases WHERE pdf_key = ?", [(k,) for k in keys])
+
+    def prune(self, key_index: KeyRegisterIndex) -> int:
+        """Borra los alias que apuntan a direcciones que ya no están en el register."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT pdf_key, address FROM aliases").fetchall()
+        stale = [key for key, address in rows if not len(key_index.rows_for_address(address))]
+        if stale:
+            self.forget(stale)
+            logger.info("Alias vencidos (la dirección ya no está en el register): %s", len(stale))
+        return len(stale)
+
+    def __len__(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM aliases").fetchone()[0]
+
+
+def _alias_match(pdf_addr: str, address: str, key_index: KeyRegisterIndex):
+    """Resultado con Match Method "alias", o None si la dirección ya no está en el register."""
+    rows = key_index.rows_for_address(address)
+    if not len(rows):
+        return None
+    # Mismo score que daría top_k, para que la columna sea comparable
+    fixed = fix_ocr_digits(pdf_addr)
+    score = key_index.score_rows(extract_address_parts(fixed), simplify_address_15chars(fixed), rows[:1])[0]
+    return {
+        "Matched Address": key_index.addresses[rows[0]],
+        "Matched Tag": key_index.rows[rows[0]].get("Tag", ""),
+        "Match Score": float(score),
+        "Match Method": "alias",
+        "Llave M": get_m_keys_for_address(address, key_index),
+    }
+
+
+# ----------------------------------------------------------
+# BUILD MATCHES
+# ----------------------------------------------------------
+def _tiebreak_key(item: dict) -> str:
+    return json.dumps([item["pdf_address"], [c["address"] for c in item["candidates"]]], ensure_ascii=False)
+
+
+def _resolve_match(best: dict, top3: list, gpt_decision: dict, key_index: KeyRegisterIndex) -> dict:
+    """Resultado de una dirección: match final (con sus llaves M) o motivo de revisión."""
+    final_address = ""
+    final_tag = ""
+    match_score = 0
+    match_method = "none"
+    review_reason = ""
+
+    if best is not None:
+        match_score = float(best["score"])
+
+        if match_score >= 75:
+            final_address = best["Property Address"]
+            final_tag = best["Tag"]
+            match_method = "rule_auto"
+
+        elif match_score >= 55:
+            gpt_decision = gpt_decision or _tiebreak_fallback("No selection")
+            selected = str(gpt_decision.get("selected_address", "")).strip()
+
+            if selected:
+                chosen = next((c for c in top3 if c["Property Address"] == selected), None)
+                if chosen:
+                    final_address = chosen["Property Address"]
+                    final_tag = chosen["Tag"]
+                    match_score = chosen["score"]
+                    match_method = "gpt_tiebreak"
+                else:
+                    review_reason = f"GPT eligió dirección fuera del top3: {selected}"
+            else:
+                review_reason = str(gpt_decision.get("reason", "No selection"))
+
+        else:
+            review_reason = "Low score"
+
+    if final_address:
+        return {
+            "Matched Address": final_address,
+            "Matched Tag": final_tag,
+            "Match Score": match_score,
+            "Match Method": match_method,
+            "Llave M": get_m_keys_for_address(final_address, key_index),
+        }
+
+    top_candidates_str = " | ".join(
+        [f"{c['Property Address']} ({c['score']})" for c in top3]
+    ) if top3 else ""
+    return {
+        "Top Candidates": top_candidates_str,
+        "Review Reason": review_reason or "No match found",
+    }
+
+
+class MatchSession:
+    """
+    Matching de una corrida que llega de a pedazos (una o pocas páginas por
+    vez). Cada dirección distinta (normalizada) se resuelve una sola vez: la
+    misma propiedad suele aparecer varias veces en el día (depart + service,
+    dos encargados) y todas sus filas comparten match, tiebreak y llaves M.
+    add() puntúa lo nuevo y devuelve las filas que ya tienen match, para ir
+    mostrándolas; las ambiguas (55-75) esperan a finish(), que las manda a
+    GPT todas juntas en lotes de TIEBREAK_BATCH_SIZE y arma Matched_Debug y
+    Review_Needed con una fila por fila del PDF.
+    `tiebreak_cache` (dirección PDF + candidatos → decisión) evita volver a
+    preguntarle a GPT lo mismo al reanudar una corrida; se actualiza en el lugar.
+    Con `stats`, el tiempo queda repartido entre "matching" y "tiebreak".
+    Con `aliases`, las direcciones ya confirmadas salen de ahí (Match Method
+    "alias") y los matches nuevos seguros se guardan para la próxima.
+    """
+
+    def __init__(
+        self,
+        key_index: KeyRegisterIndex,
+        tiebreak_cache: dict = None,
+        api_key: str = "",
+        stats: dict = None,
+        aliases: AliasStore = None,
+    ):
+        self.key_index = key_index
+        self.tiebreak_cache = tiebreak_cache
+        self.api_key = api_key
+        self.stats = stats
+        self.aliases = aliases
+        # Dirección normalizada → grupo, para toda la corrida: una propiedad
+        # que se repite en páginas siguientes reusa el resultado de la primera
+        self.groups = {}
+        self.keys = []
+        self.addresses = []
+        self.scored = []
+        self.resolved = []
+        self.rows = []
+        self.tiebreak_items = []
+        self.learned = []
+
+    def _learn(self, group: int, decision: dict = None):
+        result = self.resolved[group]
+        method = result.get("Match Method")
+        if method not in ALIAS_LEARN_METHODS:
+            return
+        if method == "gpt_tiebreak":
+            try:
+                confidence = float(decision.get("confidence", 0) or 0)
+            except Exception:
+                confidence = 0.0
+            if confidence < ALIAS_MIN_TIEBREAK_CONFIDENCE:
+                return
+        self.learned.append((self.keys[group], result["Matched Address"], method))
+
+    def add(self, df_pdf: pd.DataFrame) -> pd.DataFrame:
+        """Suma filas del PDF y devuelve las que ya quedaron con match."""
+        # 1) Agrupar por dirección normalizada; la primera aparición representa al grupo
+        started = time.perf_counter()
+        pdf_rows = df_pdf.to_dict("records")
+        new_groups = []
+        first_row = len(self.rows)
+        for pdf_row in pdf_rows:
+            pdf_addr = str(pdf_row["Property Nickname"])
+            key = normalize_address(pdf_addr)
+            group = self.groups.get(key)
+            if group is None:
+                group = self.groups[key] = len(self.keys)
+                self.keys.append(key)
+                self.addresses.append(pdf_addr)
+                self.scored.append((None, []))
+                self.resolved.append(None)
+                new_groups.append(group)
+            self.rows.append((pdf_row, group))
+
+        # 2) Alias conocidos; los que apuntan a direcciones borradas se descartan
+        if self.aliases is not None and new_groups:
+            stale = []
+            alias_keys = []
+            for key, alias in self.aliases.lookup([self.keys[g] for g in new_groups]).items():
+                group = self.groups[key]
+                self.resolved[group] = _alias_match(self.addresses[group], alias["address"], self.key_index)
+                if self.resolved[group] is None:
+                    stale.append(key)
+                else:
+                    alias_keys.append(key)
+            if stale:
+                self.aliases.forget(stale)
+            if alias_keys:
+                self.aliases.record_hits(alias_keys)
+            if self.stats is not None:
+                self.stats["alias_hits"] = self.stats.get("alias_hits", 0) + len(alias_keys)
+
+        # 3) Scoring del resto; las ambiguas (55-75) se juntan para GPT
+        for group in new_groups:
+            if self.resolved[group] is not None:
+                continue
+            pdf_addr = self.addresses[group]
+            best, top3 = find_best_match(pdf_addr, self.key_index)
+            self.scored[group] = (best, top3)
+
+            if best is not None and 55 <= float(best["score"]) < 75:
+                self.tiebreak_items.append({
+                    "id": group,
+                    "pdf_address": pdf_addr,
+                    "candidates": [{"address": c["Property Address"], "score": c["score"]} for c in top3],
+                })
+                continue
+            self.resolved[group] = _resolve_match(best, top3, None, self.key_index)
+            self._learn(group)
+
+        if self.stats is not None:
+            self.stats["match_rows"] = self.stats.get("match_rows", 0) + len(pdf_rows)
+            self.stats["match_addresses"] = self.stats.get("match_addresses", 0) + len(new_groups)
+
+        matched_rows = [
+            {**pdf_row, **self.resolved[group]}
+            for pdf_row, group in self.rows[first_row:]
+            if self.resolved[group] is not None and "Matched Address" in self.resolved[group]
+        ]
+        record_perf(self.stats, "matching", time.perf_counter() - started)
+        return pd.DataFrame(matched_rows)
+
+    def finish(self):
+        """Tiebreak en lote de todas las ambiguas y (matched_df, review_df) de la corrida."""
+        # 4) Un solo tiebreak en lote (o pocos, si hay muchos casos)
+        gpt_decisions = {}
+        if self.tiebreak_cache is not None:
+            for item in self.tiebreak_items:
+                if _tiebreak_key(item) in self.tiebreak_cache:
+                    gpt_decisions[item["id"]] = self.tiebreak_cache[_tiebreak_key(item)]
+        pending_items = [item for item in self.tiebreak_items if item["id"] not in gpt_decisions]
+
+        if pending_items:
+            new_decisions = resolve_matches_with_gpt(pending_items, self.api_key, self.stats)
+            gpt_decisions.update(new_decisions)
+            if self.tiebreak_cache is not None:
+                for item in pending_items:
+                    decision = new_decisions.get(item["id"], {})
+                    if decision and not decision.get("failed"):
+                        self.tiebreak_cache[_tiebreak_key(item)] = decision
+
+        # 5) Resolver las ambiguas y copiar cada resultado a todas sus filas
+        started = time.perf_counter()
+        for item in self.tiebreak_items:
+            group = item["id"]
+            best, top3 = self.scored[group]
+            decision = gpt_decisions.get(group)
+            self.resolved[group] = _resolve_match(best, top3, decision, self.key_index)
+            self._learn(group, decision)
+        self.tiebreak_items = []
+        if self.aliases is not None and self.learned:
+            self.aliases.learn(self.learned)
+        self.learned = []
+
+        matched_rows = []
+        review_rows = []
+        for pdf_row, group in self.rows:
+            result = self.resolved[group]
+            if "Matched Address" in result:
+                matched_rows.append({**pdf_row, **result})
+            else:
+                review_rows.append({**pdf_row, **result})
+
+        matched_df = pd.DataFrame(matched_rows)
+        review_df = pd.DataFrame(review_rows)
+        record_perf(self.stats, "matching", time.perf_counter() - started, calls=0)
+
+        return matched_df, review_df
+
+
+def build_matches(
+    df_pdf: pd.DataFrame,
+    key_index: KeyRegisterIndex,
+    tiebreak_cache: dict = None,
+    api_key: str = "",
+    stats: dict = None,
+    aliases: AliasStore = None,
+):
+    """Matching de un DataFrame completo de una vez (ver MatchSession)."""
+    session = MatchSession(key_index, tiebreak_cache, api_key, stats, aliases)
+    session.add(df_pdf)
+    return session.finish()
+
+# ----------------------------------------------------------
+# GENERAR EXCEL
+# ----------------------------------------------------------
+def records_to_dataframe(records: list) -> pd.DataFrame:
+    df_pdf = pd.DataFrame(records)
+    if df_pdf.empty:
+        return df_pdf
+    df_pdf = df_pdf.rename(columns={"address": "Property Nickname", "cleaner": "Cleaner"})
+
+    for col in ["Cleaner", "Property Nickname", "notes"]:
+        if col in df_pdf.columns:
+            df_pdf[col] = df_pdf[col].fillna("").astype(str).str.strip()
+
+    df_pdf["Cleaner"] = df_pdf["Cleaner"].replace("", "Unassigned")
+    return df_pdf[df_pdf["Property Nickname"] != ""].reset_index(drop=True)
+
+
+def _concat(frames: list) -> pd.DataFrame:
+    frames = [f for f in frames if not f.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+# Columnas de las hojas de debug cuando no hay filas que mostrar
+MATCHED_COLUMNS = [
+    "Cleaner", "Property Nickname", "page",
+    "address_confidence", "cleaner_confidence", "notes",
+    "Matched Address", "Matched Tag", "Match Score",
+    "Match Method", "Llave M"
+]
+REVIEW_COLUMNS = [
+    "Cleaner", "Property Nickname", "page", "address_confidence",
+    "cleaner_confidence", "notes", "Top Candidates", "Review Reason"
+]
+
+
+def group_report(matched_df: pd.DataFrame) -> pd.DataFrame:
+    """Hoja Reporte: una fila por (encargado, dirección) con todas sus llaves M."""
+    if matched_df.empty:
+        return pd.DataFrame(columns=["Dirección", "Encargado", "Llave M"])
+
+    df_report = matched_df[["Cleaner", "Property Nickname", "Llave M"]].rename(
+        columns={"Cleaner": "Encargado", "Property Nickname": "Dirección"}
+    )
+
+    df_report = df_report.fillna("").astype(str)
+    df_report["Encargado"] = df_report["Encargado"].str.strip().replace("", "Unassigned")
+    df_report["Dirección"] = df_report["Dirección"].str.strip()
+    df_report["Llave M"] = df_report["Llave M"].str.strip()
+    df_report = df_report[df_report["Dirección"] != ""]
+
+    return (
+        df_report.groupby(["Encargado", "Dirección"], as_index=False)
+        .agg({"Llave M": lambda x: ", ".join(sorted({v.strip() for v in x if v.strip()}))})
+        .sort_values(["Encargado", "Dirección"])
+    )[["Dirección", "Encargado", "Llave M"]]
+
+
+# Hojas de debug: se pueden dejar fuera del Excel y exportar aparte
+DEBUG_SHEETS = ("Extraido_PDF", "Matched_Debug")
+
+
+def _sheet_rows(df: pd.DataFrame):
+    """Filas como tuplas de Python, con celdas vacías en lugar de NaN."""
+    if df.empty:
+        return
+    values = df.astype(object).where(df.notna(), None)
+    yield from values.itertuples(index=False, name=None)
+
+
+def _write_sheet(ws, df: pd.DataFrame, hdr, start_row: int = 0):
+    ws.write_row(start_row, 0, [str(c) for c in df.columns], hdr)
+    for row, values in enumerate(_sheet_rows(df), start=start_row + 1):
+        ws.write_row(row, 0, values)
+
+
+def write_report_excel(
+    grouped: pd.DataFrame,
+    df_pdf: pd.DataFrame,
+    matched_df: pd.DataFrame,
+    review_df: pd.DataFrame,
+    perf_df: pd.DataFrame = None,
+    pages_df: pd.DataFrame = None,
+    include_debug: bool = True,
+    output_path: str = None,
+):
+    """
+    Escribe el Excel fila por fila con xlsxwriter en modo constant_memory:
+    cada hoja se vuelca a disco a medida que se escribe, así la memoria no
+    crece con la cantidad de filas. El rayado de la hoja Reporte es un
+    formato condicional, no un formato por fila.
+    `perf_df` (y el detalle por página `pages_df`) agregan la hoja Perf;
+    puede ser una función que lo arma justo antes de escribir esa hoja, así
+    incluye el tiempo de las hojas anteriores. Con include_debug=False no se
+    escriben Extraido_PDF ni Matched_Debug.
+    Con `output_path` el archivo va directo a disco y devuelve None; si no,
+    devuelve los bytes.
+    """
+    import xlsxwriter
+
+    output = output_path or BytesIO()
+    wb = xlsxwriter.Workbook(output, {"constant_memory": True})
+    try:
+        hdr = wb.add_format({
+            "bold": True,
+            "bg_color": "#305496",
+            "font_color": "white",
+            "border": 1,
+            "align": "center",
+            "valign": "vcenter",
+        })
+        cel = wb.add_format({
+            "border": 1,
+            "align": "left",
+            "valign": "vcenter",
+        })
+        alt = wb.add_format({
+            "border": 1,
+            "bg_color": "#F2F2F2",
+            "align": "left",
+            "valign": "vcenter",
+        })
+
+        ws = wb.add_worksheet("Reporte")
+        ws.set_column("A:A", 48, cel)
+        ws.set_column("B:B", 30, cel)
+        ws.set_column("C:C", 40, cel)
+        _write_sheet(ws, grouped, hdr)
+        if len(grouped):
+            ws.conditional_format(1, 0, len(grouped), len(grouped.columns) - 1, {
+                "type": "formula",
+                "criteria": "=MOD(ROW(),2)=1",
+                "format": alt,
+            })
+
+        if include_debug:
+            ws2 = wb.add_worksheet("Extraido_PDF")
+            ws2.set_column("A:A", 55)
+            ws2.set_column("B:B", 28)
+            ws2.set_column("C:F", 18)
+            _write_sheet(ws2, df_pdf, hdr)
+
+            ws3 = wb.add_worksheet("Matched_Debug")
+            ws3.set_column(0, len(matched_df.columns) - 1, 24)
+            _write_sheet(ws3, matched_df, hdr)
+
+        ws4 = wb.add_worksheet("Review_Needed")
+        ws4.set_column(0, len(review_df.columns) - 1, 28)
+        _write_sheet(ws4, review_df, hdr)
+
+        if callable(perf_df):
+            perf_df = perf_df()
+        if perf_df is not None:
+            ws5 = wb.add_worksheet("Perf")
+            ws5.set_column(0, 12, 18)
+            _write_sheet(ws5, perf_df, hdr)
+            if pages_df is not None and not pages_df.empty:
+                _write_sheet(ws5, pages_df, hdr, start_row=len(perf_df) + 2)
+    finally:
+        wb.close()
+
+    if output_path:
+        return None
+    return output.getvalue()
+
+
+def export_debug_tables(df_pdf: pd.DataFrame, matched_df: pd.DataFrame, prefix: str, fmt: str = "csv") -> list:
+    """
+    Guarda las hojas de debug como <prefix>.Extraido_PDF.csv / .parquet (y
+    Matched_Debug). Devuelve las rutas escritas.
+    """
+    if fmt not in ("csv", "parquet"):
+        raise ValueError(f"Formato de exportación desconocido: {fmt}")
+    if fmt == "parquet" and importlib.util.find_spec("pyarrow") is None:
+        raise ImportError("Falta pyarrow para exportar a Parquet. Agregá 'pyarrow' a requirements.txt")
+
+    paths = []
+    for name, df in zip(DEBUG_SHEETS, (df_pdf, matched_df)):
+        path = f"{prefix}.{name}.{fmt}"
+        if fmt == "csv":
+            df.to_csv(path, index=False)
+        else:
+            df.astype({c: str for c in df.columns if df[c].dtype == object}).to_parquet(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def pdf_page_count(pdf_bytes: bytes) -> int:
+    try:
+        import fitz
+    except ImportError:
+        raise ImportError("Falta PyMuPDF. Agregá 'pymupdf' a requirements.txt")
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        return doc.page_count
+
+
+def create_report_excel(
+    pdf_bytes: bytes,
+    progress_bar,
+    key_register: tuple,
+    api_key: str,
+    max_workers: int = DEFAULT_PAGE_CONCURRENCY,
+    use_cache: bool = True,
+    use_text_layer: bool = True,
+    render_profile: str = DEFAULT_RENDER_PROFILE,
+    on_update=None,
+    retry_budget: float = OPENAI_RETRY_BUDGET_S,
+    resume: bool = False,
+    stats: dict = None,
+    profile_matching: bool = False,
+    include_debug: bool = True,
+    output_path: str = None,
+    use_aliases: bool = True,
+    use_prefilter: bool = True,
+    pages_per_request: int = DEFAULT_PAGES_PER_REQUEST,
+    batch_overlap: bool = PAGE_BATCH_OVERLAP,
+):
+    """
+    Render → lectura → match página por página. `on_update(df_pdf, matched_df)`
+    se llama cada vez que hay filas nuevas, para ir mostrándolas en la UI; las
+    ambiguas de todas las páginas se resuelven al final en un solo tiebreak
+    en lote (MatchSession) y recién ahí entran al preview.
+    Cada página y cada tiebreak quedan en un checkpoint por hash del PDF; con
+    resume=True solo se vuelven a leer las páginas que faltan o fallaron.
+    `key_register` es el (df_keys, key_index) ya cargado; progress_bar puede
+    ser None. Los tiempos por etapa y los tokens quedan en stats["perf"]
+    (se puede pasar `stats` con la carga del register ya medida) y van a la
+    hoja Perf; con profile_matching=True el matching corre bajo cProfile y el
+    resumen queda en stats["matching_profile"].
+    Con `output_path` el Excel se escribe directo a ese archivo y en lugar de
+    los bytes se devuelve None. Con use_aliases=True las direcciones ya
+    confirmadas en corridas anteriores salen del AliasStore. Con
+    use_prefilter=True las páginas en blanco o de solo encabezado no van a la
+    API (stats["skipped_pages"]) y las que solo traen la cola de una dirección
+    van por el camino barato (stats["fragment_pages"]). Con
+    pages_per_request > 1 las páginas de visión consecutivas se leen de a
+    ventanas (ver iter_page_records); stats["gpt_requests"] cuenta las requests.
+    """
+    started = time.perf_counter()
+    progress_bar = progress_bar or NullProgress()
+    stats = stats if stats is not None else {}
+    profiler = cProfile.Profile() if profile_matching else None
+    checkpoint = JobCheckpoint(job_id_for(pdf_bytes))
+    if not resume:
+        checkpoint.reset()
+    saved_pages = checkpoint.ok_pages() if resume else {}
+    tiebreak_cache = checkpoint.load_tiebreaks() if resume else {}
+    stats["job_id"] = checkpoint.job_id
+
+    df_keys, key_index = key_register
+
+    n_pages = pdf_page_count(pdf_bytes)
+    checkpoint.save_meta(n_pages=n_pages, status="running", render_profile=render_profile)
+
+    profile = RENDER_PROFILES[render_profile]
+    cache = PageCache() if use_cache else None
+    aliases = AliasStore() if use_aliases else None
+    if aliases is not None:
+        aliases.prune(key_index)
+    pages = iter_pdf_pages(
+        pdf_bytes,
+        profile=profile,
+        use_text_layer=use_text_layer,
+        stats=stats,
+        skip_pages=set(saved_pages),
+        use_prefilter=use_prefilter,
+    )
+    page_records = iter_page_records(
+        pages,
+        n_pages,
+        progress_bar,
+        max_workers=max_workers,
+        cache=cache,
+        stats=stats,
+        profile=profile,
+        retry_budget=retry_budget,
+        saved_pages=saved_pages,
+        checkpoint=checkpoint,
+        api_key=api_key,
+        pages_per_request=pages_per_request,
+        batch_overlap=batch_overlap,
+    )
+
+    pdf_parts, matched_parts = [], []
+    total_records = 0
+    # Las ambiguas de todas las páginas van juntas a un solo tiebreak al final
+    matcher = MatchSession(key_index, tiebreak_cache, api_key, stats, aliases)
+
+    for records in iter_merged_records(page_records, stats):
+        total_records += len(records)
+        df_chunk = records_to_dataframe(records)
+        if df_chunk.empty:
+            continue
+
+        if profiler is not None:
+            profiler.enable()
+        matched_chunk = matcher.add(df_chunk)
+        if profiler is not None:
+            profiler.disable()
+        pdf_parts.append(df_chunk)
+        matched_parts.append(matched_chunk)
+
+        if on_update is not None:
+            on_update(_concat(pdf_parts), _concat(matched_parts))
+
+    if profiler is not None:
+        profiler.enable()
+    matched_df, review_df = matcher.finish()
+    if profiler is not None:
+        profiler.disable()
+    checkpoint.save_tiebreaks(tiebreak_cache)
+
+    checkpoint.save_meta(status="incomplete" if stats["failed_pages"] else "done")
+    if profiler is not None:
+        stats["matching_profile"] = _profile_report(profiler)
+
+    if not total_records:
+        if stats["failed_pages"]:
+            raise ValueError(f"Fallaron {len(stats['failed_pages'])} páginas y no quedó ninguna propiedad leída.")
+        raise ValueError("GPT no encontró propiedades en el PDF.")
+
+    df_pdf = _concat(pdf_parts)
+
+    if matched_df.empty and review_df.empty:
+        raise ValueError("No se pudo construir ningún resultado. Revisa el PDF y el Key Register.")
+
+    if matched_df.empty:
+        logger.warning("No hubo matches finales. Revisa la hoja Review_Needed.")
+        matched_df = pd.DataFrame(columns=MATCHED_COLUMNS)
+    if review_df.empty:
+        review_df = pd.DataFrame(columns=REVIEW_COLUMNS)
+    grouped = group_report(matched_df)
+
+    progress_bar.progress(0.92, text="Generando Excel...")
+    page_log = stats.get("page_log", {})
+    excel_started = time.perf_counter()
+    excel_recorded = 0.0
+
+    def perf_until_now() -> pd.DataFrame:
+        # La hoja Perf se escribe última: lleva el tiempo de las hojas
+        # anteriores; el cierre del archivo se suma después, solo a stats
+        nonlocal excel_recorded
+        excel_recorded = time.perf_counter() - excel_started
+        record_perf(stats, "excel", excel_recorded)
+        stats["total_s"] = time.perf_counter() - started
+        return perf_table(stats)
+
+    excel_bytes = write_report_excel(
+        grouped,
+        df_pdf,
+        matched_df,
+        review_df,
+        perf_df=perf_until_now,
+        pages_df=pd.DataFrame([page_log[p] for p in sorted(page_log)]),
+        include_debug=include_debug,
+        output_path=output_path,
+    )
+    record_perf(stats, "excel", time.perf_counter() - excel_started - excel_recorded, calls=0)
+    stats["total_s"] = time.perf_counter() - started
+
+    progress_bar.progress(1.0, text="¡Listo!")
+    return grouped, excel_bytes, df_pdf, matched_df, review_df, stats